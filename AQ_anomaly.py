@@ -0,0 +1,366 @@
+#==============================================================================
+# Flagging unusual hours (eg for sensor QA). Each series is split into a
+# trend (a centred running mean), a seasonal cycle (the mean of each month),
+# a diurnal cycle (the mean of each hour of the day in each month) and a
+# weekly cycle (the mean of each hour of each day of the week), and what is
+# left over is the residual. Residuals far from the usual (a robust z-score,
+# from the median and median absolute deviation of each series) are flagged.
+# All the series are done at once on a time x series array: the running mean
+# is a cumulative sum and each cycle is one grouped bincount (or one sort for
+# medians) over every series. A network is shared out over a pool of
+# processes a site at a time.
+# Function names:
+#   centred_mean(values, window, min_periods)
+#   grouped_means(values, keys, num_groups, robust)
+#   decompose(values, times, trend_hours, robust, iterations, step)
+#   robust_zscores(residual)
+#   detect_anomalies(data, threshold, trend_hours, robust, iterations, step)
+#   anomaly_table(result)
+#   site_anomalies(filename, species, verified, ...)
+#   network_anomalies(filenames, species, processes, ...)
+#==============================================================================
+# Uses modules:
+# os, multiprocessing, numpy, pandas, source_AQ_data, AQ_averages,
+# AQ_climatology, AQ_grid, AQ_profiling
+import os
+import multiprocessing
+import numpy as np
+import pandas as pd
+import source_AQ_data
+import AQ_averages
+import AQ_climatology
+import AQ_profiling
+from AQ_grid import RegularGrid
+#==============================================================================
+
+# The parts a series is split into (they add up to the series)
+COMPONENTS = ['trend', 'seasonal', 'diurnal', 'weekly', 'residual']
+
+# Scales the median absolute deviation to a standard deviation (normal data)
+MAD_SCALE = 1.4826
+
+ANOMALY_COLUMNS = ['Series', 'Time', 'Value', 'Expected', 'Residual',
+    'Z-score']
+
+def centred_mean(values, window, min_periods = None):
+    """
+        Centred running mean down the first axis of a float array (every
+        series at once), from AQ_averages.rolling_mean: the trailing mean
+        ending half a window later is the mean centred on a row. An even
+        window has one more row before than after (as pandas does).
+        Function IN:
+            values (REQUIRED, ARRAY):
+                1D or 2D float array, time along the first axis.
+            window (REQUIRED, INTEGER):
+                Number of rows in the window.
+            min_periods (OPTIONAL, INTEGER):
+                Number of non-NaN values needed. Default = half the window.
+        Function OUT:
+            means:
+                Float array the same shape as values.
+    """
+    values = np.asarray(values, dtype = np.float64)
+    if min_periods is None:
+        min_periods = max(window // 2, 1)
+    half = (window - 1) // 2
+    padded = np.concatenate((values, np.full((half,) + values.shape[1:],
+        np.nan)))
+    return AQ_averages.rolling_mean(padded, window, min_periods)[half:]
+
+def grouped_means(values, keys, num_groups, robust = False):
+    """
+        The mean (or median) of every series in each group.
+        Function IN:
+            values (REQUIRED, ARRAY):
+                2D float array, time x series (NaN is missing).
+            keys (REQUIRED, ARRAY of INTEGERS):
+                Group of each row (eg from AQ_climatology.group_keys).
+            num_groups (REQUIRED, INTEGER):
+                Number of groups.
+            robust (OPTIONAL, BOOLEAN):
+                Medians rather than means. Default = False
+        Function OUT:
+            means:
+                Float array, group x series (NaN for groups with no data).
+    """
+    num_series = values.shape[1]
+    valid = ~np.isnan(values)
+    # A bin for every series and group
+    bins = (keys[:, np.newaxis] * num_series + np.arange(num_series))[valid]
+    data = values[valid]
+    size = num_groups * num_series
+    counts = np.bincount(bins, minlength = size)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        if not robust:
+            sums = np.bincount(bins, weights = data, minlength = size)
+            return (sums / counts).reshape(num_groups, num_series)
+
+        # One sort by bin then value, so each bin is a sorted block
+        ordered = data[np.lexsort((data, bins))]
+        starts = np.cumsum(counts) - counts
+        lower = starts + np.maximum(counts - 1, 0) // 2
+        upper = starts + counts // 2
+        medians = np.full(size, np.nan)
+        has_data = counts > 0
+        medians[has_data] = (ordered[lower[has_data]] +
+            ordered[np.minimum(upper, len(ordered) - 1)[has_data]]) / 2.
+        return medians.reshape(num_groups, num_series)
+
+def _cycle(values, keys, num_groups, robust):
+    """
+        The grouped means of the values put back on every row.
+    """
+    return grouped_means(values, keys, num_groups, robust)[keys]
+
+def decompose(values, times, trend_hours = 720, robust = False,
+    iterations = 2, step = '1H'):
+    """
+        Split many series into trend, seasonal, diurnal, weekly and residual
+        parts. The cycles are taken off before the trend is worked out again,
+        iterations times, so a strong cycle doesn't pull the trend about.
+        Function IN:
+            values (REQUIRED, ARRAY):
+                2D float array, time x series (NaN is missing), on a regular
+                grid (eg the values of an AQ_grid grid).
+            times (REQUIRED, PANDAS DatetimeIndex):
+                Time of each row (hour ending, as in the DEFRA files, so
+                the cycles are keyed on the hour each value covers).
+            trend_hours (OPTIONAL, INTEGER):
+                Length of the running mean for the trend in hours (turned
+                into rows with step). Default = 720 (30 days)
+            robust (OPTIONAL, BOOLEAN):
+                Use medians for the cycles (slower, less pulled by spikes).
+                Default = False
+            iterations (OPTIONAL, INTEGER):
+                Times round the trend and cycles. Default = 2
+            step (OPTIONAL, STRING):
+                Time between rows (see AQ_climatology.group_keys). Default =
+                '1H'
+        Function OUT:
+            components:
+                Dictionary of each of COMPONENTS and a float array the shape
+                of values. They add up to the values (the trend and residual
+                are NaN where the trend's window has too little data).
+    """
+    values = np.asarray(values, dtype = np.float64)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    month = AQ_climatology.group_keys(times, 'month', step = step)[0]
+    month_hour = AQ_climatology.group_keys(times, 'month_hour',
+        step = step)[0]
+    hour_weekday = AQ_climatology.group_keys(times, 'hour_weekday',
+        step = step)[0]
+    trend_rows = max(int(round(pd.Timedelta(trend_hours, 'h') /
+        pd.Timedelta(step))), 1)
+
+    components = {}
+    cycles = np.zeros(values.shape)
+    with AQ_profiling.stage('decompose', values.size):
+        for iteration in range(max(int(iterations), 1)):
+            # A quarter of the window, so the ends of the series (which
+            # only have half a window) still get a trend
+            trend = centred_mean(values - cycles, trend_rows,
+                max(trend_rows // 4, 1))
+            detrended = values - trend
+            seasonal = _cycle(detrended, month, 12, robust)
+            # The diurnal cycle of each month, less the month's mean
+            diurnal = _cycle(detrended - seasonal, month_hour, 12 * 24,
+                robust)
+            weekly = _cycle(detrended - seasonal - diurnal, hour_weekday,
+                7 * 24, robust)
+            # Cycles with no data for a group add nothing
+            for cycle in (seasonal, diurnal, weekly):
+                cycle[np.isnan(cycle)] = 0.
+            cycles = seasonal + diurnal + weekly
+
+    components['trend'] = trend
+    components['seasonal'] = seasonal
+    components['diurnal'] = diurnal
+    components['weekly'] = weekly
+    components['residual'] = values - trend - cycles
+    return components
+
+def robust_zscores(residual):
+    """
+        Robust z-scores of every series: the distance from the median in
+        median absolute deviations (scaled to standard deviations), so the
+        anomalies being looked for don't widen the scale.
+        Function IN:
+            residual (REQUIRED, ARRAY):
+                2D float array, time x series.
+        Function OUT:
+            zscores:
+                Float array the same shape (NaN where the residual is).
+    """
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        residual = np.asarray(residual, dtype = np.float64)
+        empty = np.all(np.isnan(residual), axis = 0)
+        filled = np.where(empty, 0., residual)
+        median = np.nanmedian(filled, axis = 0)
+        spread = MAD_SCALE * np.nanmedian(np.abs(filled - median), axis = 0)
+        spread[spread == 0] = np.nan
+        return (residual - median) / spread
+
+def detect_anomalies(data, threshold = 4., trend_hours = 720,
+    robust = False, iterations = 2, step = '1H'):
+    """
+        Decompose every series and flag the hours whose residuals are far
+        from the usual.
+        Function IN:
+            data (REQUIRED, PANDAS SERIES, DATAFRAME or AQ_grid.RegularGrid):
+                The values with a datetime index (a column per series). They
+                are put on a regular grid first.
+            threshold (OPTIONAL, FLOAT):
+                Robust z-score (either side) above which an hour is flagged.
+                Default = 4
+            trend_hours, robust, iterations (OPTIONAL):
+                As for decompose.
+            step (OPTIONAL, STRING):
+                Time between measurements. Default = '1H'
+        Function OUT:
+            result:
+                Dictionary of pandas DataFrames (time x series) of each of
+                COMPONENTS, 'value', 'expected' (the value less the
+                residual), 'zscore' and 'anomaly' (True where flagged).
+    """
+    if isinstance(data, RegularGrid):
+        grid = data
+    else:
+        grid = RegularGrid.from_dataframe(data, step = step)
+    times = grid.times
+    components = decompose(grid.values, times, trend_hours, robust,
+        iterations, grid.step)
+    zscores = robust_zscores(components['residual'])
+    with np.errstate(invalid = 'ignore'):
+        anomaly = np.abs(zscores) > threshold
+
+    result = {}
+    frame = lambda values: pd.DataFrame(values, index = times,
+        columns = grid.names)
+    for name in COMPONENTS:
+        result[name] = frame(components[name])
+    result['value'] = frame(grid.values)
+    result['expected'] = frame(grid.values - components['residual'])
+    result['zscore'] = frame(zscores)
+    result['anomaly'] = frame(anomaly)
+    return result
+
+def anomaly_table(result):
+    """
+        The flagged hours from detect_anomalies as a list.
+        Function IN:
+            result (REQUIRED, DICTIONARY):
+                From detect_anomalies.
+        Function OUT:
+            table:
+                pandas DataFrame with columns Series, Time, Value, Expected,
+                Residual and Z-score, a row per flagged hour, sorted by
+                series then time.
+    """
+    anomaly = result['anomaly']
+    # Transposed so the flags come out by series then time
+    columns, rows = np.nonzero(anomaly.values.T)
+    pick = lambda name: result[name].values[rows, columns]
+    return pd.DataFrame({'Series': np.asarray(anomaly.columns,
+        dtype = object)[columns],
+        'Time': anomaly.index[rows],
+        'Value': pick('value'),
+        'Expected': pick('expected'),
+        'Residual': pick('residual'),
+        'Z-score': pick('zscore')}, columns = ANOMALY_COLUMNS)
+
+def site_anomalies(filename, species = None, verified = False,
+    threshold = 4., trend_hours = 720, robust = False, iterations = 2):
+    """
+        The anomalies of every species at a site (file).
+        Function IN:
+            filename (REQUIRED, STRING):
+                The csv file.
+            species (OPTIONAL, LIST of STRINGS):
+                The species. Default is all of them but wind direction.
+            verified (OPTIONAL, BOOLEAN):
+                Use just the verified data. Default = False (QA is usually
+                wanted before the data is verified).
+            threshold, trend_hours, robust, iterations (OPTIONAL):
+                As for detect_anomalies.
+        Function OUT:
+            table:
+                pandas DataFrame from anomaly_table, with the species as
+                the Series.
+    """
+    all_data = source_AQ_data.open_csv(filename)
+    if species is None:
+        # Wind directions are angles, so have no linear cycles
+        species = [name for name in source_AQ_data.list_species(
+            all_data.columns) if 'Direction' not in name]
+    species = [name for name in species if name in all_data.columns]
+    if verified:
+        grids = []
+        for name in species:
+            species_data = source_AQ_data.purge_unverified(
+                source_AQ_data.split_one_variable(all_data, name), name)
+            grids.append(RegularGrid.from_series(species_data[name]))
+        grid = RegularGrid.combine(grids)
+    else:
+        grid = RegularGrid.from_open_csv(all_data, species)
+    return anomaly_table(detect_anomalies(grid, threshold, trend_hours,
+        robust, iterations))
+
+def _site_anomalies_task(arguments):
+    """
+        Runs site_anomalies for network_anomalies (a pool needs a function at
+        the top of the module). Errors are returned rather than stopping the
+        other sites.
+    """
+    filename, species, kwargs = arguments
+    try:
+        return filename, site_anomalies(filename, species, **kwargs)
+    except Exception as error:
+        return filename, error
+
+def network_anomalies(filenames, species = None, processes = None,
+    **kwargs):
+    """
+        The anomalies of every site and species, with the sites shared out
+        over a pool of processes (each site's species are done together).
+        Function IN:
+            filenames (REQUIRED, LIST of STRINGS):
+                The csv files. The site name is the file name without the
+                directory or extension.
+            species (OPTIONAL, LIST of STRINGS):
+                The species. Default is all of them.
+            processes (OPTIONAL, INTEGER):
+                Number of processes. Default is the number of CPUs. 1 runs
+                everything here without a pool.
+            Anything else is passed on to site_anomalies.
+        Function OUT:
+            table:
+                pandas DataFrame as from anomaly_table with a Site column
+                first and the species in the Series column.
+    """
+    tasks = [(filename, species, kwargs) for filename in filenames]
+    if processes == 1 or len(tasks) < 2:
+        results = [_site_anomalies_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_site_anomalies_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    tables = []
+    for filename, table in results:
+        site = os.path.splitext(os.path.basename(filename))[0]
+        if isinstance(table, Exception):
+            print "Couldn't find anomalies for %s: %s" % (site, table)
+            continue
+        table.insert(0, 'Site', site)
+        tables.append(table)
+    if not tables:
+        return pd.DataFrame(columns = ['Site'] + ANOMALY_COLUMNS)
+    return pd.concat(tables, ignore_index = True)
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
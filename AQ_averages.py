@@ -3,70 +3,195 @@
 # variables passed can either be a pandas DataFrame or two arrays of time and
 # concentration. Maybe also do a dictionary option?
 # Function names:
-#   convert_to_pandas()
-#   running_24_hour()
 #   running_8_hour()
+#   running_24_hour()
 #   running_custom_hour()
+#   rolling_mean()
+#   period_mean()
 #==============================================================================
 # Uses modules:
-# pandas
+# numpy, pandas, quick_tools, AQ_profiling, AQ_bootstrap
+import numpy as np
 import pandas as pd
 import quick_tools
+import AQ_profiling
+import AQ_bootstrap
 #==============================================================================
 
-def running_8_hour(timeseries, date_and_time = 'None'):
+def running_8_hour(timeseries, date_and_time = 'None', min_periods = 6):
     """
             Calculates the rolling mean over an 8 hour period. Ideal for ozone
             and CO.
         Function IN:
-            timeseries(REQUIRED, PANDAS DATAFRAME or LIST or ARRAY):
-                A pandas dataframe of the time series. The time/date elemenet
-                must be set as an index for the dataframe. If its a list of a
-                numpy array then it will be converted to a pandas DataFrame.
+            timeseries(REQUIRED, PANDAS SERIES or LIST or ARRAY):
+                A pandas series of the time series. The time/date elemenet
+                must be set as an index for the series. If its a list or a
+                numpy array then it will be wrapped as a pandas Series (without
+                copying if its already a float array).
             date_and_time(OPTIONAL, LIST or ARRAY (DATETIME)):
-                This is used if the input isn't a pandas dataframe - and is
+                This is used if the input isn't a pandas series - and is
                 two seperate lists of concentration and corresponding date/time.
+                Can be datetime64, epoch seconds or strings.
+            min_periods(OPTIONAL, INTEGER):
+                Number of hours in the 8 that must have data. Default = 6
+                (75% data capture - see AQ_capture for checking capture).
         Fucntion OUT:
             aved_df:
                 The averaged dataframe - this includes mean, std., min, max etc.
     """
-    # If the input data is not a pandas timeseries, then try and make it one.
+    # If the input data is not a pandas timeseries, then make it one.
     if not isinstance(timeseries,pd.Series):
-        timeseries = quick_tools.convert_to_pandas(timeseries,date_and_time)
+        values, index = quick_tools.normalise_timeseries(timeseries,
+            date_and_time)
+        timeseries = pd.Series(values, index = index, copy = False)
 
     # Get 8 hour rolling stats for the the data.
-    # Needs to have a minimum of 75% values (ie 6/8)
-    aved_df = timeseries.rolling(8, min_periods = 6)
+    # Needs to have a minimum of 75% values (ie 6/8) by default
+    aved_df = timeseries.rolling(8, min_periods = min_periods)
 
     return aved_df
 
-def running_24_hour(arg):
+def running_24_hour(timeseries, date_and_time = 'None'):
     """
-            Calculates the rolling mean over an 8 hour period. Ideal for ozone
-            and CO.
+            Calculates the rolling mean over a 24 hour period. Ideal for
+            PM10 and PM2.5.
         Function IN:
-            argin(REQUIRED, DTYPE):
-                Description of the argument in, wheter its REQUIRED, OPTIONAL,
-                or DEFAULT
+            timeseries(REQUIRED, PANDAS SERIES or LIST or ARRAY):
+                The concentrations. See running_custom_hour.
+            date_and_time(OPTIONAL, LIST or ARRAY (DATETIME)):
+                The times if timeseries isn't a pandas Series.
         Fucntion OUT:
-            argout:
-                Description of what the fuction returns if any
+            aved_series:
+                pandas Series of the 24 hour means.
     """
-    pass
+    return running_custom_hour(timeseries, hours = 24,
+        date_and_time = date_and_time)
 
-def running_custom_hour(arg):
+def running_custom_hour(timeseries, hours = 8, date_and_time = 'None',
+    min_fraction = 0.75):
     """
-            Calculates the rolling mean over an 8 hour period. Ideal for ozone
-            and CO.
+            Calculates the rolling mean over any number of hours. The mean is
+            only given when enough of the window has data (75% by default).
+            The window is counted in rows, so the data should be hourly.
+        Function IN:
+            timeseries(REQUIRED, PANDAS SERIES or LIST or ARRAY):
+                The concentrations. Series, numpy arrays and lists are all
+                passed to the calculation as a float array without copying
+                where possible.
+            hours(OPTIONAL, INTEGER):
+                The length of the window in hours. Default = 8
+            date_and_time(OPTIONAL, LIST or ARRAY (DATETIME)):
+                The times if timeseries isn't a pandas Series. Can be
+                datetime64, epoch seconds or strings.
+            min_fraction(OPTIONAL, FLOAT):
+                Fraction of the window that must have data. Default = 0.75
+        Fucntion OUT:
+            aved_series:
+                pandas Series of the running means.
+    """
+    values, index = quick_tools.normalise_timeseries(timeseries, date_and_time)
+    min_periods = int(np.ceil(hours * min_fraction))
+    with AQ_profiling.stage('running_custom_hour.rolling_mean', len(values)):
+        means = rolling_mean(values, hours, min_periods = min_periods)
+
+    name = timeseries.name if isinstance(timeseries, pd.Series) else None
+    aved_series = pd.Series(means, index = index, name = name, copy = False)
+
+    return aved_series
+
+def rolling_mean(values, window, min_periods = None):
+    """
+            Trailing rolling mean of a float array (works down the first axis
+            so a 2D array of time x series does every series at once). Uses
+            cumulative sums so its one pass whatever the window length.
+            NaNs are ignored and counted as missing.
         Function IN:
-            argin(REQUIRED, DTYPE):
-                Description of the argument in, wheter its REQUIRED, OPTIONAL,
-                or DEFAULT
+            values(REQUIRED, NUMPY ARRAY):
+                1D or 2D float array, time along the first axis.
+            window(REQUIRED, INTEGER):
+                Number of rows in the window.
+            min_periods(OPTIONAL, INTEGER):
+                Number of non-NaN values needed to give a mean. Defaults to
+                the whole window.
         Fucntion OUT:
-            argout:
-                Description of what the fuction returns if any
+            means:
+                Float array the same shape as values.
     """
-    pass
+    if min_periods is None:
+        min_periods = window
+    values = np.asarray(values, dtype = np.float64)
+    valid = ~np.isnan(values)
+
+    # Cumulative sums with a leading zero row so window sums are differences
+    pad = np.zeros((1,) + values.shape[1:])
+    sums = np.concatenate((pad, np.cumsum(np.where(valid, values, 0.),
+        axis = 0)))
+    counts = np.concatenate((pad, np.cumsum(valid, axis = 0)))
+
+    # End and start of each window (the start is clipped at the first row)
+    upper = np.arange(1, len(values) + 1)
+    lower = np.maximum(upper - window, 0)
+    window_sums = sums[upper] - sums[lower]
+    window_counts = counts[upper] - counts[lower]
+
+    means = np.full(values.shape, np.nan)
+    enough = window_counts >= max(min_periods, 1)
+    means[enough] = window_sums[enough] / window_counts[enough]
+
+    return means
+
+def period_mean(timeseries, period = 'A', date_and_time = 'None',
+    confidence = None, block_length = 24, num_bootstrap = 1000, seed = 0):
+    """
+            Calculates the mean of each day, month or year (eg to compare with
+            the annual limits), optionally with a block bootstrap confidence
+            interval. Times are hour ending, so the 24:00 hour counts in the
+            period it ends.
+        Function IN:
+            timeseries(REQUIRED, PANDAS SERIES or LIST or ARRAY):
+                The hourly concentrations. See running_custom_hour.
+            period(OPTIONAL, STRING):
+                'D', 'M' or 'A' (day, month or year). Default = 'A'
+            date_and_time(OPTIONAL, LIST or ARRAY (DATETIME)):
+                The times if timeseries isn't a pandas Series.
+            confidence(OPTIONAL, FLOAT):
+                If given (eg 0.95) the Lower and Upper columns hold the
+                confidence interval of the mean (NaN for periods with less
+                than two blocks of data). See AQ_bootstrap.
+            block_length(OPTIONAL, INTEGER):
+                Hours in each bootstrap block. Default = 24
+            num_bootstrap(OPTIONAL, INTEGER):
+                Number of bootstrap copies. Default = 1000
+            seed(OPTIONAL, INTEGER):
+                Seed for the bootstrap, so the interval can be repeated.
+        Fucntion OUT:
+            aved_df:
+                pandas DataFrame indexed by period with columns Mean, Count
+                (hours with data) and, if confidence is given, Lower and
+                Upper.
+    """
+    values, index = quick_tools.normalise_timeseries(timeseries, date_and_time)
+    series = pd.Series(values, index = index, copy = False)
+    matrix, lengths, rows = AQ_bootstrap.period_matrix(series, period)
+
+    with AQ_profiling.stage('period_mean.bootstrap', matrix.size):
+        if confidence is None:
+            with np.errstate(invalid = 'ignore'):
+                means = np.nanmean(matrix, axis = 1)
+            columns = {'Mean': means}
+        else:
+            means, lower, upper = AQ_bootstrap.block_bootstrap(matrix,
+                'mean', lengths, block_length, num_bootstrap, confidence,
+                seed)
+            columns = {'Mean': means, 'Lower': lower, 'Upper': upper}
+    columns['Count'] = np.sum(~np.isnan(matrix), axis = 1)
+
+    aved_df = pd.DataFrame(columns, index = pd.Index(
+        rows.get_level_values('Period'), name = 'Period'),
+        columns = ['Mean', 'Lower', 'Upper', 'Count']
+        if confidence is not None else ['Mean', 'Count'])
+
+    return aved_df
 
 if __name__ == '__main__':
     # If the module needs testing as a stand alone, use this to set the
@@ -74,6 +199,7 @@ if __name__ == '__main__':
     filename  = 'Example_Data/' \
                     + 'edinburgh_st_leonards_2015_2017.csv'
     fname(filename)
+
 ## ============================================================================
 ## END OF PROGAM
 ## ============================================================================
@@ -0,0 +1,449 @@
+#==============================================================================
+# Timing and memory measurements for the package. Run as a script to print
+# the numbers, eg:
+#       python -m Edinburgh_AQ.AQ_benchmarks --years 1 5 20
+#       python -m Edinburgh_AQ.AQ_benchmarks --save-baseline baseline.json
+#       python -m Edinburgh_AQ.AQ_benchmarks --baseline baseline.json
+# The data used is made with synthetic_AQ_data so nothing needs downloading.
+# Each benchmark is run a few times (in a new process each time) and the
+# fastest is kept. How much slower the median run is gives the noise, and a
+# change has to be bigger than a few times the noise to count as a
+# regression.
+# Function names:
+#   measure(func, *args, **kwargs)
+#   measure_repeated(func, *args, **kwargs)
+#   input_path_benchmarks(sizes, repeat)
+#   suite_benchmarks(years, directory, seed, repeat)
+#   print_results(results)
+#   save_baseline(results, filename)
+#   compare_to_baseline(results, filename, tolerance, min_seconds, min_mb,
+#       noise_factor)
+#   import_times(modules)
+#   check_imports(budget_seconds)
+#==============================================================================
+# Uses modules:
+# os, sys, time, json, shutil, tempfile, argparse, resource, subprocess,
+# multiprocessing, numpy, pandas, quick_tools, AQ_averages, windrose,
+# source_AQ_data, AQ_limits, synthetic_AQ_data
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import resource
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+import quick_tools
+import AQ_averages
+import source_AQ_data
+import synthetic_AQ_data
+from windrose import windrose
+from AQ_limits import AQ_limits
+#==============================================================================
+
+# Modules that should only be imported by the plotting code. Importing any of
+# the data modules must not pull these in.
+PLOTTING_MODULES = ['plotly', 'brewer2mpl', 'matplotlib']
+# The data and limits modules, which should import quickly.
+DATA_MODULES = ['quick_tools', 'source_AQ_data', 'AQ_averages', 'AQ_limits',
+    'windrose']
+# A change in time must be more than this many times the noise to be a
+# regression
+NOISE_FACTOR = 3.
+
+def measure(func, *args, **kwargs):
+    """
+        Runs a function in a separate process and measures how long it takes
+        and how much the peak memory (max resident set size) grows while it
+        runs. Running in a new process means each measurement starts from the
+        same memory and one result doesn't hide the next.
+        Function IN:
+            func (REQUIRED, FUNCTION):
+                The function to run. Must be importable (ie module level) as
+                it is sent to another process.
+            *args, **kwargs:
+                Passed on to the function.
+            setup (OPTIONAL, FUNCTION):
+                If given as a keyword, this is called with the arguments
+                instead and must return a tuple of arguments for func. Only
+                func is timed (eg. setup can load the data first).
+        Function OUT:
+            seconds:
+                Wall time of the function call.
+            peak_mb:
+                Growth of the peak memory in megabytes during the call.
+    """
+    setup = kwargs.pop('setup', None)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target = _measure_child,
+        args = (queue, setup, func, args, kwargs))
+    process.start()
+    seconds, peak_mb = queue.get()
+    process.join()
+    return seconds, peak_mb
+
+def measure_repeated(func, *args, **kwargs):
+    """
+        Runs measure a number of times and keeps the fastest, so one slow
+        run (eg the machine was busy) isn't taken as the time.
+        Function IN:
+            func, *args, **kwargs, setup:
+                As for measure.
+            repeat (OPTIONAL, INTEGER):
+                If given as a keyword, the number of runs. Default = 3
+        Function OUT:
+            seconds:
+                Wall time of the fastest run.
+            peak_mb:
+                Smallest growth of the peak memory.
+            noise:
+                Seconds the median run took over the fastest.
+    """
+    repeat = max(int(kwargs.pop('repeat', 3)), 1)
+    runs = [measure(func, *args, **kwargs) for n in range(repeat)]
+    seconds = np.array([run[0] for run in runs])
+    peak_mb = min(run[1] for run in runs)
+    return seconds.min(), peak_mb, np.median(seconds) - seconds.min()
+
+def _measure_child(queue, setup, func, args, kwargs):
+    """
+        Does the timing inside the child process for measure().
+    """
+    if setup is not None:
+        args = setup(*args, **kwargs)
+        kwargs = {}
+    # ru_maxrss is in kilobytes on Linux
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    func(*args, **kwargs)
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((seconds, (after - before) / 1024.))
+
+def _make_inputs(size):
+    """
+        Make an hourly float array of concentrations and datetime64 times.
+    """
+    rng = np.random.RandomState(size % (2 ** 32))
+    values = rng.gamma(2., 10., size)
+    times = np.datetime64('2000-01-01T01:00', 'ns') + \
+        np.arange(size) * np.timedelta64(1, 'h')
+    return values, times
+
+def _convert_inputs(size):
+    values, times = _make_inputs(size)
+    quick_tools.convert_to_pandas(values, times)
+
+def _convert_inputs_by_parsing(size):
+    # The old way: a dict based DataFrame with the times re-parsed
+    values, times = _make_inputs(size)
+    df = pd.DataFrame({'Data': values, 'date_and_time': times})
+    df['date_and_time'] = pd.to_datetime(df['date_and_time'].astype(str))
+    df.index = df.pop('date_and_time')
+
+def _running_mean_array(size):
+    values, times = _make_inputs(size)
+    AQ_averages.running_custom_hour(values, hours = 8, date_and_time = times)
+
+def _windrose_array(size):
+    values, times = _make_inputs(size)
+    directions = np.mod(values * 7.3, 360.)
+    windrose(values / 5., directions)
+
+def input_path_benchmarks(sizes = (100000, 1000000, 5000000), repeat = 3):
+    """
+        Time and memory for the numpy / datetime64 input paths at a number
+        of data sizes. Also checks that the inputs are not copied.
+        Function IN:
+            sizes (OPTIONAL, LIST of INTEGERS):
+                The numbers of hourly values to try.
+            repeat (OPTIONAL, INTEGER):
+                Runs of each benchmark (see measure_repeated). Default = 3
+        Function OUT:
+            results:
+                List of (name, size, seconds, peak_mb, noise) tuples.
+    """
+    cases = [('convert_to_pandas (datetime64)', _convert_inputs),
+             ('convert_to_pandas (re-parsed)', _convert_inputs_by_parsing),
+             ('running_custom_hour (ndarray)', _running_mean_array),
+             ('windrose (ndarray)', _windrose_array)]
+    results = []
+    for size in sizes:
+        for name, func in cases:
+            results.append((name, size) + measure_repeated(func, size,
+                repeat = repeat))
+    return results
+
+def check_zero_copy(size = 1000):
+    """
+        Checks the numpy input paths share memory with the input.
+        Function OUT:
+            shared:
+                Dictionary of path name and True/False.
+    """
+    values, times = _make_inputs(size)
+    series = pd.Series(values, index = pd.DatetimeIndex(times))
+    shared = {}
+    shared['as_float_array (ndarray)'] = np.shares_memory(
+        quick_tools.as_float_array(values), values)
+    shared['as_float_array (Series)'] = np.shares_memory(
+        quick_tools.as_float_array(series), values)
+    shared['convert_to_pandas'] = np.shares_memory(
+        quick_tools.convert_to_pandas(values, times)['Data'].values, values)
+    shared['as_datetime_index'] = np.shares_memory(
+        quick_tools.as_datetime_index(times).values, times)
+    return shared
+
+# Species used in the benchmarks
+BENCHMARK_SPECIES = 'Nitrogen dioxide'
+
+def _select_setup(filename):
+    return BENCHMARK_SPECIES, filename
+
+def _purge_setup(filename):
+    return source_AQ_data.select_one_variable(BENCHMARK_SPECIES, filename)
+
+def _running_8_hour_setup(filename):
+    species_data, variablename = _purge_setup(filename)
+    return (species_data[variablename],)
+
+def _running_8_hour_mean(timeseries):
+    AQ_averages.running_8_hour(timeseries).mean()
+
+def _windrose_setup(filename):
+    wd = source_AQ_data.select_one_variable('Modelled Wind Direction',
+        filename)[0]
+    ws = source_AQ_data.select_one_variable('Modelled Wind Speed',
+        filename)[0]
+    wind = pd.concat([wd, ws], axis = 1).dropna()
+    return wind['Modelled Wind Speed'], wind['Modelled Wind Direction']
+
+def _limits_setup(filename):
+    return ('NO2',)
+
+# The benchmarks in the suite as (name, setup, function). The setup is given
+# the data file and returns the arguments for the function.
+SUITE = [('open_csv', None, source_AQ_data.open_csv),
+         ('select_one_variable', _select_setup,
+            source_AQ_data.select_one_variable),
+         ('purge_unverified', _purge_setup, source_AQ_data.purge_unverified),
+         ('running_8_hour', _running_8_hour_setup, _running_8_hour_mean),
+         ('windrose', _windrose_setup, windrose),
+         ('AQ_limits', _limits_setup, AQ_limits)]
+
+def suite_benchmarks(years = (1, 5, 20), directory = None, seed = 0,
+    repeat = 3):
+    """
+        Time and memory of the main processing steps for synthetic DEFRA
+        files of a number of years of data.
+        Function IN:
+            years (OPTIONAL, LIST of INTEGERS):
+                The numbers of years of hourly data to try.
+            directory (OPTIONAL, STRING):
+                Where to write the data files. A temporary directory is used
+                (and removed) if not given.
+            seed (OPTIONAL, INTEGER):
+                Seed for the synthetic data.
+            repeat (OPTIONAL, INTEGER):
+                Runs of each benchmark (see measure_repeated). Default = 3
+        Function OUT:
+            results:
+                List of (name, size, seconds, peak_mb, noise) tuples. The
+                size is the number of rows (hours) of data.
+    """
+    remove_directory = directory is None
+    if remove_directory:
+        directory = tempfile.mkdtemp(prefix = 'AQ_benchmarks_')
+
+    results = []
+    try:
+        for num_years in years:
+            filename = os.path.join(directory,
+                'synthetic_%d_years_seed_%d.csv' % (num_years, seed))
+            if not os.path.exists(filename):
+                synthetic_AQ_data.write_defra_csv(filename, years = num_years,
+                    seed = seed)
+            size = sum(1 for line in open(filename)) - 5
+            for name, setup, func in SUITE:
+                if setup is None:
+                    timing = measure_repeated(func, filename,
+                        repeat = repeat)
+                else:
+                    timing = measure_repeated(func, filename, setup = setup,
+                        repeat = repeat)
+                results.append((name, size) + timing)
+    finally:
+        if remove_directory:
+            shutil.rmtree(directory)
+
+    return results
+
+def print_results(results):
+    """
+        Print a table of benchmark results.
+    """
+    print '%-40s %10s %10s %10s %10s' % ('Benchmark', 'Size', 'Seconds',
+        'Noise', 'Peak MB')
+    for result in results:
+        seconds, peak_mb, noise = _timing(result)
+        print '%-40s %10d %10.4f %10.4f %10.1f' % (result[0], result[1],
+            seconds, noise, peak_mb)
+
+def _timing(result):
+    """
+        Seconds, peak MB and noise of a result (baselines saved before the
+        noise was kept have none).
+    """
+    seconds, peak_mb = result[2:4]
+    noise = result[4] if len(result) > 4 else 0.
+    return seconds, peak_mb, noise
+
+def save_baseline(results, filename):
+    """
+        Save benchmark results to a JSON file to compare against later.
+    """
+    with open(filename, 'w') as f:
+        json.dump([list(r) for r in results], f, indent = 1)
+
+def compare_to_baseline(results, filename, tolerance = 0.25,
+    min_seconds = 0.01, min_mb = 5., noise_factor = NOISE_FACTOR):
+    """
+        Compare benchmark results to ones saved with save_baseline and print
+        any that have got worse.
+        Function IN:
+            results (REQUIRED, LIST):
+                Results from suite_benchmarks or input_path_benchmarks.
+            filename (REQUIRED, STRING):
+                The saved baseline JSON file.
+            tolerance (OPTIONAL, FLOAT):
+                Fraction slower (or bigger) allowed before its a regression.
+                Default = 0.25 (ie 25%)
+            min_seconds, min_mb (OPTIONAL, FLOAT):
+                Changes smaller than these are ignored as they are just noise.
+            noise_factor (OPTIONAL, FLOAT):
+                Slowdowns must also be more than this many times the noise
+                of the baseline or the new run (whichever is bigger).
+                Default = NOISE_FACTOR
+        Function OUT:
+            regressions:
+                List of (name, size, what, baseline, now) for anything worse.
+    """
+    with open(filename) as f:
+        baseline = dict(((r[0], r[1]), _timing(r)) for r in json.load(f))
+
+    regressions = []
+    for result in results:
+        name, size = result[:2]
+        if (name, size) not in baseline:
+            continue
+        seconds, peak_mb, noise = _timing(result)
+        base_seconds, base_mb, base_noise = baseline[(name, size)]
+        allowed = max(min_seconds, noise_factor * max(noise, base_noise))
+        if seconds > base_seconds * (1 + tolerance) and \
+            seconds - base_seconds > allowed:
+            regressions.append((name, size, 'seconds', base_seconds, seconds))
+        if peak_mb > base_mb * (1 + tolerance) and peak_mb - base_mb > min_mb:
+            regressions.append((name, size, 'peak MB', base_mb, peak_mb))
+
+    for name, size, what, before, now in regressions:
+        print 'REGRESSION %s (%d rows) %s: %.4f -> %.4f' % (name, size, what,
+            before, now)
+    return regressions
+
+def import_times(modules = DATA_MODULES, repeat = 3):
+    """
+        Measure how long it takes to import each module in a fresh python
+        process, and which plotting modules it brought in with it.
+        Function IN:
+            modules (OPTIONAL, LIST of STRINGS):
+                The module names within the package to import.
+            repeat (OPTIONAL, INTEGER):
+                Number of times to import each module. The fastest is kept.
+        Function OUT:
+            results:
+                Dictionary of module name and (seconds, list of plotting
+                modules loaded).
+    """
+    # Run from the directory above the package so it can be imported by name
+    package_path = os.path.dirname(os.path.abspath(__file__))
+    package_name = os.path.basename(package_path)
+    code = ('import sys, time, json\n'
+            'start = time.time()\n'
+            'import %s.%%s\n'
+            'seconds = time.time() - start\n'
+            'loaded = [m for m in %r if m in sys.modules]\n'
+            'print(json.dumps([seconds, loaded]))\n') % (package_name,
+                PLOTTING_MODULES)
+
+    results = {}
+    for module in modules:
+        best = None
+        for n in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c',
+                code % module], cwd = os.path.dirname(package_path))
+            seconds, loaded = json.loads(output.strip().splitlines()[-1])
+            if best is None or seconds < best[0]:
+                best = (seconds, loaded)
+        results[module] = best
+    return results
+
+def check_imports(budget_seconds = 2.0, modules = DATA_MODULES):
+    """
+        Guard against slow imports creeping back in. Fails if any of the data
+        modules imports a plotting module or takes longer than the budget.
+        Function IN:
+            budget_seconds (OPTIONAL, FLOAT):
+                The longest an import may take. Default = 2 seconds
+            modules (OPTIONAL, LIST of STRINGS):
+                The module names within the package to check.
+        Function OUT:
+            passed:
+                True if all the modules are within budget.
+    """
+    passed = True
+    for module, (seconds, loaded) in sorted(import_times(modules).items()):
+        status = 'ok'
+        if loaded:
+            status = 'FAIL imports %s' % ', '.join(loaded)
+            passed = False
+        elif seconds > budget_seconds:
+            status = 'FAIL over %.2f s budget' % budget_seconds
+            passed = False
+        print '%-20s %8.3f s  %s' % (module, seconds, status)
+    return passed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Edinburgh_AQ benchmarks')
+    parser.add_argument('--years', type = int, nargs = '+', default = [1, 5, 20],
+        help = 'Years of synthetic data for the suite')
+    parser.add_argument('--inputs', action = 'store_true',
+        help = 'Also run the numpy / datetime64 input path benchmarks')
+    parser.add_argument('--save-baseline', help = 'Save the results here')
+    parser.add_argument('--baseline', help = 'Compare to a saved baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25,
+        help = 'Fraction slower allowed before a regression (default 0.25)')
+    parser.add_argument('--repeat', type = int, default = 3,
+        help = 'Runs of each benchmark, the fastest is kept (default 3)')
+    args = parser.parse_args()
+
+    if not check_imports():
+        sys.exit(1)
+    results = suite_benchmarks(args.years, repeat = args.repeat)
+    if args.inputs:
+        for name, shared in sorted(check_zero_copy().items()):
+            print '%-40s shares memory: %s' % (name, shared)
+        results += input_path_benchmarks(repeat = args.repeat)
+    print_results(results)
+
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline)
+    if args.baseline and compare_to_baseline(results, args.baseline,
+        tolerance = args.tolerance):
+        sys.exit(1)
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,277 @@
+#==============================================================================
+# Confidence intervals of period means and percentiles (eg an annual mean
+# close to its limit) by moving block bootstrap: each copy of a period is
+# made from randomly chosen blocks of consecutive hours, so the hour to hour
+# correlation is kept. All the random block starts of every copy of every
+# series and period are drawn as one array. For means only the block sums
+# are needed (from cumulative sums), so the copies never have to be built
+# hour by hour.
+# Function names:
+#   block_bootstrap(values, statistic, lengths, block_length, num_bootstrap,
+#       confidence, seed)
+#   period_matrix(data, period)
+#   period_statistics(data, period, statistic, block_length, num_bootstrap,
+#       confidence, seed)
+#==============================================================================
+# Uses modules:
+# numpy, pandas
+import numpy as np
+import pandas as pd
+#==============================================================================
+
+# numpy datetime units for each period (pandas names too)
+PERIOD_UNITS = {'day': 'D', 'D': 'D', 'month': 'M', 'M': 'M', 'year': 'Y',
+    'A': 'Y', 'Y': 'Y'}
+
+# Most numbers in each array when building bootstrap copies (rows are done
+# in batches to keep under it, and a few arrays this size are held at once)
+MAX_ELEMENTS = 5000000
+
+def _data_span(values, lengths):
+    """
+        The first column with data in each row and the number of columns
+        from there to the last with data (at least 1), so the blocks are
+        drawn from the part of a period that has data.
+    """
+    valid = ~np.isnan(values)
+    width = values.shape[1]
+    first = np.argmax(valid, axis = 1)
+    last = width - np.argmax(valid[:, ::-1], axis = 1)
+    span = np.where(valid.any(axis = 1), last - first, 1)
+    return first, np.minimum(span, np.maximum(lengths - first, 1))
+
+def _block_starts(first, span, block_length, num_bootstrap, num_blocks, rng):
+    """
+        Random block starts for every row, copy and block: an integer array,
+        row x copy x block. Row r has starts from its first column with data
+        to the end of its data less the block length.
+    """
+    choices = np.maximum(span - block_length + 1, 1)
+    random = rng.random_sample((len(span), num_bootstrap, num_blocks))
+    return first[:, np.newaxis, np.newaxis] + (random *
+        choices[:, np.newaxis, np.newaxis]).astype(np.int64)
+
+def _bootstrap_means(values, first, span, block_length, num_bootstrap, rng):
+    """
+        Means of the bootstrap copies of every row, from the sums and counts
+        of the blocks (NaNs left out). Each copy is the length of the span of
+        its row with data, so the last block is cut short if need be. Done in
+        batches of rows to keep the memory down. Returns an array, row x
+        copy.
+    """
+    num_rows, width = values.shape
+    valid = ~np.isnan(values)
+    zeros = np.zeros((num_rows, 1))
+    sums = np.hstack((zeros, np.cumsum(np.where(valid, values, 0.), axis = 1)))
+    counts = np.hstack((zeros, np.cumsum(valid, axis = 1)))
+
+    num_blocks = int(np.ceil(float(span.max()) / block_length))
+    batch = max(1, MAX_ELEMENTS // (num_bootstrap * num_blocks))
+    results = np.full((num_rows, num_bootstrap), np.nan)
+
+    for start in range(0, num_rows, batch):
+        rows = slice(start, min(start + batch, num_rows))
+        starts = _block_starts(first[rows], span[rows], block_length,
+            num_bootstrap, num_blocks, rng)
+        # Hours of each block used in the copy (0 past the end of the span)
+        used = np.clip(span[rows][:, np.newaxis] - block_length *
+            np.arange(num_blocks), 0, block_length)[:, np.newaxis, :]
+        ends = np.minimum(starts + used, width)
+        index = np.arange(starts.shape[0])[:, np.newaxis, np.newaxis]
+        row_sums, row_counts = sums[rows], counts[rows]
+        total = np.sum(row_sums[index, ends] - row_sums[index, starts],
+            axis = 2)
+        count = np.sum(row_counts[index, ends] - row_counts[index, starts],
+            axis = 2)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            results[rows] = total / count
+    return results
+
+def _bootstrap_percentiles(values, first, span, block_length, num_bootstrap,
+    percentile, rng):
+    """
+        A percentile of the bootstrap copies of every row. The copies are
+        built in batches of rows to keep the memory down. Returns an array,
+        row x copy.
+    """
+    num_rows, width = values.shape
+    num_blocks = int(np.ceil(float(span.max()) / block_length))
+    copy_length = num_blocks * block_length
+    batch = max(1, MAX_ELEMENTS // (num_bootstrap * copy_length))
+    offsets = np.arange(block_length)
+    results = np.full((num_rows, num_bootstrap), np.nan)
+
+    for start in range(0, num_rows, batch):
+        rows = slice(start, min(start + batch, num_rows))
+        row_spans = span[rows][:, np.newaxis, np.newaxis]
+        row_ends = (first + span)[rows][:, np.newaxis, np.newaxis]
+        starts = _block_starts(first[rows], span[rows], block_length,
+            num_bootstrap, num_blocks, rng)
+        # Hour of the row for every hour of every copy
+        hours = (starts[:, :, :, np.newaxis] + offsets).reshape(
+            starts.shape[0], num_bootstrap, copy_length)
+        copies = values[rows][np.arange(starts.shape[0])[:, np.newaxis,
+            np.newaxis], np.minimum(hours, width - 1)]
+        # Cut each copy to the length of its span (and blocks of short spans
+        # to the span)
+        copies[(np.arange(copy_length) >= row_spans) |
+            (hours >= row_ends)] = np.nan
+        results[rows] = _sorted_percentile(np.sort(copies, axis = 2),
+            percentile)
+    return results
+
+def _sorted_percentile(ordered, percentile):
+    """
+        A percentile along the last axis of an array already sorted along it
+        (NaNs sort to the end), interpolating as numpy does. Much quicker than
+        np.nanpercentile on lots of rows.
+    """
+    count = np.sum(~np.isnan(ordered), axis = -1)
+    position = percentile / 100. * np.maximum(count - 1, 0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, np.maximum(count - 1, 0))
+    fraction = position - lower
+    low = np.take_along_axis(ordered, lower[..., np.newaxis], -1)[..., 0]
+    high = np.take_along_axis(ordered, upper[..., np.newaxis], -1)[..., 0]
+    result = low + fraction * (high - low)
+    result[count == 0] = np.nan
+    return result
+
+def block_bootstrap(values, statistic = 'mean', lengths = None,
+    block_length = 24, num_bootstrap = 1000, confidence = 0.95, seed = 0):
+    """
+        Moving block bootstrap confidence intervals of the mean or a
+        percentile of many series at once.
+        Function IN:
+            values (REQUIRED, ARRAY):
+                1D or 2D float array, a series per row (NaN is missing).
+            statistic (OPTIONAL, STRING or FLOAT):
+                'mean' (default), 'median' or a percentile (0-100).
+            lengths (OPTIONAL, ARRAY):
+                Length of each row (the rest is padding). Default is the whole
+                row.
+            block_length (OPTIONAL, INTEGER):
+                Hours (columns) in each block. Should be long enough to cover
+                the correlation of the data and much shorter than the rows.
+                Default = 24
+            num_bootstrap (OPTIONAL, INTEGER):
+                Number of bootstrap copies. Default = 1000
+            confidence (OPTIONAL, FLOAT):
+                Confidence level. Default = 0.95
+            seed (OPTIONAL, INTEGER):
+                Seed for the random numbers, so the intervals can be repeated.
+                Default = 0
+        Function OUT:
+            estimate, lower, upper:
+                Arrays (one value per row) of the statistic and its interval.
+                Blocks are only drawn from the span of a row that has data,
+                and rows whose span is shorter than two blocks get NaN for
+                the interval.
+    """
+    values = np.asarray(values, dtype = np.float64)
+    single = values.ndim == 1
+    values = np.atleast_2d(values)
+    if lengths is None:
+        lengths = np.full(len(values), values.shape[1], dtype = np.int64)
+    lengths = np.asarray(lengths, dtype = np.int64)
+    block_length = max(1, int(block_length))
+    first, span = _data_span(values, lengths)
+    rng = np.random.RandomState(seed)
+
+    with np.errstate(invalid = 'ignore'):
+        if statistic == 'mean':
+            estimate = np.nanmean(values, axis = 1)
+            copies = _bootstrap_means(values, first, span, block_length,
+                num_bootstrap, rng)
+        else:
+            percentile = 50. if statistic == 'median' else float(statistic)
+            estimate = np.nanpercentile(values, percentile, axis = 1)
+            copies = _bootstrap_percentiles(values, first, span,
+                block_length, num_bootstrap, percentile, rng)
+        alpha = 100. * (1. - confidence) / 2.
+        lower, upper = np.nanpercentile(copies, [alpha, 100. - alpha],
+            axis = 1)
+
+    # Rows with no data, or too little to draw different blocks from, have
+    # no interval
+    empty = np.isnan(estimate) | (span < 2 * block_length)
+    lower[empty] = upper[empty] = np.nan
+    if single:
+        return float(estimate[0]), float(lower[0]), float(upper[0])
+    return estimate, lower, upper
+
+def period_matrix(data, period = 'year', step = '1H'):
+    """
+        Rearrange series so each row is one series in one period (day, month
+        or year) and each column an hour of the period. Times are hour ending
+        (as in the DEFRA files), so the 24:00 hour counts in the period it
+        ends.
+        Function IN:
+            data (REQUIRED, PANDAS SERIES or DATAFRAME):
+                The values with a datetime index (a column per series).
+            period (OPTIONAL, STRING):
+                'day', 'month' or 'year' (or D, M, A). Default = 'year'
+            step (OPTIONAL, STRING):
+                Time between measurements. Default = '1H'
+        Function OUT:
+            matrix:
+                2D float array, (series, period) x hour, NaN padded.
+            lengths:
+                Number of hours in each row's period.
+            index:
+                pandas MultiIndex of (Series, Period) for the rows.
+    """
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    unit = PERIOD_UNITS[period]
+    step = np.timedelta64(pd.Timedelta(step).value, 'ns')
+    starts = pd.DatetimeIndex(data.index).values - step
+    periods = starts.astype('datetime64[%s]' % unit)
+    first, last = periods.min(), periods.max()
+    all_periods = np.arange(first, last + 1)
+    keys = (periods - first).astype(np.int64)
+    position = ((starts - periods.astype('datetime64[ns]')) // step).astype(
+        np.int64)
+    lengths = (((all_periods + 1).astype('datetime64[ns]') -
+        all_periods.astype('datetime64[ns]')) // step).astype(np.int64)
+
+    values = np.asarray(data.values, dtype = np.float64)
+    num_series, num_periods = values.shape[1], len(all_periods)
+    matrix = np.full((num_series * num_periods, lengths.max()), np.nan)
+    for column in range(num_series):
+        valid = ~np.isnan(values[:, column])
+        matrix[column * num_periods + keys[valid], position[valid]] = \
+            values[valid, column]
+
+    index = pd.MultiIndex.from_product([list(data.columns),
+        [str(p) for p in all_periods]], names = ['Series', 'Period'])
+    return matrix, np.tile(lengths, num_series), index
+
+def period_statistics(data, period = 'year', statistic = 'mean',
+    block_length = 24, num_bootstrap = 1000, confidence = 0.95, seed = 0):
+    """
+        The mean (or a percentile) of each period of one or more series,
+        with block bootstrap confidence intervals.
+        Function IN:
+            data (REQUIRED, PANDAS SERIES or DATAFRAME):
+                Hourly values with a datetime index (a column per series).
+            period (OPTIONAL, STRING):
+                'day', 'month' or 'year' (or D, M, A). Default = 'year'
+            statistic, block_length, num_bootstrap, confidence, seed
+            (OPTIONAL):
+                As for block_bootstrap.
+        Function OUT:
+            table:
+                pandas DataFrame indexed by series and period with columns
+                Value, Lower, Upper and Count (hours with data).
+    """
+    matrix, lengths, index = period_matrix(data, period)
+    estimate, lower, upper = block_bootstrap(matrix, statistic, lengths,
+        block_length, num_bootstrap, confidence, seed)
+    return pd.DataFrame({'Value': estimate, 'Lower': lower, 'Upper': upper,
+        'Count': np.sum(~np.isnan(matrix), axis = 1)}, index = index,
+        columns = ['Value', 'Lower', 'Upper', 'Count'])
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
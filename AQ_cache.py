@@ -0,0 +1,74 @@
+#==============================================================================
+# A small thread safe least recently used cache, shared by the query service
+# (AQ_service) and the memoised functions (AQ_memo).
+# Class names:
+#   LRUCache(max_items)
+#==============================================================================
+# Uses modules:
+# threading, collections
+import threading
+from collections import OrderedDict
+#==============================================================================
+
+class LRUCache(object):
+    """
+        A thread safe dictionary that holds at most max_items. When it is full
+        the least recently used item is dropped. Keeps count of hits, misses
+        and evictions.
+    """
+    def __init__(self, max_items = 16):
+        super(LRUCache, self).__init__()
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+            Returns (True, value) if the key is in the cache, otherwise
+            (False, None).
+        """
+        with self.lock:
+            if key in self.items:
+                # Move to the end (most recently used)
+                value = self.items.pop(key)
+                self.items[key] = value
+                self.hits += 1
+                return True, value
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        """
+            Add an item, dropping the least recently used if over max_items.
+        """
+        with self.lock:
+            if key in self.items:
+                self.items.pop(key)
+            self.items[key] = value
+            while len(self.items) > self.max_items:
+                self.items.popitem(last = False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        """
+            Returns a dictionary of the cache size and hit counts.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'items': len(self.items),
+                    'max_items': self.max_items,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / float(lookups) if lookups else 0.}
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,224 @@
+#==============================================================================
+# Data capture (completeness) of the measurements. Regulatory statistics only
+# count when enough of the period has valid data, so this counts, for every
+# species at once, the hours that are verified, unverified (provisional, not
+# verified, suspect, filled...) and missing in each day, month or year, or
+# in a running window.
+# Times are hour ending (as in the DEFRA files), so the 24:00 hour counts in
+# the day it ends, not the next one.
+# Function names:
+#   status_codes(all_data, species)
+#   capture_counts(all_data, period, species)
+#   completeness_matrix(all_data, period, species, verified_only)
+#   rolling_capture(all_data, hours, species, verified_only)
+#   network_completeness(filenames, period, species)
+#==============================================================================
+# Uses modules:
+# os, numpy, pandas, source_AQ_data, AQ_grid
+import os
+import numpy as np
+import pandas as pd
+import source_AQ_data
+from AQ_grid import RegularGrid
+#==============================================================================
+
+# The codes given to each hour
+MISSING = 0
+UNVERIFIED = 1
+VERIFIED = 2
+CODE_NAMES = ['Missing', 'Unverified', 'Verified']
+
+# numpy datetime units for each period
+PERIOD_UNITS = {'day': 'D', 'month': 'M', 'year': 'Y'}
+
+def status_codes(all_data, species = None, step = '1H'):
+    """
+        Give every hour of every species a code: 0 missing, 1 unverified or
+        2 verified. Verified is a value with a V status (or any modelled
+        value that wasn't filled in, as in source_AQ_data.purge_unverified).
+        Filled in values (status F, see AQ_gapfill) weren't measured, so
+        they count as missing. The codes are put on a regular grid, so hours
+        with no row in the file count as missing.
+        Function IN:
+            all_data (REQUIRED, PANDAS DATAFRAME):
+                The data from source_AQ_data.open_csv.
+            species (OPTIONAL, LIST of STRINGS):
+                The species to use. Default is all of them.
+            step (OPTIONAL, STRING):
+                Time between measurements. Default = '1H'
+        Function OUT:
+            grid:
+                AQ_grid.RegularGrid of the codes (as floats).
+    """
+    if species is None:
+        species = source_AQ_data.list_species(all_data.columns)
+    columns = list(all_data.columns)
+
+    codes = {}
+    for name in species:
+        status = all_data[columns[columns.index(name) + 1]]
+        filled = (status.str[0] == source_AQ_data.FILLED).values
+        has_value = all_data[name].notnull().values & ~filled
+        if name.split()[0] == 'Modelled':
+            verified = np.ones(len(status), dtype = bool)
+        else:
+            verified = (status.str[0] == 'V').values
+        codes[name] = np.where(has_value,
+            np.where(verified, VERIFIED, UNVERIFIED), MISSING)
+
+    df = pd.DataFrame(codes, index = all_data['Date and Time'].values,
+        columns = species)
+    grid = RegularGrid.from_dataframe(df, step = step)
+    # Rows that weren't in the file
+    grid.values[np.isnan(grid.values)] = MISSING
+    return grid
+
+def _period_keys(grid, period):
+    """
+        Reframe the grid to cover whole periods and give each row the number
+        of its period. Returns the grid, the keys and the period labels.
+    """
+    unit = PERIOD_UNITS[period]
+    # Hour ending times, so take off a step to get the hour they start in
+    first = (grid.start - grid.step).astype('datetime64[%s]' % unit)
+    last = (grid.end - grid.step).astype('datetime64[%s]' % unit)
+    start = (first.astype('datetime64[ns]') + grid.step)
+    end = ((last + 1).astype('datetime64[ns]'))
+    length = int((end - start) // grid.step) + 1
+    grid = grid.reframe(start, length)
+
+    starts = grid.times.values - grid.step
+    periods = starts.astype('datetime64[%s]' % unit)
+    keys = (periods - first).astype(np.int64)
+    labels = [str(p) for p in np.arange(first, last + 1)]
+    return grid, keys, labels
+
+def capture_counts(all_data, period = 'year', species = None, step = '1H'):
+    """
+        Count the verified, unverified and missing hours of each species in
+        each day, month or year.
+        Function IN:
+            all_data (REQUIRED, PANDAS DATAFRAME):
+                The data from source_AQ_data.open_csv.
+            period (OPTIONAL, STRING):
+                'day', 'month' or 'year'. Default = 'year'
+            species (OPTIONAL, LIST of STRINGS):
+                The species to use. Default is all of them.
+            step (OPTIONAL, STRING):
+                Time between measurements. Default = '1H'
+        Function OUT:
+            counts:
+                pandas DataFrame indexed by species and period, with columns
+                Expected (hours in the period), Verified, Unverified, Missing,
+                Capture (% verified) and Valid (% verified or unverified).
+    """
+    grid, keys, labels = _period_keys(status_codes(all_data, species, step),
+        period)
+    num_periods = len(labels)
+    num_species = grid.values.shape[1]
+
+    # One bincount for everything: a bin for each species, period and code
+    codes = grid.values.astype(np.int64)
+    species_index = np.arange(num_species)[np.newaxis, :]
+    bins = ((species_index * num_periods + keys[:, np.newaxis]) * 3 + codes)
+    counted = np.bincount(bins.ravel(), minlength = num_species *
+        num_periods * 3).reshape(num_species * num_periods, 3)
+
+    expected = np.tile(np.bincount(keys, minlength = num_periods), num_species)
+    index = pd.MultiIndex.from_product([grid.names, labels],
+        names = ['Species', 'Period'])
+    counts = pd.DataFrame(counted[:, ::-1], index = index,
+        columns = CODE_NAMES[::-1])
+    counts.insert(0, 'Expected', expected)
+    counts['Capture'] = 100. * counts['Verified'] / counts['Expected']
+    counts['Valid'] = 100. * (counts['Verified'] + counts['Unverified']) / \
+        counts['Expected']
+
+    return counts
+
+def completeness_matrix(all_data, period = 'year', species = None,
+    verified_only = True, step = '1H'):
+    """
+        The percentage data capture as a species x period table.
+        Function IN:
+            all_data (REQUIRED, PANDAS DATAFRAME):
+                The data from source_AQ_data.open_csv.
+            period (OPTIONAL, STRING):
+                'day', 'month' or 'year'. Default = 'year'
+            species (OPTIONAL, LIST of STRINGS):
+                The species to use. Default is all of them.
+            verified_only (OPTIONAL, BOOLEAN):
+                Count just verified data (True, default) or any valid data.
+        Function OUT:
+            matrix:
+                pandas DataFrame of percentages, a row per species and a
+                column per period.
+    """
+    counts = capture_counts(all_data, period, species, step)
+    column = 'Capture' if verified_only else 'Valid'
+    return counts[column].unstack('Period')
+
+def rolling_capture(all_data, hours = 24, species = None, verified_only = False,
+    step = '1H'):
+    """
+        The percentage of the last N hours with data, for every hour and
+        species (eg. hours = 8 and 75% is the rule for running 8 hour means).
+        Function IN:
+            all_data (REQUIRED, PANDAS DATAFRAME):
+                The data from source_AQ_data.open_csv.
+            hours (OPTIONAL, INTEGER):
+                Length of the window in hours (rows). Default = 24
+            species (OPTIONAL, LIST of STRINGS):
+                The species to use. Default is all of them.
+            verified_only (OPTIONAL, BOOLEAN):
+                Count just verified data (True) or any valid data (False,
+                default).
+        Function OUT:
+            capture:
+                pandas DataFrame of percentages, time x species.
+    """
+    grid = status_codes(all_data, species, step)
+    threshold = VERIFIED if verified_only else UNVERIFIED
+    good = (grid.values >= threshold).astype(np.int64)
+
+    # Window sums from cumulative sums. The first hours have a short window
+    # but are still divided by the full window length.
+    totals = np.concatenate((np.zeros((1, good.shape[1]), dtype = np.int64),
+        np.cumsum(good, axis = 0)))
+    upper = np.arange(1, len(good) + 1)
+    lower = np.maximum(upper - hours, 0)
+    capture = 100. * (totals[upper] - totals[lower]) / float(hours)
+
+    return pd.DataFrame(capture, index = grid.times, columns = grid.names)
+
+def network_completeness(filenames, period = 'year', species = None,
+    verified_only = True):
+    """
+        The completeness matrix for a number of sites (files) together.
+        Function IN:
+            filenames (REQUIRED, LIST of STRINGS):
+                The csv files. The site name is the file name without the
+                directory or extension.
+            period, species, verified_only (OPTIONAL):
+                As for completeness_matrix. Species not in a file are left
+                out for that site.
+        Function OUT:
+            matrix:
+                pandas DataFrame of percentages, a row per site and species
+                and a column per period.
+    """
+    matrices = {}
+    for filename in filenames:
+        all_data = source_AQ_data.open_csv(filename)
+        site_species = source_AQ_data.list_species(all_data.columns)
+        if species is not None:
+            site_species = [s for s in species if s in site_species]
+        site = os.path.splitext(os.path.basename(filename))[0]
+        matrices[site] = completeness_matrix(all_data, period, site_species,
+            verified_only)
+    matrix = pd.concat(matrices, names = ['Site'], sort = False)
+    return matrix.reindex(columns = sorted(matrix.columns))
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
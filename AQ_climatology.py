@@ -0,0 +1,214 @@
+#==============================================================================
+# Climatology profiles (the average day, week and year) for many species at
+# once. The time fields (hour, weekday, month) are worked out once and each
+# profile is made from integer group numbers with grouped sums and one sort,
+# rather than masking the data once per hour or month. Times are hour ending
+# (as in the DEFRA files), so each is moved back one step first: the hour
+# ending 01:00 is hour 0 and the 24:00 hour counts in the day (and month) it
+# ends. Daily (or longer) values are stamped with the start of their day, so
+# they aren't moved.
+# Profiles:
+#   hour - hour of the day (0-23)
+#   weekday - day of the week (0 = Monday)
+#   month - month of the year (1-12)
+#   hour_weekday - hour of the day for each day of the week
+#   month_hour - hour of the day for each month
+# Function names:
+#   climatology(data, profiles, quantiles, confidence, step)
+#   grouped_values(series, profile, step)
+#   group_keys(index, profile, fields, step)
+#==============================================================================
+# Uses modules:
+# numpy, pandas, quick_tools
+import numpy as np
+import pandas as pd
+import quick_tools
+#==============================================================================
+
+PROFILES = ['hour', 'weekday', 'month', 'hour_weekday', 'month_hour']
+
+def group_keys(index, profile, fields = None, step = '1H'):
+    """
+        The group number of every time for a profile, and the labels of the
+        groups.
+        Function IN:
+            index (REQUIRED, PANDAS DatetimeIndex):
+                The times (hour ending).
+            profile (REQUIRED, STRING):
+                One of PROFILES.
+            fields (OPTIONAL, DICTIONARY):
+                Already worked out hour, weekday and month arrays (saves
+                doing it again for each profile).
+            step (OPTIONAL, STRING):
+                Time between measurements, taken off each time before the
+                fields are worked out if it is less than a day. None for
+                times that are the start of the hour. Default = '1H'
+        Function OUT:
+            keys:
+                Integer array of group numbers (0 to number of groups - 1).
+            labels:
+                pandas Index (or MultiIndex) of the groups.
+    """
+    if fields is None:
+        fields = _time_fields(index, step)
+    hour, weekday, month = fields['hour'], fields['weekday'], fields['month']
+    hours = np.arange(24)
+
+    if profile == 'hour':
+        return hour, pd.Index(hours, name = 'Hour')
+    elif profile == 'weekday':
+        return weekday, pd.Index(np.arange(7), name = 'Weekday')
+    elif profile == 'month':
+        return month - 1, pd.Index(np.arange(1, 13), name = 'Month')
+    elif profile == 'hour_weekday':
+        return weekday * 24 + hour, pd.MultiIndex.from_product(
+            [np.arange(7), hours], names = ['Weekday', 'Hour'])
+    elif profile == 'month_hour':
+        return (month - 1) * 24 + hour, pd.MultiIndex.from_product(
+            [np.arange(1, 13), hours], names = ['Month', 'Hour'])
+    else:
+        raise ValueError('Unknown profile %s. Choose from %s' % (profile,
+            PROFILES))
+
+def _time_fields(index, step = '1H'):
+    """
+        Hour, weekday and month of each time as integer arrays, with the
+        times moved back one step if it is less than a day (so they are the
+        start of the hour).
+    """
+    index = pd.DatetimeIndex(index)
+    if step is not None and pd.Timedelta(step) < pd.Timedelta(1, 'D'):
+        index = index - pd.Timedelta(step)
+    return {'hour': np.asarray(index.hour, dtype = np.int64),
+            'weekday': np.asarray(index.dayofweek, dtype = np.int64),
+            'month': np.asarray(index.month, dtype = np.int64)}
+
+def _grouped_stats(values, keys, num_groups, quantiles, z):
+    """
+        Statistics of one series for each group. Returns a dictionary of
+        arrays (one value per group).
+    """
+    valid = ~np.isnan(values)
+    values = values[valid]
+    keys = keys[valid]
+
+    # Counts, means and standard deviations from grouped sums
+    count = np.bincount(keys, minlength = num_groups)
+    total = np.bincount(keys, weights = values, minlength = num_groups)
+    squares = np.bincount(keys, weights = values ** 2, minlength = num_groups)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = total / count
+        variance = (squares - count * mean ** 2) / (count - 1)
+        std = np.sqrt(np.maximum(variance, 0.))
+        half_width = z * std / np.sqrt(count)
+    stats = {'count': count, 'mean': mean, 'std': std,
+             'ci_lower': mean - half_width, 'ci_upper': mean + half_width}
+
+    # Quantiles from one sort by group then value. Each group is then a
+    # sorted block starting at the sum of the counts before it.
+    ordered = values[np.lexsort((values, keys))]
+    starts = np.cumsum(count) - count
+    has_data = count > 0
+    for q in quantiles:
+        position = starts + q * np.maximum(count - 1, 0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, starts + count - 1)
+        fraction = position - lower
+        result = np.full(num_groups, np.nan)
+        if len(ordered):
+            low = ordered[np.clip(lower, 0, len(ordered) - 1)]
+            high = ordered[np.clip(upper, 0, len(ordered) - 1)]
+            result[has_data] = (low + fraction * (high - low))[has_data]
+        stats[_quantile_name(q)] = result
+
+    return stats
+
+def _quantile_name(q):
+    if q == 0.5:
+        return 'median'
+    return 'q%g' % (100 * q)
+
+def climatology(data, profiles = PROFILES, quantiles = (0.05, 0.25, 0.5,
+    0.75, 0.95), confidence = 0.95, step = '1H'):
+    """
+        Work out the climatology profiles of one or more species.
+        Function IN:
+            data (REQUIRED, PANDAS DATAFRAME or SERIES):
+                The concentrations with a datetime index, a column per species
+                (eg. AQ_grid.RegularGrid.to_dataframe()). Columns that aren't
+                numbers are left out.
+            profiles (OPTIONAL, LIST of STRINGS):
+                Which profiles to make. Default is all of PROFILES.
+            quantiles (OPTIONAL, LIST of FLOATS):
+                Quantiles to give for each group. 0.5 is called 'median', the
+                rest 'q5', 'q25' etc. Default = 0.05, 0.25, 0.5, 0.75, 0.95
+            confidence (OPTIONAL, FLOAT):
+                Confidence level of the interval around the mean (normal
+                approximation). Default = 0.95
+            step (OPTIONAL, STRING):
+                Time between measurements (see group_keys). Default = '1H'
+        Function OUT:
+            profile_dict:
+                Dictionary of profile name and pandas DataFrame. Each has a row
+                per group and columns of (species, statistic), where the
+                statistics are count, mean, std, ci_lower, ci_upper and the
+                quantiles.
+    """
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    data = data.select_dtypes(include = [np.number])
+    values = np.asarray(data.values, dtype = np.float64)
+    z = quick_tools.normal_quantile(0.5 + confidence / 2.)
+    fields = _time_fields(data.index, step)
+    stat_names = ['count', 'mean', 'std', 'ci_lower', 'ci_upper'] + \
+        [_quantile_name(q) for q in quantiles]
+
+    profile_dict = {}
+    for profile in profiles:
+        keys, labels = group_keys(data.index, profile, fields)
+        columns = {}
+        for n, species in enumerate(data.columns):
+            stats = _grouped_stats(values[:, n], keys, len(labels), quantiles,
+                z)
+            for stat in stat_names:
+                columns[(species, stat)] = stats[stat]
+        profile_df = pd.DataFrame(columns, index = labels)
+        profile_df = profile_df[[(s, stat) for s in data.columns
+            for stat in stat_names]]
+        profile_df.columns = pd.MultiIndex.from_tuples(profile_df.columns,
+            names = ['Species', 'Statistic'])
+        profile_dict[profile] = profile_df
+
+    return profile_dict
+
+def grouped_values(series, profile, step = '1H'):
+    """
+        Split a series into its groups for a profile (eg. for box plots),
+        with one sort rather than a mask per group. NaNs are left out.
+        Function IN:
+            series (REQUIRED, PANDAS SERIES):
+                The concentrations with a datetime index.
+            profile (REQUIRED, STRING):
+                One of PROFILES.
+            step (OPTIONAL, STRING):
+                Time between measurements (see group_keys). Default = '1H'
+        Function OUT:
+            labels:
+                pandas Index of the groups.
+            groups:
+                List of numpy arrays, the values in each group.
+    """
+    values = np.asarray(series.values, dtype = np.float64)
+    keys, labels = group_keys(series.index, profile, step = step)
+    valid = ~np.isnan(values)
+    values = values[valid]
+    keys = keys[valid]
+
+    order = np.argsort(keys, kind = 'mergesort')
+    counts = np.bincount(keys, minlength = len(labels))
+    groups = np.split(values[order], np.cumsum(counts)[:-1])
+    return labels, groups
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,225 @@
+#==============================================================================
+# Correlation of the same species across many sites (eg. regional versus
+# local sources, or checking one sensor against its neighbours). All the sites
+# are put on one hourly grid (AQ_grid) and the whole correlation matrix comes
+# from a few matrix products of the data and its missing data mask, so every
+# pair uses just the hours both sites have data (pairwise complete) with no
+# loop over pairs.
+# Function names:
+#   site_grid(filenames, species, step, verified)
+#   pairwise_correlation(data, min_periods)
+#   correlation_matrix(data, min_periods)
+#   lagged_correlation(data, lags, min_periods)
+#   best_lags(data, lags, min_periods)
+#==============================================================================
+# Uses modules:
+# os, numpy, pandas, source_AQ_data, AQ_grid, AQ_profiling
+import os
+import numpy as np
+import pandas as pd
+import source_AQ_data
+import AQ_profiling
+from AQ_grid import RegularGrid
+#==============================================================================
+
+def site_grid(filenames, species, step = '1H', verified = True):
+    """
+        Read one species from a number of sites (files) onto a common grid,
+        with a column for each site.
+        Function IN:
+            filenames (REQUIRED, LIST of STRINGS):
+                The csv files. The site name is the file name without the
+                directory or extension. Files without the species are left
+                out.
+            species (REQUIRED, STRING):
+                The species (eg 'Nitrogen dioxide').
+            step (OPTIONAL, STRING):
+                Time between measurements. Default = '1H'
+            verified (OPTIONAL, BOOLEAN):
+                Use just the verified data (True, default) or all of it.
+        Function OUT:
+            grid:
+                AQ_grid.RegularGrid with a column per site.
+    """
+    grids = []
+    sites = []
+    for filename in filenames:
+        all_data = source_AQ_data.open_csv(filename)
+        if species not in all_data.columns:
+            continue
+        species_data = source_AQ_data.split_one_variable(all_data, species)
+        if verified:
+            species_data = source_AQ_data.purge_unverified(species_data,
+                species)
+        grids.append(RegularGrid.from_series(species_data[species],
+            step = step))
+        sites.append(os.path.splitext(os.path.basename(filename))[0])
+    if not grids:
+        raise ValueError('None of the files have %s' % species)
+    return RegularGrid.combine(grids, names = sites)
+
+def _as_matrix(data):
+    """
+        The values (time x series) and names of a RegularGrid, DataFrame or
+        2D array.
+    """
+    if isinstance(data, RegularGrid):
+        return data.values, data.names
+    if isinstance(data, np.ndarray):
+        values = np.asarray(data, dtype = np.float64).reshape(len(data), -1)
+        return values, list(range(values.shape[1]))
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    return np.asarray(data.values, dtype = np.float64), list(data.columns)
+
+def _correlate(a, b, min_periods = 2):
+    """
+        Correlation of every column of a with every column of b (same number
+        of rows), using the rows where both have data. Returns the
+        correlations and the number of rows used, both columns of a x columns
+        of b.
+    """
+    same = a is b
+    # Taking off the means first doesn't change the correlations but stops
+    # the sums getting large and losing precision
+    with np.errstate(invalid = 'ignore'):
+        a = a - np.nan_to_num(np.nanmean(a, axis = 0))
+    a_mask = (~np.isnan(a)).astype(np.float64)
+    a = np.where(a_mask > 0, a, 0.)
+    if same:
+        b, b_mask = a, a_mask
+    else:
+        with np.errstate(invalid = 'ignore'):
+            b = b - np.nan_to_num(np.nanmean(b, axis = 0))
+        b_mask = (~np.isnan(b)).astype(np.float64)
+        b = np.where(b_mask > 0, b, 0.)
+
+    # Sums over the rows where both have data. With a series against itself
+    # the b sums are the a sums transposed.
+    count = a_mask.T.dot(b_mask)
+    sum_a = a.T.dot(b_mask)
+    sum_aa = (a ** 2).T.dot(b_mask)
+    if same:
+        sum_b, sum_bb = sum_a.T, sum_aa.T
+    else:
+        sum_b = a_mask.T.dot(b)
+        sum_bb = a_mask.T.dot(b ** 2)
+    sum_ab = a.T.dot(b)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        covariance = count * sum_ab - sum_a * sum_b
+        variance_a = count * sum_aa - sum_a ** 2
+        variance_b = count * sum_bb - sum_b ** 2
+        correlation = covariance / np.sqrt(variance_a * variance_b)
+    correlation[count < max(min_periods, 2)] = np.nan
+    return np.clip(correlation, -1., 1.), count.astype(np.int64)
+
+def pairwise_correlation(data, min_periods = 2):
+    """
+        The Pearson correlation of every pair of series, using the times when
+        both have data.
+        Function IN:
+            data (REQUIRED, AQ_grid.RegularGrid, PANDAS DATAFRAME or ARRAY):
+                The series as columns on a common time axis (eg. from
+                site_grid).
+            min_periods (OPTIONAL, INTEGER):
+                Fewest times in common for a correlation to be given (NaN if
+                fewer). Default = 2
+        Function OUT:
+            correlation:
+                2D array, series x series.
+            count:
+                2D array of the number of times used for each pair.
+    """
+    values, names = _as_matrix(data)
+    with AQ_profiling.stage('pairwise_correlation', values.size):
+        return _correlate(values, values, min_periods)
+
+def correlation_matrix(data, min_periods = 2):
+    """
+        As pairwise_correlation, but as pandas DataFrames labelled with the
+        series names.
+        Function OUT:
+            correlation:
+                pandas DataFrame, series x series.
+            count:
+                pandas DataFrame of the number of times used for each pair.
+    """
+    values, names = _as_matrix(data)
+    correlation, count = pairwise_correlation(values, min_periods)
+    return (pd.DataFrame(correlation, index = names, columns = names),
+            pd.DataFrame(count, index = names, columns = names))
+
+def lagged_correlation(data, lags = range(-24, 25), min_periods = 2):
+    """
+        Cross correlation of every pair of series at a number of lags. The
+        value for lag L and pair (i, j) is the correlation of series i at
+        time t with series j at time t + L (in rows, eg hours). A peak at a
+        positive lag means j follows i.
+        Function IN:
+            data (REQUIRED, AQ_grid.RegularGrid, PANDAS DATAFRAME or ARRAY):
+                The series as columns on a common, regular time axis.
+            lags (OPTIONAL, LIST of INTEGERS):
+                The lags in rows. Default = -24 to 24
+            min_periods (OPTIONAL, INTEGER):
+                As for pairwise_correlation.
+        Function OUT:
+            correlation:
+                3D array, lag x series x series.
+            count:
+                3D array of the number of times used.
+    """
+    values, names = _as_matrix(data)
+    lags = list(lags)
+    num_rows, num_series = values.shape
+    correlation = np.full((len(lags), num_series, num_series), np.nan)
+    count = np.zeros((len(lags), num_series, num_series), dtype = np.int64)
+    with AQ_profiling.stage('lagged_correlation', values.size * len(lags)):
+        for n, lag in enumerate(lags):
+            if abs(lag) >= num_rows:
+                continue
+            if lag >= 0:
+                leading, following = values[:num_rows - lag], values[lag:]
+            else:
+                leading, following = values[-lag:], values[:num_rows + lag]
+            correlation[n], count[n] = _correlate(leading, following,
+                min_periods)
+    return correlation, count
+
+def best_lags(data, lags = range(-24, 25), min_periods = 2):
+    """
+        The lag with the highest correlation for every pair of series.
+        Function IN:
+            data, lags, min_periods:
+                As for lagged_correlation.
+        Function OUT:
+            table:
+                pandas DataFrame indexed by the pair of series, with columns
+                Lag, Correlation (at that lag), Count and Zero lag (the
+                correlation with no lag, if 0 is one of the lags).
+    """
+    values, names = _as_matrix(data)
+    lags = list(lags)
+    correlation, count = lagged_correlation(values, lags, min_periods)
+    num_series = len(names)
+
+    # nanargmax fails on all NaN pairs, so put those to -inf first
+    filled = np.where(np.isnan(correlation), -np.inf, correlation)
+    best = filled.argmax(axis = 0)
+    rows, columns = np.indices((num_series, num_series))
+    best_correlation = correlation[best, rows, columns]
+    table = pd.DataFrame({'Lag': np.asarray(lags)[best].ravel(),
+        'Correlation': best_correlation.ravel(),
+        'Count': count[best, rows, columns].ravel()},
+        index = pd.MultiIndex.from_product([names, names],
+            names = ['Series', 'Other series']),
+        columns = ['Lag', 'Correlation', 'Count'])
+    if 0 in lags:
+        table['Zero lag'] = correlation[lags.index(0)].ravel()
+    # Pairs with no correlation at any lag
+    table.loc[np.isnan(best_correlation.ravel()), 'Lag'] = np.nan
+    return table
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,272 @@
+#==============================================================================
+# The UK Daily Air Quality Index (DAQI) for every hour of every site (see
+# https://uk-air.defra.gov.uk/air-pollution/daqi). Each pollutant is averaged
+# the DAQI way (running 8 hour mean of ozone, running 24 hour mean of
+# particles, hourly NO2 and SO2), put into a band (1-10) by looking the value
+# up in the band limits with searchsorted, and the index of a site is the
+# highest band of its pollutants. All the sites are done together on one
+# grid (AQ_grid), and DAQI.update takes just the new hours, keeping the last
+# day to carry on the running means.
+# Class/Function names:
+#   DAQI(min_capture)
+#   DAQI.update(grid)
+#   daqi_pollutant(species)
+#   bands(values, pollutant)
+#   band_names(index)
+#   daqi_grid(site_data, verified)
+#   network_daqi(filenames, verified)
+#==============================================================================
+# Uses modules:
+# os, numpy, pandas, source_AQ_data, AQ_averages, AQ_grid, AQ_profiling
+import os
+import numpy as np
+import pandas as pd
+import source_AQ_data
+import AQ_averages
+import AQ_profiling
+from AQ_grid import RegularGrid
+#==============================================================================
+
+# Hours in the running mean and the top of bands 1 to 9 (ugm-3). Anything
+# above the last is band 10. SO2 should be a 15 minute mean, but the DEFRA
+# hourly files only have hourly means so those are used.
+DAQI_BANDS = {
+    'O3': (8, [33, 66, 100, 120, 140, 160, 187, 213, 240]),
+    'NO2': (1, [67, 134, 200, 267, 334, 400, 467, 534, 600]),
+    'SO2': (1, [88, 177, 266, 354, 443, 532, 710, 887, 1064]),
+    'PM2.5': (24, [11, 23, 35, 41, 47, 53, 58, 64, 70]),
+    'PM10': (24, [16, 33, 50, 58, 66, 75, 83, 91, 100])}
+POLLUTANTS = ['O3', 'NO2', 'SO2', 'PM2.5', 'PM10']
+
+# Start of the DEFRA species names for each pollutant
+DEFRA_NAMES = [('Ozone', 'O3'), ('Nitrogen dioxide', 'NO2'),
+    ('Sulphur dioxide', 'SO2'), ('PM2.5 particulate matter', 'PM2.5'),
+    ('PM10 particulate matter', 'PM10')]
+
+# Band names of index 0 (no data) to 10
+BAND_NAMES = np.array(['No data'] + ['Low'] * 3 + ['Moderate'] * 3 +
+    ['High'] * 3 + ['Very High'])
+
+def daqi_pollutant(species):
+    """
+        The DAQI pollutant (eg 'O3') of a DEFRA species name (eg 'Ozone'), or
+        None if it isn't one of them. DAQI names are returned as they are.
+    """
+    if species in DAQI_BANDS:
+        return species
+    for start, pollutant in DEFRA_NAMES:
+        if species.startswith(start):
+            return pollutant
+    return None
+
+def bands(values, pollutant):
+    """
+        The DAQI band (1-10) of concentrations that have already been
+        averaged the DAQI way. Values are rounded to whole numbers first, as
+        the band limits are.
+        Function IN:
+            values (REQUIRED, FLOAT or ARRAY):
+                Concentrations (ugm-3), any shape. NaN is missing.
+            pollutant (REQUIRED, STRING):
+                One of POLLUTANTS.
+        Function OUT:
+            index:
+                Integer array of the bands, 0 where the value is missing.
+    """
+    values = np.asarray(values, dtype = np.float64)
+    upper_limits = np.asarray(DAQI_BANDS[pollutant][1], dtype = np.float64)
+    # np.round rounds halves to even, DAQI rounds them up
+    rounded = np.floor(values + 0.5)
+    index = np.searchsorted(upper_limits, rounded, side = 'left') + 1
+    return np.where(np.isnan(values), 0, index)
+
+def band_names(index):
+    """
+        The band names (Low, Moderate, High, Very High) of DAQI indexes (an
+        array of 0-10, with 0 called 'No data').
+    """
+    return BAND_NAMES[np.asarray(index, dtype = np.int64)]
+
+def daqi_grid(site_data, verified = False, step = '1H'):
+    """
+        Put the DAQI pollutants of a number of sites on one grid.
+        Function IN:
+            site_data (REQUIRED, DICTIONARY):
+                Site name and pandas DataFrame from source_AQ_data.open_csv.
+            verified (OPTIONAL, BOOLEAN):
+                Use just the verified data (True) or all of it (False,
+                default - the index is usually wanted before the data is
+                verified).
+            step (OPTIONAL, STRING):
+                Time between measurements. Default = '1H'
+        Function OUT:
+            grid:
+                AQ_grid.RegularGrid with a column for each site and pollutant,
+                named (site, pollutant).
+    """
+    grids = []
+    names = []
+    for site in sorted(site_data.keys()):
+        all_data = site_data[site]
+        for species in source_AQ_data.list_species(all_data.columns):
+            pollutant = daqi_pollutant(species)
+            if pollutant is None:
+                continue
+            species_data = source_AQ_data.split_one_variable(all_data,
+                species)
+            if verified:
+                species_data = source_AQ_data.purge_unverified(species_data,
+                    species)
+            grids.append(RegularGrid.from_series(species_data[species],
+                step = step))
+            names.append((site, pollutant))
+    if not grids:
+        raise ValueError('None of the sites have a DAQI pollutant')
+    return RegularGrid.combine(grids, names = names)
+
+class DAQI(object):
+    """
+        Works out the DAQI of many sites, an hour at a time or a batch of
+        hours at a time. Give update a grid (eg from daqi_grid) of the new
+        hours; it keeps the last day of data so the running means of the new
+        hours are right, and gives back just the new hours.
+        Instance variables:
+            min_capture - fraction of a running mean's hours that need data
+            history - RegularGrid of the last hours seen (or None)
+    """
+    def __init__(self, min_capture = 0.75):
+        super(DAQI, self).__init__()
+        self.min_capture = min_capture
+        self.history = None
+
+    @property
+    def keep_hours(self):
+        """
+            Hours of data needed before a new hour (the longest running mean
+            less one).
+        """
+        return max(hours for hours, limits in DAQI_BANDS.values()) - 1
+
+    def _join(self, grid):
+        """
+            The history with the new grid added (new values replace old ones
+            at the same time), and the row of the first new hour.
+        """
+        if self.history is None or len(self.history) == 0:
+            return grid, 0
+        if grid.step != self.history.step:
+            raise ValueError('New data must have the same step')
+        names = list(self.history.names)
+        units = list(self.history.units)
+        # Column of each new series in the history. A site can have more
+        # than one column of a pollutant, so they are matched in order.
+        columns = []
+        for name, unit in zip(grid.names, grid.units):
+            matches = [n for n, old in enumerate(names)
+                if old == name and n not in columns]
+            if matches:
+                columns.append(matches[0])
+            else:
+                names.append(name)
+                units.append(unit)
+                columns.append(len(names) - 1)
+        start = min(self.history.start, grid.start)
+        end = max(self.history.end, grid.end)
+        length = int((end - start) // grid.step) + 1
+
+        values = np.full((length, len(names)), np.nan)
+        old = self.history.reframe(start, length)
+        values[:, :len(self.history.names)] = old.values
+        new = grid.reframe(start, length)
+        has_value = ~np.isnan(new.values)
+        values[:, columns] = np.where(has_value, new.values,
+            values[:, columns])
+        joined = RegularGrid(start, grid.step, values, names, units)
+        return joined, int((grid.start - start) // grid.step)
+
+    def update(self, grid):
+        """
+            Add new hours and work out their DAQI.
+            Function IN:
+                grid (REQUIRED, AQ_grid.RegularGrid):
+                    The new hours, a column per site and pollutant named
+                    (site, pollutant), eg from daqi_grid.
+            Function OUT:
+                index:
+                    pandas DataFrame of the new hours with columns of (site,
+                    pollutant) holding the band of each pollutant and (site,
+                    'DAQI') the index of the site. 0 means no data.
+        """
+        joined, first_new = self._join(grid)
+        values = joined.values
+        sites = sorted(set(site for site, pollutant in joined.names))
+        site_number = dict((site, n) for n, site in enumerate(sites))
+
+        num_rows = len(joined) - first_new
+        pollutant_bands = {}
+        overall = np.zeros((num_rows, len(sites)), dtype = np.int64)
+        with AQ_profiling.stage('DAQI.update', values.size):
+            for pollutant in POLLUTANTS:
+                columns = [n for n, name in enumerate(joined.names)
+                    if name[1] == pollutant]
+                if not columns:
+                    continue
+                hours = DAQI_BANDS[pollutant][0]
+                min_periods = int(np.ceil(self.min_capture * hours))
+                # Only the rows that the new hours' means need
+                first = max(first_new - hours + 1, 0)
+                means = AQ_averages.rolling_mean(values[first:, columns],
+                    hours, min_periods = min_periods)[first_new - first:]
+                index = bands(means, pollutant)
+                site_columns = [site_number[joined.names[c][0]]
+                    for c in columns]
+                # maximum.at so a site with two columns of a pollutant gets
+                # the higher band of them
+                np.maximum.at(overall.T, site_columns, index.T)
+                for n, c in enumerate(columns):
+                    name = joined.names[c]
+                    if name in pollutant_bands:
+                        pollutant_bands[name] = np.maximum(
+                            pollutant_bands[name], index[:, n])
+                    else:
+                        pollutant_bands[name] = index[:, n]
+
+        for n, site in enumerate(sites):
+            pollutant_bands[(site, 'DAQI')] = overall[:, n]
+        columns = [(site, pollutant) for site in sites
+            for pollutant in POLLUTANTS + ['DAQI']
+            if (site, pollutant) in pollutant_bands]
+        result = pd.DataFrame(pollutant_bands,
+            index = joined.times[first_new:], columns = columns)
+        result.columns = pd.MultiIndex.from_tuples(columns,
+            names = ['Site', 'Pollutant'])
+
+        # Keep the end for next time
+        keep = min(self.keep_hours, len(joined))
+        self.history = RegularGrid(joined.time_at(len(joined) - keep),
+            joined.step, values[len(joined) - keep:], joined.names,
+            joined.units)
+        return result
+
+def network_daqi(filenames, verified = False):
+    """
+        The hourly DAQI of a number of sites (files).
+        Function IN:
+            filenames (REQUIRED, LIST of STRINGS):
+                The csv files. The site name is the file name without the
+                directory or extension.
+            verified (OPTIONAL, BOOLEAN):
+                As for daqi_grid. Default = False
+        Function OUT:
+            index:
+                pandas DataFrame as from DAQI.update, for every hour.
+    """
+    site_data = {}
+    for filename in filenames:
+        site = os.path.splitext(os.path.basename(filename))[0]
+        site_data[site] = source_AQ_data.open_csv(filename)
+    return DAQI().update(daqi_grid(site_data, verified))
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
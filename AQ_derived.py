@@ -0,0 +1,428 @@
+#==============================================================================
+# Derived variables: new series worked out from the species in a file (eg NOx
+# less NO, the PM2.5/PM10 ratio, ppb from ugm-3, the u and v wind
+# components). A derived variable is a formula written in terms of species
+# names, eg:
+#       AQ_derived.define('PM ratio', 'pm25 / pm10', unit = 'ratio',
+#           pm25 = 'PM2.5 particulate matter (Hourly measured)',
+#           pm10 = 'PM10 particulate matter (Hourly measured)')
+# The formula is kept as an expression (nothing is worked out when it is
+# defined) and is only evaluated when asked for, in one pass over the float
+# arrays of the species it needs, reusing the arrays of the intermediate
+# results rather than making a DataFrame for each step. Results are cached
+# for each loaded DataFrame (so don't change one in place after using it) and
+# dropped when a variable they use is redefined.
+# Derived names can be used like species names in
+# source_AQ_data.select_one_variable and split_one_variable (and so the plot
+# functions), AQ_grid.RegularGrid.from_open_csv and the AQ_service queries.
+# Each value's status is the worst of the statuses of its inputs (a value
+# worked out from a provisional one is provisional).
+# Class/Function names:
+#   Expression, Column(name), Constant(value), Operation(function, args)
+#   Derived(name, expression, unit)
+#   define(name, formula, unit, **variables)
+#   is_derived(name)
+#   definition(name)
+#   available(columns)
+#   evaluate(all_data, name)
+#   add_columns(all_data, names)
+#==============================================================================
+# Uses modules:
+# weakref, threading, numpy, pandas
+import weakref
+import threading
+import numpy as np
+import pandas as pd
+#==============================================================================
+
+# Status codes from best to worst. Unknown codes count as N.
+STATUS_ORDER = ['M', 'V', 'P', 'N', 'S', 'F']
+
+# Multiply ugm-3 by these to get ppb (20C and 1013mb, as DEFRA use)
+PPB_FACTORS = {'Nitrogen dioxide': 1. / 1.9125,
+               'Nitric oxide': 1. / 1.2473,
+               'Ozone': 1. / 1.9957,
+               'Sulphur dioxide': 1. / 2.6609}
+
+# Molecular masses, to give NO as NO2
+NO_AS_NO2 = 46.0055 / 30.0061
+
+class Expression(object):
+    """
+        A formula that hasn't been worked out yet. Arithmetic on expressions
+        (and numbers) makes new expressions.
+    """
+    def columns(self):
+        """
+            The column names the expression needs, in the order they first
+            appear.
+        """
+        raise NotImplementedError
+
+    def evaluate(self, arrays):
+        """
+            Work out the expression. arrays is a dictionary of column name
+            and float array. Returns the result and whether it is a new array
+            that can be written over (rather than one of the inputs).
+        """
+        raise NotImplementedError
+
+    def __add__(self, other):
+        return Operation(np.add, (self, other))
+
+    def __radd__(self, other):
+        return Operation(np.add, (other, self))
+
+    def __sub__(self, other):
+        return Operation(np.subtract, (self, other))
+
+    def __rsub__(self, other):
+        return Operation(np.subtract, (other, self))
+
+    def __mul__(self, other):
+        return Operation(np.multiply, (self, other))
+
+    def __rmul__(self, other):
+        return Operation(np.multiply, (other, self))
+
+    def __div__(self, other):
+        return Operation(np.true_divide, (self, other))
+
+    def __rdiv__(self, other):
+        return Operation(np.true_divide, (other, self))
+
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+
+    def __pow__(self, other):
+        return Operation(np.power, (self, other))
+
+    def __rpow__(self, other):
+        return Operation(np.power, (other, self))
+
+    def __neg__(self):
+        return Operation(np.negative, (self,))
+
+    def __abs__(self):
+        return Operation(np.absolute, (self,))
+
+class Column(Expression):
+    """
+        A species (or another derived variable) by name.
+    """
+    def __init__(self, name):
+        super(Column, self).__init__()
+        self.name = name
+
+    def __repr__(self):
+        return 'Column(%r)' % self.name
+
+    def columns(self):
+        return [self.name]
+
+    def evaluate(self, arrays):
+        return arrays[self.name], False
+
+class Constant(Expression):
+    """
+        A number.
+    """
+    def __init__(self, value):
+        super(Constant, self).__init__()
+        self.value = float(value)
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def columns(self):
+        return []
+
+    def evaluate(self, arrays):
+        return self.value, False
+
+class Operation(Expression):
+    """
+        A numpy ufunc (eg np.add, np.sqrt) of one or more expressions.
+    """
+    def __init__(self, function, args):
+        super(Operation, self).__init__()
+        self.function = function
+        self.args = [arg if isinstance(arg, Expression) else Constant(arg)
+            for arg in args]
+
+    def __repr__(self):
+        return '%s(%s)' % (self.function.__name__,
+            ', '.join(repr(arg) for arg in self.args))
+
+    def columns(self):
+        names = []
+        for arg in self.args:
+            names += [name for name in arg.columns() if name not in names]
+        return names
+
+    def evaluate(self, arrays):
+        results = [arg.evaluate(arrays) for arg in self.args]
+        values = [value for value, new in results]
+        # Write the answer over an intermediate result if there is one, so
+        # a long formula doesn't make a new array at every step
+        for value, new in results:
+            if new and isinstance(value, np.ndarray):
+                return self.function(*values, out = value), True
+        result = self.function(*values)
+        return result, isinstance(result, np.ndarray)
+
+# Functions that can be used in formulas
+FUNCTIONS = dict((name, getattr(np, name)) for name in ['sqrt', 'exp',
+    'log', 'log10', 'sin', 'cos', 'tan', 'arctan2', 'radians', 'degrees',
+    'absolute', 'minimum', 'maximum', 'fmin', 'fmax'])
+
+def _function(ufunc):
+    return lambda *args: Operation(ufunc, args)
+
+class Derived(object):
+    """
+        A named derived variable: an expression and the unit of the result
+        (None for the unit of its first input).
+    """
+    def __init__(self, name, expression, unit = None):
+        super(Derived, self).__init__()
+        self.name = name
+        self.expression = expression
+        self.unit = unit
+
+    def __repr__(self):
+        return 'Derived(%r, %r, %r)' % (self.name, self.expression, self.unit)
+
+    def inputs(self):
+        """
+            The columns the expression uses.
+        """
+        return self.expression.columns()
+
+# All the defined variables, by name
+DERIVED = {}
+
+def define(name, formula, unit = None, **variables):
+    """
+        Define a derived variable.
+        Function IN:
+            name (REQUIRED, STRING):
+                The name to use for it (like a species name).
+            formula (REQUIRED, STRING or Expression):
+                The formula, eg 'nox - no * 1.53'. It can use +, -, *, /, **,
+                numbers, the names given in variables and the functions in
+                FUNCTIONS (eg sqrt, sin, radians).
+            unit (OPTIONAL, STRING):
+                Unit of the result. Default is the unit of the first input.
+            variables (OPTIONAL, STRINGS):
+                The species (or derived variable) each name in the formula
+                stands for, eg no = 'Nitric oxide'.
+        Function OUT:
+            derived:
+                The Derived variable (also kept in DERIVED).
+    """
+    if isinstance(formula, Expression):
+        expression = formula
+    else:
+        namespace = dict((key, _function(ufunc))
+            for key, ufunc in FUNCTIONS.items())
+        namespace.update((key, Column(species))
+            for key, species in variables.items())
+        namespace['__builtins__'] = {}
+        try:
+            expression = eval(compile(formula, name, 'eval'), namespace)
+        except NameError as error:
+            raise ValueError('Unknown name in formula for %s: %s' % (name,
+                error))
+        if not isinstance(expression, Expression):
+            expression = Constant(expression)
+    derived = Derived(name, expression, unit)
+    DERIVED[name] = derived
+    _forget(name)
+    return derived
+
+def _forget(name):
+    """
+        Drop the cached results of a variable, and of every variable that
+        uses it, for every DataFrame.
+    """
+    names = set([name])
+    changed = True
+    while changed:
+        changed = False
+        for other, derived in DERIVED.items():
+            if other not in names and names.intersection(derived.inputs()):
+                names.add(other)
+                changed = True
+    with _cache_lock:
+        for reference, results in list(_cache.values()):
+            for other in names:
+                results.pop(other, None)
+
+def is_derived(name):
+    """
+        True if the name is a defined derived variable.
+    """
+    return name in DERIVED
+
+def definition(name):
+    """
+        The formula of a derived variable and of every derived variable it
+        uses, as a string (eg to tell if a remembered result is out of
+        date).
+    """
+    derived = DERIVED[name]
+    return repr(derived) + ''.join('; ' + definition(species)
+        for species in derived.inputs() if is_derived(species))
+
+def _needs(name, columns):
+    """
+        True if the derived variable can be worked out from the columns.
+    """
+    for species in DERIVED[name].inputs():
+        if species in columns:
+            continue
+        if not is_derived(species) or not _needs(species, columns):
+            return False
+    return True
+
+def available(columns):
+    """
+        The derived variables that can be worked out from a list of columns
+        (eg the columns of a DataFrame from open_csv), sorted.
+    """
+    columns = set(columns)
+    return sorted(name for name in DERIVED
+        if name not in columns and _needs(name, columns))
+
+# Cached results of each DataFrame: id -> (weak reference, {name: result})
+_cache = {}
+_cache_lock = threading.Lock()
+
+def _cached(all_data):
+    """
+        The dictionary of results for a DataFrame, dropped when the
+        DataFrame is.
+    """
+    key = id(all_data)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0]() is not all_data:
+            reference = weakref.ref(all_data, lambda ref: _cache.pop(key,
+                None))
+            entry = (reference, {})
+            _cache[key] = entry
+        return entry[1]
+
+def _status_codes(status):
+    """
+        The rank (in STATUS_ORDER) of each status in a column of strings
+        (missing counts as N). There are only a few different statuses, so
+        each is looked at once.
+    """
+    codes, statuses = pd.factorize(status)
+    ranks = np.array([STATUS_ORDER.index(code[:1])
+        if code[:1] in STATUS_ORDER else STATUS_ORDER.index('N')
+        for code in statuses] + [STATUS_ORDER.index('N')], dtype = np.int8)
+    # Missing statuses have code -1, the last rank
+    return ranks[codes]
+
+def _input(all_data, species, results):
+    """
+        Values, status ranks and unit of a species or derived variable.
+    """
+    if species in all_data.columns:
+        columns = list(all_data.columns)
+        status = all_data[columns[columns.index(species) + 1]]
+        units = status.dropna()
+        unit = units.iloc[0].split(' ', 2)[1] if len(units) else None
+        return (np.asarray(all_data[species].values, dtype = np.float64),
+            _status_codes(status), unit)
+    if species not in results:
+        results[species] = _evaluate(all_data, species, results)
+    return results[species]
+
+def _evaluate(all_data, name, results):
+    derived = DERIVED[name]
+    arrays = {}
+    ranks = np.zeros(len(all_data), dtype = np.int8)
+    unit = derived.unit
+    for species in derived.inputs():
+        if species not in all_data.columns and not is_derived(species):
+            raise KeyError('%s needs %s, which is not in the data' % (name,
+                species))
+        values, status, input_unit = _input(all_data, species, results)
+        arrays[species] = values
+        ranks = np.maximum(ranks, status)
+        if unit is None:
+            unit = input_unit
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        values = derived.expression.evaluate(arrays)[0]
+    values = np.broadcast_to(values, (len(all_data),)).astype(np.float64)
+    # Kept in the cache, so make sure nothing changes them in place
+    values.flags.writeable = False
+    ranks.flags.writeable = False
+    return values, ranks, unit
+
+def evaluate(all_data, name):
+    """
+        Work out a derived variable (or get it from the cache).
+        Function IN:
+            all_data (REQUIRED, PANDAS DATAFRAME):
+                The data from source_AQ_data.open_csv.
+            name (REQUIRED, STRING):
+                The derived variable.
+        Function OUT:
+            values:
+                pandas Series of the values (same index as all_data). A
+                copy, so it can be changed without changing the cache.
+            status:
+                pandas Series of the statuses (eg 'V ugm-3'), as in the
+                status columns of the file.
+    """
+    results = _cached(all_data)
+    values, ranks, unit = _input(all_data, name, results)
+    statuses = np.array([code + (' ' + unit if unit else '')
+        for code in STATUS_ORDER], dtype = object)
+    status = statuses[ranks]
+    return (pd.Series(values.copy(), index = all_data.index, name = name),
+        pd.Series(status, index = all_data.index, name = 'Status'))
+
+def add_columns(all_data, names):
+    """
+        A copy of the data with derived variables (and their status columns)
+        added on the end, so they can be used like the species in the file.
+        Names already in the data are left as they are.
+    """
+    names = [name for name in names if name not in all_data.columns]
+    if not names:
+        return all_data
+    columns = []
+    for name in names:
+        values, status = evaluate(all_data, name)
+        columns += [values, status.rename('Status.%s' % name)]
+    return pd.concat([all_data] + columns, axis = 1)
+
+# The standard derived variables
+PM25 = 'PM2.5 particulate matter (Hourly measured)'
+PM10 = 'PM10 particulate matter (Hourly measured)'
+for _species, _factor in PPB_FACTORS.items():
+    define('%s (ppb)' % _species, 'x * %r' % _factor, unit = 'ppb',
+        x = _species)
+define('Oxidant (ppb)', 'no2 + o3', unit = 'ppb',
+    no2 = 'Nitrogen dioxide (ppb)', o3 = 'Ozone (ppb)')
+define('NOx less NO (as nitrogen dioxide)', 'nox - no * %r' % NO_AS_NO2,
+    nox = 'Nitrogen oxides as nitrogen dioxide', no = 'Nitric oxide')
+define('PM2.5/PM10 ratio', 'pm25 / pm10', unit = 'ratio', pm25 = PM25,
+    pm10 = PM10)
+define('PM coarse', 'pm10 - pm25', pm25 = PM25, pm10 = PM10)
+# Direction is where the wind comes from, u is towards the east and v
+# towards the north
+define('Modelled Wind U', '-speed * sin(radians(direction))',
+    speed = 'Modelled Wind Speed', direction = 'Modelled Wind Direction')
+define('Modelled Wind V', '-speed * cos(radians(direction))',
+    speed = 'Modelled Wind Speed', direction = 'Modelled Wind Direction')
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,318 @@
+#==============================================================================
+# Pollution episodes: runs of consecutive hours (or days, or running means)
+# above a limit. The runs of every series are found at once by run length
+# encoding the exceedance mask (the differences of the mask mark where runs
+# start and end), runs closer than a gap tolerance are joined and short ones
+# dropped, and the peak and exposure of each episode come from cumulative
+# sums and one sort, with no loop over series or episodes.
+# The episodes are kept in an EpisodeTable, sorted by start time, which can
+# be queried quickly by time, series and length.
+# Class/Function names:
+#   run_lengths(mask)
+#   find_episodes(data, threshold, max_gap, min_duration, step)
+#   limit_episodes(timeseries, species, limit_name, max_gap, min_duration)
+#   EpisodeTable(table, step)
+#==============================================================================
+# Uses modules:
+# numpy, pandas, AQ_limits, AQ_averages, AQ_grid, AQ_profiling
+import numpy as np
+import pandas as pd
+import AQ_limits
+import AQ_averages
+import AQ_profiling
+from AQ_grid import RegularGrid
+#==============================================================================
+
+EPISODE_COLUMNS = ['Series', 'Start', 'End', 'Duration', 'Steps over',
+    'Peak', 'Peak time', 'Mean', 'Exposure', 'Excess', 'Threshold']
+
+def run_lengths(mask):
+    """
+        Run length encoding of the True runs in a boolean array.
+        Function IN:
+            mask (REQUIRED, ARRAY of BOOLEANS):
+                1D, or 2D with time down the first axis and a column per
+                series.
+        Function OUT:
+            series, starts, lengths:
+                Integer arrays with one value per run: the column it's in,
+                the row it starts on and the number of rows. Sorted by column
+                then start.
+    """
+    mask = np.asarray(mask, dtype = bool)
+    if mask.ndim == 1:
+        mask = mask[:, np.newaxis]
+    # A False either side of every series so every run has a start and end
+    padded = np.zeros((mask.shape[1], mask.shape[0] + 2), dtype = np.int8)
+    padded[:, 1:-1] = mask.T
+    changes = np.diff(padded, axis = 1)
+    series, starts = np.nonzero(changes == 1)
+    ends = np.nonzero(changes == -1)[1]
+    return series, starts, ends - starts
+
+def _join_runs(series, starts, lengths, max_gap):
+    """
+        Join runs of the same series with max_gap or fewer rows between
+        them. Returns the new series, starts and lengths.
+    """
+    if len(starts) == 0 or max_gap <= 0:
+        return series, starts, lengths
+    ends = starts + lengths
+    gaps = starts[1:] - ends[:-1]
+    new = np.concatenate(([True], (series[1:] != series[:-1]) |
+        (gaps > max_gap)))
+    first = np.nonzero(new)[0]
+    last = np.concatenate((first[1:], [len(starts)])) - 1
+    return series[first], starts[first], ends[last] - starts[first]
+
+def find_episodes(data, threshold, max_gap = 0, min_duration = 1,
+    step = '1H'):
+    """
+        Find the episodes of every series above a threshold.
+        Function IN:
+            data (REQUIRED, PANDAS SERIES, DATAFRAME or AQ_grid.RegularGrid):
+                The values with a datetime index (a column per series). They
+                are put on a regular grid first, so missing times break a run
+                (unless within max_gap).
+            threshold (REQUIRED, FLOAT, LIST or DICTIONARY):
+                Values above this are exceedances. A list (one per column) or
+                dictionary of column name and threshold can be given.
+            max_gap (OPTIONAL, INTEGER):
+                Runs separated by this many steps or fewer (below the threshold
+                or missing) are joined into one episode. Default = 0
+            min_duration (OPTIONAL, INTEGER):
+                Episodes shorter than this many steps (including joined gaps)
+                are dropped. Default = 1
+            step (OPTIONAL, STRING):
+                Time between values. Default = '1H'
+        Function OUT:
+            episodes:
+                EpisodeTable.
+    """
+    if isinstance(data, RegularGrid):
+        grid = data
+    else:
+        grid = RegularGrid.from_dataframe(data, step = step)
+    values = grid.values
+    if isinstance(threshold, dict):
+        threshold = [threshold[name] for name in grid.names]
+    thresholds = np.broadcast_to(np.asarray(threshold, dtype = np.float64),
+        (values.shape[1],))
+
+    with AQ_profiling.stage('find_episodes.run_lengths', values.size):
+        with np.errstate(invalid = 'ignore'):
+            over = values > thresholds
+        series, starts, lengths = run_lengths(over)
+        series, starts, lengths = _join_runs(series, starts, lengths, max_gap)
+        keep = lengths >= max(min_duration, 1)
+        series, starts, lengths = series[keep], starts[keep], lengths[keep]
+
+    with AQ_profiling.stage('find_episodes.statistics', len(starts)):
+        table = _episode_statistics(values, over, thresholds, series, starts,
+            lengths)
+    table['Series'] = np.asarray(grid.names, dtype = object)[series] \
+        if len(series) else np.array([], dtype = object)
+    table['Start'] = grid.time_at(starts)
+    # End is the time of the last step in the episode
+    table['End'] = grid.time_at(starts + lengths - 1)
+    table['Peak time'] = grid.time_at(table['Peak time'])
+    table = pd.DataFrame(table, columns = EPISODE_COLUMNS)
+    return EpisodeTable(table, grid.step)
+
+def _episode_statistics(values, over, thresholds, series, starts, lengths):
+    """
+        Duration, steps over, peak (and its row), mean, exposure (sum of
+        the values) and excess (sum of the values over the threshold) of
+        each episode. Returns a dictionary of arrays.
+    """
+    num_rows, num_series = values.shape
+    # Work on the series one after another in one long array
+    flat = values.T.ravel()
+    valid = ~np.isnan(flat)
+    flat_thresholds = np.repeat(thresholds, num_rows)
+    offsets = series * num_rows + starts
+    ends = offsets + lengths
+
+    def window_sums(x):
+        sums = np.concatenate(([0.], np.cumsum(x)))
+        return sums[ends] - sums[offsets]
+
+    filled = np.where(valid, flat, 0.)
+    exposure = window_sums(filled)
+    count = window_sums(valid)
+    excess = window_sums(np.where(valid, np.maximum(flat - flat_thresholds,
+        0.), 0.))
+    steps_over = window_sums(over.T.ravel())
+
+    # Peaks from a maximum over each episode's slice of the long array (a
+    # -inf on the end so the last episode's end can be used as an index)
+    peak = np.full(len(starts), np.nan)
+    peak_row = np.zeros(len(starts), dtype = np.int64)
+    if len(starts):
+        padded = np.append(np.where(valid, flat, -np.inf), -np.inf)
+        bounds = np.column_stack((offsets, ends)).ravel()
+        peak = np.maximum.reduceat(padded, bounds)[::2]
+        # The first step in each episode equal to its peak. Episodes don't
+        # overlap, so +1 at each start and -1 after each end marks the steps
+        # inside one.
+        marks = np.zeros(len(flat) + 1, dtype = np.int64)
+        marks[offsets] += 1
+        marks[ends] -= 1
+        inside = np.cumsum(marks)[:-1] > 0
+        started = np.zeros(len(flat), dtype = np.int64)
+        started[offsets] = 1
+        episode = np.cumsum(started) - 1
+        at_peak = np.nonzero(inside & (padded[:-1] == peak[np.maximum(
+            episode, 0)]))[0]
+        numbers, first = np.unique(episode[at_peak], return_index = True)
+        peak_row[numbers] = at_peak[first] % num_rows
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = exposure / count
+    return {'Duration': lengths, 'Steps over': steps_over.astype(np.int64),
+            'Peak': peak, 'Peak time': peak_row, 'Mean': mean,
+            'Exposure': exposure, 'Excess': excess,
+            'Threshold': thresholds[series]}
+
+def limit_episodes(timeseries, species, limit_name = 'UK_HOURLY',
+    max_gap = 0, min_duration = 1):
+    """
+        Episodes above one of the limits for a species, with the series
+        averaged to suit the limit first:
+            HOURLY - the hourly values
+            8HOURLY - running 8 hour means (6 of 8 hours needed)
+            DAILY - daily means (from at least 18 hours of data)
+        Function IN:
+            timeseries (REQUIRED, PANDAS Series or DataFrame):
+                Hourly concentrations with a datetime index, in the unit of
+                the limit. A DataFrame is taken as a column per site.
+            species (REQUIRED, STRING):
+                The species for the limit (eg NO2, 'Nitrogen dioxide').
+            limit_name (OPTIONAL, STRING):
+                The limit type (eg UK_HOURLY, UK_8HOURLY, EU_DAILY).
+                Default = UK_HOURLY
+            max_gap, min_duration (OPTIONAL, INTEGER):
+                As for find_episodes, in steps of the averaged series (hours,
+                or days for DAILY limits).
+        Function OUT:
+            episodes:
+                EpisodeTable, or None if the limit isn't available.
+    """
+    limits = AQ_limits.AQ_limits(species)
+    if limits.species_name is None:
+        return None
+    if limit_name not in limits.limit_type:
+        print "%s not availble for %s. Availble limits are: %s" % (limit_name,
+            limits.species_name, sorted(limits.limit_type.keys()))
+        return None
+    limit = float(limits.limit_type[limit_name].limit)
+    period = limit_name.split('_', 1)[1]
+
+    if isinstance(timeseries, pd.Series):
+        timeseries = timeseries.to_frame()
+    grid = RegularGrid.from_dataframe(timeseries.astype(float), step = '1H')
+    if period == 'HOURLY':
+        averaged = grid
+    elif period == '8HOURLY':
+        averaged = grid.rolling_mean(8, min_periods = 6)
+    elif period == 'DAILY':
+        # Hour ending times, so the 24:00 hour is in the day it ends
+        hourly = grid.to_dataframe()
+        hourly.index = hourly.index - pd.Timedelta(1, 'h')
+        daily = hourly.resample('D')
+        means = daily.mean().where(daily.count() >= 18)
+        averaged = RegularGrid.from_dataframe(means, step = '1D')
+    else:
+        print "Can't find episodes of %s limits." % period
+        return None
+    return find_episodes(averaged, limit, max_gap, min_duration)
+
+class EpisodeTable(object):
+    """
+        A table of episodes (one per row, sorted by start time) that can be
+        queried quickly. Instance variables:
+            table - pandas DataFrame with columns Series, Start, End,
+                Duration (steps, including joined gaps), Steps over, Peak,
+                Peak time, Mean, Exposure (sum of the values), Excess (sum of
+                the values over the threshold) and Threshold
+            step - the time step (numpy timedelta64)
+        The latest end of the episodes up to each one is kept, so finding
+        the episodes in a time range is two binary searches.
+    """
+    def __init__(self, table, step):
+        super(EpisodeTable, self).__init__()
+        self.table = table.sort_values(['Start', 'Series']).reset_index(
+            drop = True)
+        self.table.index.name = 'Episode'
+        self.step = step
+        self._starts = self.table['Start'].values
+        self._ends = self.table['End'].values
+        # Latest end of the episodes up to each one (never goes down, so it
+        # can be searched)
+        self._latest_end = np.maximum.accumulate(self._ends) \
+            if len(self._ends) else self._ends
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return 'EpisodeTable(%d episodes)' % len(self)
+
+    def between(self, start = None, end = None, series = None):
+        """
+            Episodes that overlap the time range start to end (either can be
+            left out), optionally of just some series.
+        """
+        first = 0
+        last = len(self.table)
+        if end is not None:
+            last = np.searchsorted(self._starts, np.datetime64(
+                pd.Timestamp(end).value, 'ns'), side = 'right')
+        if start is not None:
+            start = np.datetime64(pd.Timestamp(start).value, 'ns')
+            first = np.searchsorted(self._latest_end[:last], start,
+                side = 'left')
+        found = self.table.iloc[first:last]
+        if start is not None:
+            found = found[found['End'].values >= start]
+        if series is not None:
+            found = self.for_series(series, found)
+        return found
+
+    def at(self, time, series = None):
+        """
+            Episodes going on at a time.
+        """
+        return self.between(time, time, series)
+
+    def for_series(self, series, table = None):
+        """
+            Episodes of one series (or a list of them).
+        """
+        if table is None:
+            table = self.table
+        if isinstance(series, (list, tuple, set)):
+            return table[table['Series'].isin(series)]
+        return table[table['Series'] == series]
+
+    def longest(self, number = 10):
+        """
+            The longest episodes.
+        """
+        return self.table.sort_values(['Duration', 'Peak'],
+            ascending = False).head(number)
+
+    def summary(self, by = 'year'):
+        """
+            Number of episodes, total duration and highest peak of each
+            series by year (or month).
+        """
+        table = self.table
+        periods = table['Start'].dt.year if by == 'year' else \
+            table['Start'].dt.to_period('M')
+        return table.groupby([table['Series'], periods.rename('Period')]).agg(
+            {'Duration': ['count', 'sum'], 'Peak': 'max'})
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,319 @@
+#==============================================================================
+# Filling short gaps in the measurements (eg an instrument outage of a few
+# hours), so running means and other statistics don't lose whole windows.
+# The gaps of every series are found at once by run length encoding the
+# missing mask (AQ_episodes.run_lengths). Short gaps are filled with a
+# straight line between the values either side (on the regular grid this is
+# time weighted), longer gaps with the series' average diurnal profile moved
+# up or down to meet the values either side, and gaps longer than that are
+# left. Gaps at the start or end of a series have only one side so are not
+# filled. Every gap is filled in one go from its start, length and ends, with
+# no loop over series or gaps.
+# Filled values are given the status F (source_AQ_data.FILLED) so they are
+# never counted as verified (see source_AQ_data.purge_unverified and
+# AQ_capture.status_codes).
+# Class/Function names:
+#   gap_runs(values)
+#   fill_gaps(values, keys, max_linear, max_profile, circular)
+#   fill_grid(grid, max_linear, max_profile, profile)
+#   fill_open_csv(all_data, species, max_linear, max_profile, profile, step)
+#   fill_sites(site_data, species, max_linear, max_profile, profile, step)
+#==============================================================================
+# Uses modules:
+# numpy, pandas, source_AQ_data, AQ_climatology, AQ_episodes, AQ_grid,
+# AQ_profiling
+import numpy as np
+import pandas as pd
+import source_AQ_data
+import AQ_climatology
+import AQ_episodes
+import AQ_profiling
+from AQ_grid import RegularGrid
+#==============================================================================
+
+# How each value was filled
+NOT_FILLED = 0
+LINEAR = 1
+PROFILE = 2
+FILL_NAMES = ['Not filled', 'Linear', 'Profile']
+
+def gap_runs(values):
+    """
+        The gaps (runs of NaN) in every series.
+        Function IN:
+            values (REQUIRED, ARRAY):
+                2D float array, time x series (or 1D for one series).
+        Function OUT:
+            series, starts, lengths, inside:
+                Integer arrays with one value per gap: the column it's in,
+                the row it starts on and the number of rows, and a boolean
+                array that is True for gaps with a value either side.
+    """
+    values = np.asarray(values, dtype = np.float64)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    series, starts, lengths = AQ_episodes.run_lengths(np.isnan(values))
+    inside = (starts > 0) & (starts + lengths < values.shape[0])
+    return series, starts, lengths, inside
+
+def _profiles(values, keys, num_groups):
+    """
+        The mean of every series in each group (eg hour of the day), an array
+        group x series, from one bincount.
+    """
+    num_series = values.shape[1]
+    valid = ~np.isnan(values)
+    bins = (keys[:, np.newaxis] * num_series + np.arange(num_series))[valid]
+    size = num_groups * num_series
+    sums = np.bincount(bins, weights = values[valid], minlength = size)
+    counts = np.bincount(bins, minlength = size)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return (sums / counts).reshape(num_groups, num_series)
+
+def fill_gaps(values, keys = None, max_linear = 3, max_profile = 48,
+    circular = None):
+    """
+        Fill the gaps in many series at once.
+        Function IN:
+            values (REQUIRED, ARRAY):
+                2D float array, time x series (NaN is missing), with rows
+                evenly spaced in time (eg the values of an AQ_grid grid).
+            keys (OPTIONAL, ARRAY of INTEGERS):
+                Profile group of each row (eg the hour of the day, see
+                AQ_climatology.group_keys). Needed for profile filling.
+            max_linear (OPTIONAL, INTEGER):
+                Longest gap (in rows) filled with a straight line between the
+                values either side. Default = 3
+            max_profile (OPTIONAL, INTEGER):
+                Longest gap filled with the profile. Gaps longer than
+                max_linear and no longer than this are filled with the mean
+                profile of the series, shifted to meet the values either
+                side. Default = 48 (no profile filling without keys)
+            circular (OPTIONAL, LIST of BOOLEANS):
+                True for series that are angles in degrees (eg wind
+                direction), which are filled by their sine and cosine so
+                they go the short way round.
+        Function OUT:
+            filled:
+                The values with the gaps filled (a new array).
+            method:
+                Integer array the same shape, LINEAR or PROFILE where a value
+                was filled and NOT_FILLED elsewhere.
+    """
+    values = np.asarray(values, dtype = np.float64)
+    single = values.ndim == 1
+    if single:
+        values = values[:, np.newaxis]
+    num_rows, num_series = values.shape
+    if circular is None:
+        circular = np.zeros(num_series, dtype = bool)
+    circular = np.asarray(circular, dtype = bool)
+
+    # Angles are filled as their cosine (in their own column) and sine (in
+    # extra columns on the end)
+    radians = np.radians(values[:, circular])
+    work = values.copy()
+    work[:, circular] = np.cos(radians)
+    work = np.hstack((work, np.sin(radians)))
+
+    series, starts, lengths, inside = gap_runs(work)
+    method_of_gap = np.where(lengths <= max_linear, LINEAR, PROFILE)
+    if keys is None:
+        method_of_gap[method_of_gap == PROFILE] = NOT_FILLED
+    method_of_gap[(lengths > max(max_linear, max_profile)) | ~inside] = \
+        NOT_FILLED
+    fill = method_of_gap != NOT_FILLED
+    series, starts, lengths = series[fill], starts[fill], lengths[fill]
+    method_of_gap = method_of_gap[fill]
+
+    # Every missing row of the gaps: its row, column and place in the gap
+    total = lengths.sum()
+    first_of_gap = np.cumsum(lengths) - lengths
+    step = np.arange(total) - np.repeat(first_of_gap, lengths) + 1
+    rows = np.repeat(starts, lengths) + step - 1
+    cells = np.repeat(series, lengths)
+    ends = starts + lengths
+    left = work[starts - 1, series]
+    right = work[ends, series]
+
+    with AQ_profiling.stage('fill_gaps', total):
+        if keys is not None:
+            keys = np.asarray(keys, dtype = np.int64)
+            profiles = _profiles(work, keys, keys.max() + 1)
+            # Take the profile off the ends, so the profile is shifted to
+            # meet them
+            is_profile = method_of_gap == PROFILE
+            left = left - np.where(is_profile,
+                profiles[keys[starts - 1], series], 0.)
+            right = right - np.where(is_profile,
+                profiles[keys[ends], series], 0.)
+        fraction = step / (np.repeat(lengths, lengths) + 1.)
+        left, right = np.repeat(left, lengths), np.repeat(right, lengths)
+        new = left + fraction * (right - left)
+        cell_method = np.repeat(method_of_gap, lengths)
+        if keys is not None:
+            on_profile = cell_method == PROFILE
+            new[on_profile] += profiles[keys[rows[on_profile]],
+                cells[on_profile]]
+            # A shifted profile can go below zero; keep series that are
+            # never negative (concentrations) that way
+            positive = ~(np.fmin.reduce(work, axis = 0) < 0)
+            clip = on_profile & positive[cells]
+            new[clip] = np.maximum(new[clip], 0.)
+        work[rows, cells] = new
+
+    # Gaps where the profile has no data are left
+    done = ~np.isnan(new)
+    method = np.zeros(work.shape, dtype = np.int8)
+    method[rows[done], cells[done]] = cell_method[done]
+
+    # Put the angles back together (the sine and cosine have the same gaps
+    # so are filled the same way)
+    filled = work[:, :num_series]
+    method = method[:, :num_series]
+    if circular.any():
+        angles = np.degrees(np.arctan2(work[:, num_series:],
+            filled[:, circular])) % 360.
+        filled[:, circular] = np.where(method[:, circular] != NOT_FILLED,
+            angles, values[:, circular])
+    if single:
+        return filled[:, 0], method[:, 0]
+    return filled, method
+
+def _is_angle(name):
+    name = name[-1] if isinstance(name, tuple) else name
+    return 'Direction' in str(name)
+
+def fill_grid(grid, max_linear = 3, max_profile = 48, profile = 'hour'):
+    """
+        Fill the gaps of every series on a grid. Wind directions are filled
+        as angles.
+        Function IN:
+            grid (REQUIRED, AQ_grid.RegularGrid):
+                The series (eg from RegularGrid.from_open_csv or combine).
+            max_linear, max_profile (OPTIONAL, INTEGER):
+                As for fill_gaps. Default = 3 and 48
+            profile (OPTIONAL, STRING):
+                The profile used for longer gaps, one of
+                AQ_climatology.PROFILES: 'hour' (default), 'hour_weekday' or
+                'month_hour' (the diurnal cycle of each month). None to only
+                fill linearly.
+        Function OUT:
+            filled:
+                AQ_grid.RegularGrid with the gaps filled.
+            method:
+                Integer array, time x series, of how each value was filled.
+    """
+    keys = None
+    if profile is not None:
+        keys = AQ_climatology.group_keys(grid.times, profile,
+            step = grid.step)[0]
+    circular = [_is_angle(name) for name in grid.names]
+    values, method = fill_gaps(grid.values, keys, max_linear, max_profile,
+        circular)
+    return RegularGrid(grid.start, grid.step, values, grid.names,
+        grid.units), method
+
+def _apply_fill(all_data, species, filled, method, columns):
+    """
+        Put the filled values of some grid columns back into a DataFrame
+        from open_csv (a copy), giving them the FILLED status.
+    """
+    all_data = all_data.copy()
+    names = list(all_data.columns)
+    rows = filled.offset(all_data['Date and Time'].values)
+    for name, column in zip(species, columns):
+        was_filled = method[rows, column] != NOT_FILLED
+        if not was_filled.any():
+            continue
+        status_name = names[names.index(name) + 1]
+        all_data.loc[was_filled, name] = filled.values[rows[was_filled],
+            column]
+        # Keep the units (and instrument) of the status, change the code
+        status = all_data.loc[was_filled, status_name]
+        unit = filled.units[column] or ''
+        rest = status.str.split(' ', 1).str[1].fillna(unit)
+        all_data.loc[was_filled, status_name] = \
+            source_AQ_data.FILLED + ' ' + rest
+    return all_data
+
+def fill_open_csv(all_data, species = None, max_linear = 3,
+    max_profile = 48, profile = 'hour', step = '1H'):
+    """
+        Fill the gaps of the species in a DataFrame from
+        source_AQ_data.open_csv. Filled values get the status F so
+        purge_unverified removes them. Only rows that are in the file are
+        filled (DEFRA files have a row for every hour).
+        Function IN:
+            all_data (REQUIRED, PANDAS DATAFRAME):
+                The data from source_AQ_data.open_csv.
+            species (OPTIONAL, LIST of STRINGS):
+                The species to fill. Default is all of them.
+            max_linear, max_profile, profile (OPTIONAL):
+                As for fill_grid.
+            step (OPTIONAL, STRING):
+                Time between measurements. Default = '1H'
+        Function OUT:
+            filled_data:
+                A copy of all_data with the gaps filled.
+    """
+    if species is None:
+        species = source_AQ_data.list_species(all_data.columns)
+    grid = RegularGrid.from_open_csv(all_data, species, step = step)
+    filled, method = fill_grid(grid, max_linear, max_profile, profile)
+    return _apply_fill(all_data, species, filled, method,
+        range(len(species)))
+
+def fill_sites(site_data, species = None, max_linear = 3, max_profile = 48,
+    profile = 'hour', step = '1H'):
+    """
+        Fill the gaps of many sites in one go: all their species are put on
+        one grid and filled together.
+        Function IN:
+            site_data (REQUIRED, DICTIONARY):
+                Site name and pandas DataFrame from source_AQ_data.open_csv.
+            species (OPTIONAL, LIST of STRINGS):
+                The species to fill (those a site has). Default is all.
+            max_linear, max_profile, profile, step (OPTIONAL):
+                As for fill_open_csv.
+        Function OUT:
+            filled_data:
+                Dictionary of site name and filled DataFrame.
+            counts:
+                pandas DataFrame of the number of values filled by each
+                method, indexed by site and species.
+    """
+    sites = sorted(site_data.keys())
+    grids = []
+    names = []
+    site_species = {}
+    for site in sites:
+        available = source_AQ_data.list_species(site_data[site].columns)
+        if species is not None:
+            available = [name for name in available if name in species]
+        site_species[site] = available
+        if available:
+            grids.append(RegularGrid.from_open_csv(site_data[site],
+                available, step = step))
+            names += [(site, name) for name in available]
+    if not grids:
+        raise ValueError('None of the sites have the species')
+    filled, method = fill_grid(RegularGrid.combine(grids, names = names),
+        max_linear, max_profile, profile)
+
+    filled_data = {}
+    counts = []
+    for site in sites:
+        columns = [names.index((site, name)) for name in site_species[site]]
+        filled_data[site] = _apply_fill(site_data[site], site_species[site],
+            filled, method, columns)
+        for name, column in zip(site_species[site], columns):
+            counts.append([site, name] + [int(np.sum(method[:, column] ==
+                code)) for code in (LINEAR, PROFILE)])
+    counts = pd.DataFrame(counts, columns = ['Site', 'Species'] +
+        FILL_NAMES[1:]).set_index(['Site', 'Species'])
+    return filled_data, counts
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,321 @@
+#==============================================================================
+# A dense regular time grid for one or more series: a start time, a fixed step
+# (eg. hourly or 15 minutes) and a float array with a row for every step (NaN
+# where there's no data). Finding the row for a time is just arithmetic, and
+# series on the same step line up by shifting, with no index searching or
+# joining. The array is time x series so it can go straight into the
+# averaging functions (eg AQ_averages.rolling_mean).
+# Class/Function names:
+#   RegularGrid(start, step, values, names, units)
+#   RegularGrid.from_series(series, step)
+#   RegularGrid.from_dataframe(df, step)
+#   RegularGrid.from_open_csv(all_data, species, step)
+#   RegularGrid.align(grids)
+#   RegularGrid.combine(grids)
+#   to_timedelta(step)
+#==============================================================================
+# Uses modules:
+# numpy, pandas, source_AQ_data, AQ_averages, AQ_derived
+import numpy as np
+import pandas as pd
+import source_AQ_data
+import AQ_averages
+import AQ_derived
+#==============================================================================
+
+def to_timedelta(step):
+    """
+        Turn a step given as a string (eg '1H', '15min'), pandas Timedelta or
+        numpy timedelta64 into a numpy timedelta64 in nanoseconds.
+    """
+    return np.timedelta64(pd.Timedelta(step).value, 'ns')
+
+class RegularGrid(object):
+    """
+        Series on a regular time grid. The instance variables are:
+            start - time of the first row (numpy datetime64[ns])
+            step - time between rows (numpy timedelta64[ns])
+            values - 2D float array, time x series
+            names - list of the series names (one per column)
+            units - list of the units (or None) of each series
+        The time of row i is start + i * step. Use from_series,
+        from_dataframe or from_open_csv to make one from the usual pandas
+        data, and to_dataframe to go back.
+    """
+    def __init__(self, start, step, values, names = None, units = None):
+        super(RegularGrid, self).__init__()
+        self.start = np.datetime64(pd.Timestamp(start).value, 'ns')
+        self.step = to_timedelta(step)
+        values = np.asarray(values, dtype = np.float64)
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        self.values = values
+        if names is None:
+            names = list(range(values.shape[1]))
+        self.names = list(names)
+        if units is None:
+            units = [None] * len(self.names)
+        self.units = list(units)
+        if len(self.names) != values.shape[1]:
+            raise ValueError('%d names given for %d series' % (len(self.names),
+                values.shape[1]))
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __repr__(self):
+        return 'RegularGrid(start=%s, step=%s, rows=%d, names=%r)' % (
+            self.start, pd.Timedelta(self.step), len(self), self.names)
+
+    @property
+    def end(self):
+        """
+            Time of the last row.
+        """
+        return self.start + (len(self) - 1) * self.step
+
+    @property
+    def times(self):
+        """
+            The times of all the rows as a pandas DatetimeIndex.
+        """
+        return pd.DatetimeIndex(self.start + np.arange(len(self)) * self.step)
+
+    def offset(self, timestamp):
+        """
+            Row number of a time (or array of times). Times between rows give
+            the row before. Not checked against the length of the grid, so can
+            be negative or past the end.
+        """
+        times = pd.to_datetime(np.atleast_1d(timestamp)).values
+        offsets = (times - self.start) // self.step
+        if np.ndim(timestamp) == 0 and not isinstance(timestamp,
+            (pd.Index, pd.Series)):
+            return int(offsets[0])
+        return offsets.astype(np.int64)
+
+    def time_at(self, offset):
+        """
+            The time of a row number (or array of row numbers).
+        """
+        return self.start + np.asarray(offset, dtype = np.int64) * self.step
+
+    def column(self, name):
+        """
+            The values of one series as a 1D array (not copied).
+        """
+        return self.values[:, self.names.index(name)]
+
+    def value_at(self, timestamp, name = None):
+        """
+            The value(s) at a time. NaN if the time isn't on the grid. If no
+            name is given, returns a value for every series.
+        """
+        row = self.offset(timestamp)
+        if row < 0 or row >= len(self):
+            values = np.full(self.values.shape[1], np.nan)
+        else:
+            values = self.values[row]
+        if name is None:
+            return values
+        return values[self.names.index(name)]
+
+    def slice(self, start = None, end = None):
+        """
+            The part of the grid from start to end (both included, as with
+            pandas .loc). The values are a view, not a copy.
+        """
+        first = 0 if start is None else max(self.offset(start), 0)
+        if start is not None and self.time_at(first) < np.datetime64(
+            pd.Timestamp(start).value, 'ns'):
+            first += 1
+        last = len(self) if end is None else min(self.offset(end) + 1,
+            len(self))
+        last = max(last, first)
+        return RegularGrid(self.time_at(first), self.step,
+            self.values[first:last], self.names, self.units)
+
+    def select(self, names):
+        """
+            A grid with just some of the series.
+        """
+        columns = [self.names.index(n) for n in names]
+        return RegularGrid(self.start, self.step, self.values[:, columns],
+            names, [self.units[c] for c in columns])
+
+    def reframe(self, start, length):
+        """
+            The grid moved onto a new start time and length (same step). Rows
+            outside the old grid are NaN. Start must be a whole number of
+            steps from the current start.
+        """
+        start = np.datetime64(pd.Timestamp(start).value, 'ns')
+        shift = (self.start - start) // self.step
+        if start + shift * self.step != self.start:
+            raise ValueError('New start is not on the grid')
+        values = np.full((length, self.values.shape[1]), np.nan)
+        # Rows of the old grid that land in the new one
+        first = max(0, -shift)
+        last = min(len(self), length - shift)
+        if last > first:
+            values[first + shift:last + shift] = self.values[first:last]
+        return RegularGrid(start, self.step, values, self.names, self.units)
+
+    def rolling_mean(self, window, min_periods = None):
+        """
+            Trailing running mean of every series (window in rows).
+        """
+        means = AQ_averages.rolling_mean(self.values, window,
+            min_periods = min_periods)
+        return RegularGrid(self.start, self.step, means, self.names,
+            self.units)
+
+    def to_dataframe(self):
+        """
+            The grid as a pandas DataFrame with a row for every time.
+        """
+        return pd.DataFrame(self.values, index = self.times,
+            columns = self.names, copy = False)
+
+    def to_series(self, name = None):
+        """
+            One series (the first if no name given) as a pandas Series.
+        """
+        if name is None:
+            name = self.names[0]
+        return pd.Series(self.column(name), index = self.times, name = name)
+
+    @classmethod
+    def from_dataframe(cls, df, step = '1H', start = None, end = None,
+        how = 'last', units = None):
+        """
+            Put a DataFrame (or Series) with a datetime index on a grid.
+            Function IN:
+                df (REQUIRED, PANDAS DATAFRAME or SERIES):
+                    The data. The index must be datetimes, and can have gaps,
+                    duplicates and be out of order.
+                step (OPTIONAL, STRING or TIMEDELTA):
+                    The grid step. Default = '1H'
+                start, end (OPTIONAL, DATETIME):
+                    The first and last times of the grid. Default is the first
+                    and last times in the data (start rounded down to a step).
+                how (OPTIONAL, STRING):
+                    What to do when more than one row falls in a step: 'last'
+                    (keep the last, default) or 'mean'.
+                units (OPTIONAL, LIST):
+                    The units of each column.
+            Function OUT:
+                grid:
+                    RegularGrid
+        """
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        step = to_timedelta(step)
+        times = pd.DatetimeIndex(df.index).values
+        # Columns that aren't numbers (eg units) can't go on the grid
+        df = df.select_dtypes(include = [np.number])
+        data = np.asarray(df.values, dtype = np.float64)
+
+        if start is None:
+            first = times.min() if len(times) else np.datetime64(0, 'ns')
+            start = first - (first - np.datetime64(0, 'ns')) % step
+        start = np.datetime64(pd.Timestamp(start).value, 'ns')
+        if end is None:
+            end = times.max() if len(times) else start
+        end = np.datetime64(pd.Timestamp(end).value, 'ns')
+        length = int((end - start) // step) + 1
+
+        rows = (times - start) // step
+        inside = (rows >= 0) & (rows < length)
+        rows = rows[inside].astype(np.int64)
+        data = data[inside]
+
+        values = np.full((length, data.shape[1]), np.nan)
+        if how == 'last':
+            # Assignment with repeated rows keeps the last one. NaNs are left
+            # out so they don't hide an earlier value in the same step.
+            for column in range(data.shape[1]):
+                valid = ~np.isnan(data[:, column])
+                values[rows[valid], column] = data[valid, column]
+        elif how == 'mean':
+            for column in range(data.shape[1]):
+                valid = ~np.isnan(data[:, column])
+                sums = np.bincount(rows[valid], weights = data[valid, column],
+                    minlength = length)
+                counts = np.bincount(rows[valid], minlength = length)
+                with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                    values[:, column] = sums / counts
+        else:
+            raise ValueError("how must be 'last' or 'mean'")
+
+        return cls(start, step, values, list(df.columns), units)
+
+    @classmethod
+    def from_series(cls, series, step = '1H', **kwargs):
+        """
+            Put a single pandas Series on a grid. See from_dataframe.
+        """
+        return cls.from_dataframe(series.to_frame(), step = step, **kwargs)
+
+    @classmethod
+    def from_open_csv(cls, all_data, species = None, step = '1H', **kwargs):
+        """
+            Put species from a DataFrame made by source_AQ_data.open_csv on a
+            grid. The units are taken from the status columns.
+            Function IN:
+                all_data (REQUIRED, PANDAS DATAFRAME):
+                    The data from open_csv.
+                species (OPTIONAL, LIST of STRINGS):
+                    The species to use (can include derived variables, see
+                    AQ_derived). Default is all of the species in the file.
+                step (OPTIONAL, STRING or TIMEDELTA):
+                    The grid step. Default = '1H'
+            Function OUT:
+                grid:
+                    RegularGrid
+        """
+        if species is None:
+            species = source_AQ_data.list_species(all_data.columns)
+        all_data = AQ_derived.add_columns(all_data, species)
+        columns = list(all_data.columns)
+        units = []
+        for name in species:
+            # The status column is the one after the species
+            status = all_data[columns[columns.index(name) + 1]].dropna()
+            units.append(status.iloc[0].split(' ', 2)[1]
+                if len(status) else None)
+        df = all_data[species].set_index(all_data['Date and Time'])
+        return cls.from_dataframe(df, step = step, units = units, **kwargs)
+
+    @classmethod
+    def align(cls, grids):
+        """
+            Put a list of grids (with the same step) onto the same start and
+            length, covering all of them. Returns a list of new grids.
+        """
+        step = grids[0].step
+        for grid in grids:
+            if grid.step != step:
+                raise ValueError('All grids must have the same step')
+        start = min(grid.start for grid in grids)
+        end = max(grid.end for grid in grids)
+        length = int((end - start) // step) + 1
+        return [grid.reframe(start, length) for grid in grids]
+
+    @classmethod
+    def combine(cls, grids, names = None):
+        """
+            Join a list of grids (with the same step) into one grid with all
+            of their series as columns. Names can be given for the columns,
+            otherwise the names of each grid are used.
+        """
+        aligned = cls.align(grids)
+        values = np.hstack([grid.values for grid in aligned])
+        if names is None:
+            names = sum([grid.names for grid in aligned], [])
+        units = sum([grid.units for grid in aligned], [])
+        return cls(aligned[0].start, aligned[0].step, values, names, units)
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -5,12 +5,19 @@
 # aquired from: https://uk-air.defra.gov.uk/air-pollution/uk-eu-limits
 # This module aims to return the air quality limit for a given species at for
 # a given time period (eg NO2 DAILY, CO 8-HOURLY, PM10 ANNUAL)
-#
+# Also counts how often a timeseries goes over a limit.
+# Class/Function names:
+#   AQ_limits(species)
+#   split_limits()
+#   count_exceedances(timeseries, species, limit_name)
 #==============================================================================
 # Uses modules:
-# pandas, Edinburgh_AQ
+# os, numpy, pandas, AQ_profiling, AQ_grid
+import os
+import numpy as np
 import pandas as pd
-import Edinburgh_AQ
+import AQ_profiling
+from AQ_grid import RegularGrid
 #==============================================================================
 
 class AQ_limits(object):
@@ -47,9 +54,10 @@ class AQ_limits(object):
             package.
         """
         # Set file name & read in with pandas. Skip first row of first headings
-        module_path = Edinburgh_AQ.__path__[0]
+        module_path = os.path.dirname(os.path.abspath(__file__))
         filename = '%s/AQ_limits_database.csv' % module_path
-        AQ_df = pd.read_csv(filename, skiprows = 1)
+        with AQ_profiling.stage('AQ_limits.read_database'):
+            AQ_df = pd.read_csv(filename, skiprows = 1)
         # Make the species column the DataFrame index
         AQ_df.index = AQ_df.pop('SPECIES')
 
@@ -69,11 +77,14 @@ class AQ_limits(object):
         if species_upper in self.availble_species:
             self.species_name = species_upper
             return self
-        # Check if it is PM10
-        elif species_upper in ['PM10','PM 10','PARTICULATE MATTER 10' ]:
+        # Check if it is PM10 (DEFRA columns start with the name, eg.
+        # 'PM10 particulate matter (Hourly measured)')
+        elif species_upper in ['PM10','PM 10','PARTICULATE MATTER 10' ] or \
+            species_upper.startswith('PM10 '):
             changed_name = 'PM10'
         # Check if it is PM2.5
-        elif species_upper in ['PM25', 'PM 25', 'PM2.5', 'PARTICULATE MATTER 25']:
+        elif species_upper in ['PM25', 'PM 25', 'PM2.5', 'PARTICULATE MATTER 25'] or \
+            species_upper.startswith('PM2.5 '):
             changed_name = 'PM2.5'
         # Check if NO2
         elif species_upper in ['NO2', 'NITROGEN DIOXIDE']:
@@ -118,38 +129,36 @@ class AQ_limits(object):
             # Get the full database then select only species of interest
             df = self.full_database
             species_df = df.loc[species]
-            # Remove any data that is NaNs (ie no available limits)
-            species_df.dropna(inplace = True)
+            unit = species_df.UNIT
 
-            # Get limit types. Loop through all info. If its not a unit
-            # or a per year exceedance then its a AQ limit (hopefully).
-            limit_types = []
-            for i in species_df.index:
-                if i.split('.')[0] not in ['UNIT', 'PER_YEAR']:
-                    limit_types.append(i)
-
-            # Loop throuh the limit types and put the relevant info into a dictionary
+            # Loop through the columns. If its not a unit or a per year
+            # exceedance then its a AQ limit (hopefully). Limits that are
+            # NaNs aren't available for this species.
             limit_type_dict = {}
-            for n, lt in enumerate(species_df.index):
-                if lt in limit_types:
-                    # Get the information from the DataFrame
-                    species_name = 'Test species' #species
-                    limit = species_df[lt]
-                    unit = species_df.UNIT
-                    limit_name = lt.replace('_', ' ')
-                    # Get the exceedance value that the DataFrame column one past the limit type
-                    # Try and see if there is an exceedance in the DataFrame
-                    # If not then set to None
-                    try:
-                        exceedance = '%d per year' % int(species_df[species_df.index[n + 1]])
-                    except KeyError:
-                        exceedance = 'None'
-                    except IndexError:
-                        exceedance = 'None'
-
-                    # Set all the variables into a class thats in a named dictionary
-                    limit_type_dict[lt] = split_limits(species_name,limit, unit,
-                        limit_name, exceedance)
+            columns = list(species_df.index)
+            for n, lt in enumerate(columns):
+                if lt.split('.')[0] in ['UNIT', 'PER_YEAR']:
+                    continue
+                limit = species_df[lt]
+                if pd.isnull(limit):
+                    continue
+                species_name = 'Test species' #species
+                limit_name = lt.replace('_', ' ')
+                # The exceedances allowed are in the PER_YEAR column straight
+                # after the limit (in the raw row, so a limit without one
+                # doesn't pick up the next limit's value). N/A means none.
+                per_year = None
+                exceedance = 'None'
+                if n + 1 < len(columns) and \
+                    columns[n + 1].split('.')[0] == 'PER_YEAR' and \
+                    not pd.isnull(species_df[columns[n + 1]]):
+                    per_year = int(species_df[columns[n + 1]])
+                    exceedance = '%d per year' % per_year
+
+                # Set all the variables into a class thats in a named
+                # dictionary
+                limit_type_dict[lt] = split_limits(species_name,limit, unit,
+                    limit_name, exceedance, per_year)
 
             self.limit_type = limit_type_dict
 
@@ -166,15 +175,97 @@ class split_limits(object):
             exceedance - How many times this should not be exceeded per year
                 (This is not availble for all species and will be set to None if
                 not availble.)
+            per_year - The same as exceedance but as a number (or None)
     """
 
-    def __init__(self, species_name, limit, unit, limit_name, exceedance = None):
+    def __init__(self, species_name, limit, unit, limit_name, exceedance = None,
+        per_year = None):
         super(split_limits, self).__init__()
         self.species_name =species_name
         self.limit = limit
         self.unit = unit
         self.limit_name = limit_name
         self.exceedance = exceedance
+        self.per_year = per_year
+
+def count_exceedances(timeseries, species, limit_name = 'UK_HOURLY'):
+    """
+        Count how many times a year a timeseries goes over one of the limits
+        for a species. The timeseries is averaged to suit the limit first:
+            HOURLY - the hourly values
+            8HOURLY - the highest running 8 hour mean (6 of 8 hours
+                needed) each day
+            DAILY - daily means (from at least 18 hours of data)
+            ANNUAL - annual means
+        15 minute limits can't be checked with hourly data.
+        Function IN:
+            timeseries (REQUIRED, PANDAS Series):
+                Hourly concentrations with a datetime index (eg from
+                source_AQ_data.select_one_variable). In the unit of the limit.
+            species (REQUIRED, STRING):
+                The species for the limit (eg NO2, 'Nitrogen dioxide').
+            limit_name (OPTIONAL, STRING):
+                The limit type (eg UK_HOURLY, EU_DAILY). Default = UK_HOURLY
+        Function OUT:
+            exceedances:
+                pandas DataFrame with a row per year of the number of
+                exceedances, the number allowed and whether the limit was
+                broken. None if the limit isn't available.
+    """
+    limits = AQ_limits(species)
+    if limits.species_name is None:
+        return None
+    if limit_name not in limits.limit_type:
+        print "%s not availble for %s. Availble limits are: %s" % (limit_name,
+            limits.species_name, sorted(limits.limit_type.keys()))
+        return None
+    limit = limits.limit_type[limit_name]
+    period = limit_name.split('_', 1)[1]
+
+    # Average the series to match the limit. The series is put on an hourly
+    # grid first, so missing hours are gaps rather than being skipped over
+    # by the running means.
+    grid = RegularGrid.from_series(timeseries.astype(float), step = '1H')
+    # Hour ending times, so take an hour off to put the 24:00 hour in the
+    # day (and year) it ends, as AQ_capture and AQ_episodes do
+    hour = pd.Timedelta(1, 'h')
+    has_data = ~np.isnan(grid.values[:, 0])
+    years = np.unique((grid.times[has_data] - hour).year)
+    if period == '8HOURLY':
+        grid = grid.rolling_mean(8, min_periods = 6)
+    hourly = grid.to_series()
+    hourly.index = hourly.index - hour
+    if period == 'HOURLY':
+        averaged = hourly
+    elif period == '8HOURLY':
+        averaged = hourly.resample('D').max()
+    elif period == 'DAILY':
+        daily = hourly.resample('D')
+        averaged = daily.mean().where(daily.count() >= 18)
+    elif period == 'ANNUAL':
+        averaged = hourly.resample('A').mean()
+    else:
+        print "Can't check %s limits with hourly data." % period
+        return None
+
+    # Count the exceedances for each year
+    averaged = averaged.dropna()
+    over = (averaged.values > float(limit.limit)).astype(int)
+    counts = pd.Series(over, index = averaged.index).groupby(
+        averaged.index.year).sum()
+    # Years with data but no averages that could be checked have none
+    counts = counts.reindex(years, fill_value = 0)
+
+    exceedances = pd.DataFrame({'Exceedances': counts})
+    exceedances.index.name = 'Year'
+    if limit.per_year is None:
+        exceedances['Allowed'] = 0
+    else:
+        exceedances['Allowed'] = limit.per_year
+    exceedances['Broken'] = exceedances['Exceedances'] > \
+        exceedances['Allowed']
+
+    return exceedances
 
 
 ## ============================================================================
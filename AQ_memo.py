@@ -0,0 +1,466 @@
+#==============================================================================
+# Remembers the results of the slow, often repeated functions (reading a
+# file, selecting a species, exceedances, limit lookups) so a pipeline run
+# again on the same data doesn't work them out again. Quick functions on data
+# already in memory (purging, running means, windroses) aren't memoised, as
+# fingerprinting their input takes longer than working them out. Results
+# are keyed by a fingerprint of the input data (a hash of the values of
+# DataFrames and arrays, or the modification time and size of a file) and
+# the other arguments, so changed data gives a new result. The key also has
+# a fingerprint of the package's code and the formulas of any derived
+# variables named in the arguments, so a new release or a redefined
+# variable doesn't get old results from disk.
+# Results are kept in memory (least recently used are dropped first) and,
+# if a cache directory is set, pickled to disk (oldest used files deleted
+# when over the size limit) so they last between runs. Set the directory
+# with the environment variable EDINBURGH_AQ_CACHE_DIR (and the size with
+# EDINBURGH_AQ_CACHE_MB, default 500) or in code with configure(). Use the
+# memoised functions here in place of the originals, eg:
+#       species_data, name = AQ_memo.select_one_variable('Ozone', filename)
+#       AQ_memo.stats()
+# Each call gets its own copy of the DataFrames, Series and arrays in a
+# result, so changing one doesn't change what is remembered.
+# Class/Function names:
+#   fingerprint(value)
+#   DiskStore(directory, max_bytes)
+#   Memo(max_items, directory, max_bytes)
+#   memoize(func, name)
+#   configure(directory, max_items, max_mb)
+#   stats()
+#   clear(disk)
+#   open_csv, select_one_variable, split_one_variable, count_exceedances,
+#   limits (memoised versions)
+#==============================================================================
+# Uses modules:
+# os, time, errno, hashlib, threading, tempfile, cPickle, functools, numpy,
+# pandas, source_AQ_data, AQ_derived, AQ_limits, AQ_cache
+import os
+import time
+import errno
+import hashlib
+import threading
+import tempfile
+import cPickle as pickle
+import functools
+import numpy as np
+import pandas as pd
+import source_AQ_data
+import AQ_derived
+import AQ_limits
+from AQ_cache import LRUCache
+#==============================================================================
+
+# Change this when the results of a memoised function change, so old results
+# on disk aren't used
+CACHE_VERSION = 2
+
+def _code_fingerprint():
+    """
+        A hash of the package's python files, so results worked out by other
+        code aren't used.
+    """
+    digest = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.py'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                digest.update(name + f.read())
+    return digest.hexdigest()
+
+CODE_FINGERPRINT = _code_fingerprint()
+
+def fingerprint(value):
+    """
+        A string that changes when the value does. DataFrames, Series and
+        arrays are hashed by their values (and index), names of files that
+        exist by their modification time and size, lists, tuples and
+        dictionaries by their contents and anything else by its repr.
+    """
+    digest = hashlib.sha1()
+    _update_digest(digest, value)
+    return digest.hexdigest()
+
+def _update_digest(digest, value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(type(value).__name__)
+        hashes = pd.util.hash_pandas_object(value, index = True).values
+        digest.update(np.ascontiguousarray(hashes).tostring())
+        if isinstance(value, pd.DataFrame):
+            digest.update(repr(list(value.columns)))
+        else:
+            digest.update(repr(value.name))
+    elif isinstance(value, np.ndarray):
+        digest.update('%s%s' % (value.dtype.str, value.shape))
+        if value.dtype == object:
+            digest.update(repr(value.tolist()))
+        else:
+            digest.update(np.ascontiguousarray(value).tostring())
+    elif isinstance(value, (list, tuple)):
+        digest.update('%s%d' % (type(value).__name__, len(value)))
+        for item in value:
+            _update_digest(digest, item)
+    elif isinstance(value, dict):
+        digest.update('dict%d' % len(value))
+        for key in sorted(value.keys()):
+            _update_digest(digest, key)
+            _update_digest(digest, value[key])
+    elif isinstance(value, basestring) and os.path.isfile(value):
+        info = os.stat(value)
+        digest.update(repr(('file', os.path.abspath(value), info.st_mtime,
+            info.st_size)))
+    else:
+        digest.update(repr(value))
+
+class DiskStore(object):
+    """
+        Pickled results in a directory, one file per key. When the files add
+        up to more than max_bytes the least recently used (oldest modified,
+        as a file is touched when it's read) are deleted. Results that can't
+        be pickled are just not stored.
+    """
+    def __init__(self, directory, max_bytes = 500 * 1024 ** 2):
+        super(DiskStore, self).__init__()
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unstorable = 0
+        try:
+            os.makedirs(self.directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        self.size = sum(size for path, size, mtime in self._files())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def _files(self):
+        """
+            (path, size, modification time) of every stored result.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pkl'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            files.append((path, info.st_size, info.st_mtime))
+        return files
+
+    def get(self, key):
+        """
+            Returns (True, value) if the key is stored, otherwise
+            (False, None).
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            with self.lock:
+                self.misses += 1
+            return False, None
+        try:
+            # Mark as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return True, value
+
+    def put(self, key, value):
+        """
+            Store a result, then delete the oldest if over max_bytes.
+        """
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            with self.lock:
+                self.unstorable += 1
+            return
+        if len(data) > self.max_bytes:
+            with self.lock:
+                self.unstorable += 1
+            return
+        # Write to a temporary file and rename, so a reader never sees half
+        # a file
+        handle, temp_path = tempfile.mkstemp(dir = self.directory,
+            suffix = '.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        path = self._path(key)
+        with self.lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.rename(temp_path, path)
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+            Delete the least recently used files until under max_bytes.
+        """
+        files = sorted(self._files(), key = lambda f: f[2])
+        self.size = sum(size for path, size, mtime in files)
+        for path, size, mtime in files:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            for path, size, mtime in self._files():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.size = 0
+
+    def stats(self):
+        """
+            Returns a dictionary of the store size and hit counts.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'directory': self.directory,
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'unstorable': self.unstorable,
+                    'hit_rate': self.hits / float(lookups) if lookups else 0.}
+
+class Memo(object):
+    """
+        Results kept in memory (an LRUCache) and, if a directory is given, on
+        disk (a DiskStore) behind it. Results found on disk are put back in
+        memory. Keeps count of calls, hits and the time saved.
+    """
+    def __init__(self, max_items = 256, directory = None,
+        max_bytes = 500 * 1024 ** 2):
+        super(Memo, self).__init__()
+        self.memory = LRUCache(max_items)
+        self.disk = DiskStore(directory, max_bytes) if directory else None
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def get(self, key):
+        """
+            Returns (True, value) if the key is in memory or on disk,
+            otherwise (False, None).
+        """
+        found, value = self.memory.get(key)
+        if not found and self.disk is not None:
+            found, value = self.disk.get(key)
+            if found:
+                self.memory.put(key, value)
+        return found, value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def record(self, name, hit, seconds):
+        """
+            Count a call of a memoised function (seconds is how long it took
+            to work out, for a miss).
+        """
+        with self.lock:
+            counts = self.calls.setdefault(name, {'hits': 0, 'misses': 0,
+                'seconds': 0.})
+            counts['hits' if hit else 'misses'] += 1
+            counts['seconds'] += seconds
+
+    def clear(self, disk = False):
+        """
+            Forget everything in memory (and on disk if disk = True).
+        """
+        self.memory.clear()
+        if disk and self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        """
+            Hit counts overall, for memory and disk and for each function.
+        """
+        with self.lock:
+            functions = {}
+            hits = misses = 0
+            for name, counts in self.calls.items():
+                lookups = counts['hits'] + counts['misses']
+                functions[name] = dict(counts, hit_rate = counts['hits'] /
+                    float(lookups) if lookups else 0.)
+                hits += counts['hits']
+                misses += counts['misses']
+        lookups = hits + misses
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / float(lookups) if lookups else 0.,
+                'memory': self.memory.stats(),
+                'disk': self.disk.stats() if self.disk is not None else None,
+                'functions': functions}
+
+def _default_memo():
+    directory = os.environ.get('EDINBURGH_AQ_CACHE_DIR') or None
+    max_mb = float(os.environ.get('EDINBURGH_AQ_CACHE_MB', 500))
+    return Memo(directory = directory, max_bytes = int(max_mb * 1024 ** 2))
+
+# The memo used by the memoised functions
+_memo = _default_memo()
+
+def _copy(value):
+    """
+        A copy of the DataFrames, Series and arrays in a result (in lists,
+        tuples and dictionaries too), so the remembered one can't be changed.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return value.copy()
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_copy(item) for item in value)
+    elif isinstance(value, dict):
+        return dict((key, _copy(item)) for key, item in value.items())
+    return value
+
+def _definitions(args, kwargs):
+    """
+        The formulas of the derived variables named in the arguments.
+    """
+    return [AQ_derived.definition(value) for value in
+        list(args) + [kwargs[key] for key in sorted(kwargs)]
+        if isinstance(value, basestring) and AQ_derived.is_derived(value)]
+
+def memoize(func, name = None):
+    """
+        Wrap a function so its results are remembered, keyed by the function
+        name and a fingerprint of its arguments.
+        Function IN:
+            func (REQUIRED, FUNCTION or CLASS):
+                The function to memoise.
+            name (OPTIONAL, STRING):
+                Name to key and count the results by. Default is the module
+                and function name.
+        Function OUT:
+            wrapper:
+                The memoised function.
+    """
+    if name is None:
+        name = '%s.%s' % (func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        memo = _memo
+        key = fingerprint((CACHE_VERSION, CODE_FINGERPRINT, name, args,
+            kwargs, _definitions(args, kwargs)))
+        found, result = memo.get(key)
+        if found:
+            memo.record(name, True, 0.)
+            return _copy(result)
+        started = time.time()
+        result = func(*args, **kwargs)
+        memo.record(name, False, time.time() - started)
+        memo.put(key, result)
+        return _copy(result)
+    wrapper.memo_name = name
+    return wrapper
+
+def configure(directory = None, max_items = 256, max_mb = 500):
+    """
+        Start a new memo (forgetting what is in memory).
+        Function IN:
+            directory (OPTIONAL, STRING):
+                Directory for results on disk. Default None (memory only).
+            max_items (OPTIONAL, INTEGER):
+                Number of results kept in memory. Default = 256
+            max_mb (OPTIONAL, FLOAT):
+                Size limit of the results on disk in MB. Default = 500
+        Function OUT:
+            memo:
+                The new Memo.
+    """
+    global _memo
+    _memo = Memo(max_items, directory, int(max_mb * 1024 ** 2))
+    return _memo
+
+def stats():
+    """
+        Hit statistics of the memo (see Memo.stats).
+    """
+    return _memo.stats()
+
+def clear(disk = False):
+    """
+        Forget the remembered results (and those on disk if disk = True).
+    """
+    _memo.clear(disk)
+
+# Memoised versions of the package functions
+open_csv = memoize(source_AQ_data.open_csv)
+split_one_variable = memoize(source_AQ_data.split_one_variable)
+count_exceedances = memoize(AQ_limits.count_exceedances)
+
+class _NotInFile(Exception):
+    """
+        The variable can't be got from the file, so the user has to be asked
+        for another (which isn't memoised).
+    """
+    pass
+
+def _select_one_variable(variablename, filename):
+    all_data = source_AQ_data.open_csv(filename)
+    if variablename not in all_data.columns and \
+        variablename not in AQ_derived.available(all_data.columns):
+        raise _NotInFile(variablename)
+    return source_AQ_data.split_one_variable(all_data, variablename), \
+        variablename
+_select_one_variable = memoize(_select_one_variable,
+    'source_AQ_data.select_one_variable')
+
+def select_one_variable(variablename = 'species', filename = 'ExampleData'):
+    """
+        source_AQ_data.select_one_variable, remembered. The example data is
+        looked up by its real path (so it is keyed by the file's modification
+        time and size), and a missing file or variable is passed to the
+        original, which reports it or asks for another, without memoising.
+    """
+    if filename == 'ExampleData':
+        filename = os.path.join(os.path.dirname(os.path.abspath(
+            source_AQ_data.__file__)), 'Example_Data',
+            'edinburgh_st_leonards_2015_2017.csv')
+    if os.path.isfile(filename):
+        try:
+            return _select_one_variable(variablename, filename)
+        except _NotInFile:
+            pass
+    return source_AQ_data.select_one_variable(variablename, filename)
+
+def _limits(species, database):
+    return AQ_limits.AQ_limits(species)
+_limits = memoize(_limits, 'AQ_limits.AQ_limits')
+
+def limits(species):
+    """
+        AQ_limits.AQ_limits(species), remembered. The limits database file is
+        part of the key, so editing it gives new limits.
+    """
+    database = os.path.join(os.path.dirname(os.path.abspath(
+        AQ_limits.__file__)), 'AQ_limits_database.csv')
+    return _limits(species, database)
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
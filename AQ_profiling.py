@@ -0,0 +1,222 @@
+#==============================================================================
+# Lightweight timing of the processing stages (reading the csv, fixing the
+# times, splitting the status, filtering, binning, making figures...).
+# Turned off by default and costs next to nothing when off. Turn it on with
+# the environment variable EDINBURGH_AQ_PROFILE=1 or in code with:
+#       with AQ_profiling.profiling():
+#           ...
+#       AQ_profiling.summary()
+# If EDINBURGH_AQ_PROFILE_LOG is set to a filename (or log_file is given to
+# profiling()) each stage is also written to that file as a line of JSON.
+# Function names:
+#   stage(name, rows)
+#   profiling(log_file)
+#   enable(log_file)
+#   disable()
+#   get_records()
+#   reset()
+#   summary()
+#==============================================================================
+# Uses modules:
+# os, time, json, resource, threading, contextlib
+import os
+import time
+import json
+import resource
+import threading
+from contextlib import contextmanager
+#==============================================================================
+
+# Module state. Stage records are kept in a list in the order they finish.
+_enabled = os.environ.get('EDINBURGH_AQ_PROFILE', '') not in ('', '0')
+_log_file = os.environ.get('EDINBURGH_AQ_PROFILE_LOG') or None
+_records = []
+_lock = threading.Lock()
+_PAGE_SIZE = resource.getpagesize()
+
+class _NullStage(object):
+    """
+        What stage() gives back when profiling is off. Does nothing, and
+        ignores anything set on it (eg. the number of rows).
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    """
+        Times one run of a stage and records it when it finishes. The number
+        of rows processed can be set on it inside the with block.
+    """
+    def __init__(self, name, rows = None):
+        super(_Stage, self).__init__()
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.memory_start = _memory_mb()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self.start
+        record = {'stage': self.name,
+                  'seconds': seconds,
+                  'rows': self.rows,
+                  'memory_mb': _memory_mb() - self.memory_start,
+                  'time': self.start}
+        _add_record(record)
+        return False
+
+def _memory_mb():
+    """
+        The current resident memory of the process in megabytes. Uses
+        /proc where it exists (Linux), otherwise the peak memory.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 1048576.
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def _add_record(record):
+    """
+        Keep a finished stage and write it to the log file if there is one.
+    """
+    with _lock:
+        _records.append(record)
+        if _log_file is not None:
+            with open(_log_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+def stage(name, rows = None):
+    """
+        Use as a with block around a stage of processing, eg:
+            with AQ_profiling.stage('open_csv.read_csv') as st:
+                df = pd.read_csv(...)
+                st.rows = len(df)
+        Function IN:
+            name (REQUIRED, STRING):
+                Name of the stage. Use 'function.step' so the summary groups
+                them.
+            rows (OPTIONAL, INTEGER):
+                Number of rows processed, if known at the start.
+        Function OUT:
+            A context manager. Does nothing if profiling is off.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, rows)
+
+def enable(log_file = None):
+    """
+        Turn profiling on. Optionally also write each stage to a JSON lines
+        file.
+    """
+    global _enabled, _log_file
+    _enabled = True
+    if log_file is not None:
+        _log_file = log_file
+
+def disable():
+    """
+        Turn profiling off. Records already made are kept.
+    """
+    global _enabled
+    _enabled = False
+
+@contextmanager
+def profiling(log_file = None, clear = True):
+    """
+        Profile everything inside a with block, eg:
+            with AQ_profiling.profiling():
+                plot_with_plotly.hourly_box_plots(filename, 'Ozone')
+            AQ_profiling.summary()
+        Function IN:
+            log_file (OPTIONAL, STRING):
+                Also write the stages to this JSON lines file.
+            clear (OPTIONAL, BOOLEAN):
+                Forget earlier records first. Default = True
+        Function OUT:
+            The list of records (filled in as stages finish).
+    """
+    global _enabled, _log_file
+    previous = (_enabled, _log_file)
+    if clear:
+        reset()
+    enable(log_file)
+    try:
+        yield _records
+    finally:
+        _enabled, _log_file = previous
+
+def get_records():
+    """
+        Returns a copy of the list of stage records. Each is a dictionary of
+        stage, seconds, rows, memory_mb (change in resident memory) and time
+        (when it started).
+    """
+    with _lock:
+        return list(_records)
+
+def reset():
+    """
+        Forget all the stage records.
+    """
+    with _lock:
+        del _records[:]
+
+def summary(records = None, print_out = True):
+    """
+        Summarise the records by stage: number of calls, total and mean time,
+        total rows, rows per second and total memory change.
+        Function IN:
+            records (OPTIONAL, LIST):
+                The records to summarise. Default is all kept so far.
+            print_out (OPTIONAL, BOOLEAN):
+                Print a table of the summary. Default = True
+        Function OUT:
+            stages:
+                List of dictionaries, one per stage, slowest first.
+    """
+    if records is None:
+        records = get_records()
+
+    stages = {}
+    for record in records:
+        totals = stages.setdefault(record['stage'], {'stage': record['stage'],
+            'calls': 0, 'seconds': 0., 'rows': 0, 'memory_mb': 0.})
+        totals['calls'] += 1
+        totals['seconds'] += record['seconds']
+        totals['rows'] += record['rows'] or 0
+        totals['memory_mb'] += record['memory_mb']
+
+    stages = sorted(stages.values(), key = lambda s: s['seconds'],
+        reverse = True)
+    total_seconds = sum(s['seconds'] for s in stages) or 1.
+    for totals in stages:
+        totals['mean_seconds'] = totals['seconds'] / totals['calls']
+        totals['rows_per_second'] = totals['rows'] / totals['seconds'] \
+            if totals['seconds'] > 0 else 0.
+        totals['percent'] = 100. * totals['seconds'] / total_seconds
+
+    if print_out:
+        print '%-40s %6s %10s %6s %12s %12s %10s' % ('Stage', 'Calls',
+            'Seconds', '%', 'Rows', 'Rows/s', 'Mem MB')
+        for s in stages:
+            print '%-40s %6d %10.4f %6.1f %12d %12.0f %10.1f' % (s['stage'],
+                s['calls'], s['seconds'], s['percent'], s['rows'],
+                s['rows_per_second'], s['memory_mb'])
+
+    return stages
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,392 @@
+#==============================================================================
+# Streaming approximate quantiles. Limits that can be exceeded a number of
+# times a year are the same as a high percentile of the year's data (eg. 18
+# hourly NO2 exceedances out of 8760 hours is the 99.79th percentile). Rather
+# than sort decades of data for every site, the data is fed through a small
+# sketch (KLL, Karnin, Lang & Liberty 2016) that keeps a few hundred values
+# and answers any quantile with a bounded rank error. Sketches of different
+# sites or years can be merged into one. The largest values are also kept
+# exactly, so the high percentiles of the limits are exact rather than
+# approximate.
+# Class/Function names:
+#   QuantileSketch(k, seed, tail)
+#   allowance_percentile(per_year, periods_per_year)
+#   limit_percentile(species, limit_name)
+#   yearly_sketches(timeseries, k)
+#   sketch_csv(filename, species, chunksize, k)
+#   network_sketches(filenames, species, chunksize, k)
+#   sketch_table(sketches, percentiles)
+#==============================================================================
+# Uses modules:
+# os, numpy, pandas, quick_tools, source_AQ_data, AQ_limits
+import os
+import numpy as np
+import pandas as pd
+import quick_tools
+import source_AQ_data
+import AQ_limits
+#==============================================================================
+
+# Number of largest values each sketch keeps exactly. Enough for the
+# 99.79th percentile (18 hours a year) of 50 years of hourly data.
+TAIL_SIZE = 1000
+
+# Number of periods in a year for each type of limit
+PERIODS_PER_YEAR = {'15MIN': 35040, 'HOURLY': 8760, '8HOURLY': 365,
+    'DAILY': 365}
+
+class QuantileSketch(object):
+    """
+        A mergeable sketch of a stream of numbers that gives approximate
+        quantiles. Values are kept in levels; a value at level h stands for
+        2**h of the original values. When a level is full it is sorted and
+        every other value (starting at random) moves up a level.
+        The memory used grows only with log(n). With the default k = 200
+        the error in the rank of a middle quantile is up to about 1
+        percentage point on 20 years of hourly data (0.3 at the 99.79th
+        percentile), and with k = 1000 about 0.2.
+        That is as big as a limit's whole allowance (0.21% for 18 hours a
+        year), so the largest tail values are also kept exactly, and
+        quantiles that fall among them are exact. The 99.79th percentile of
+        n values is exact while 0.0021 * n is no more than tail.
+        Instance variables:
+            k - accuracy parameter (size of the top level)
+            tail - number of largest values kept exactly
+            n - number of values seen
+            min, max - smallest and largest values seen
+            levels - list of numpy arrays of the values kept at each level
+            top - the largest values seen (up to tail of them, unsorted)
+    """
+    def __init__(self, k = 200, seed = None, tail = TAIL_SIZE):
+        super(QuantileSketch, self).__init__()
+        self.k = int(k)
+        self.tail = int(tail)
+        self.n = 0
+        self.min = np.nan
+        self.max = np.nan
+        self.levels = [np.empty(0)]
+        self.top = np.empty(0)
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return 'QuantileSketch(k=%d, n=%d, stored=%d)' % (self.k, self.n,
+            self.stored)
+
+    @property
+    def stored(self):
+        """
+            Number of values kept in the sketch.
+        """
+        return sum(len(level) for level in self.levels)
+
+    def _capacity(self, level):
+        # Lower levels are smaller, shrinking by 2/3 each step down
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (2. / 3.) ** depth)), 8)
+
+    def update(self, values):
+        """
+            Add values to the sketch. NaNs are ignored.
+            Function IN:
+                values (REQUIRED, LIST, ARRAY or PANDAS Series):
+                    The values to add.
+            Function OUT:
+                self
+        """
+        values = quick_tools.as_float_array(values)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.n += len(values)
+        self.min = np.nanmin([self.min, values.min()])
+        self.max = np.nanmax([self.max, values.max()])
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self._compress()
+        self._keep_top(values)
+        return self
+
+    def merge(self, other):
+        """
+            Add another sketch into this one (eg. another site or year).
+            Function IN:
+                other (REQUIRED, QuantileSketch):
+                    The sketch to add. It isn't changed.
+            Function OUT:
+                self
+        """
+        if other.n == 0:
+            return self
+        # Only the top of the smaller tail is known for both
+        self.tail = min(self.tail, other.tail)
+        self._keep_top(other.top)
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate((self.levels[level], values))
+        self.n += other.n
+        self.min = np.nanmin([self.min, other.min])
+        self.max = np.nanmax([self.max, other.max])
+        self._compress()
+        return self
+
+    def _keep_top(self, values):
+        """
+            Add values to the exact tail, keeping only the largest.
+        """
+        top = np.concatenate((self.top, values))
+        if len(top) > self.tail:
+            top = np.partition(top, len(top) - self.tail)[len(top) -
+                self.tail:]
+        self.top = top
+
+    @classmethod
+    def merged(cls, sketches, k = None, seed = None):
+        """
+            A new sketch made by merging a list of sketches.
+        """
+        sketches = list(sketches)
+        if k is None:
+            k = max([s.k for s in sketches] or [200])
+        tail = min([s.tail for s in sketches] or [TAIL_SIZE])
+        result = cls(k, seed, tail)
+        for sketch in sketches:
+            result.merge(sketch)
+        return result
+
+    def _compress(self):
+        """
+            Compact any level that is over its capacity, from the bottom up.
+        """
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                values = np.sort(values)
+                # An odd value out stays at this level
+                if len(values) % 2:
+                    keep, values = values[-1:], values[:-1]
+                else:
+                    keep = np.empty(0)
+                promoted = values[self.rng.randint(2)::2]
+                self.levels[level] = keep
+                self.levels[level + 1] = np.concatenate(
+                    (self.levels[level + 1], promoted))
+            level += 1
+
+    def _weighted(self):
+        """
+            All the kept values sorted, with their cumulative weights.
+        """
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(v), 2. ** h)
+            for h, v in enumerate(self.levels)])
+        order = np.argsort(values, kind = 'mergesort')
+        return values[order], np.cumsum(weights[order])
+
+    def quantile(self, q):
+        """
+            The approximate value below which a fraction q of the data lies.
+            Function IN:
+                q (REQUIRED, FLOAT or ARRAY):
+                    Fraction(s) between 0 and 1.
+            Function OUT:
+                The value(s). NaN if the sketch is empty.
+        """
+        q = np.asarray(q, dtype = np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+        values, cumulative = self._weighted()
+        target = q * cumulative[-1]
+        index = np.minimum(np.searchsorted(cumulative, target, side = 'left'),
+            len(values) - 1)
+        result = values[index]
+        # The top values are known exactly: the answer is the value with
+        # ceil(q * n) values at or below it
+        from_top = self.n - np.clip(np.ceil(q * self.n), 1, self.n)
+        exact = from_top < len(self.top)
+        if np.any(exact):
+            top = np.sort(self.top)[::-1]
+            result = np.where(exact, top[np.minimum(from_top,
+                len(top) - 1).astype(np.int64)], result)
+        # The ends are known exactly
+        result = np.where(q <= 0, self.min, np.where(q >= 1, self.max, result))
+        return result if q.ndim else float(result)
+
+    def percentile(self, p):
+        """
+            The same as quantile but with p in percent (0-100).
+        """
+        return self.quantile(np.asarray(p, dtype = np.float64) / 100.)
+
+    def rank(self, value):
+        """
+            The approximate fraction of the data less than or equal to value.
+        """
+        if self.n == 0:
+            return np.nan
+        # Above the smallest of the top values, everything bigger is in the
+        # top so the rank is exact
+        if len(self.top) and value >= self.top.min():
+            return 1. - np.sum(self.top > value) / float(self.n)
+        values, cumulative = self._weighted()
+        index = np.searchsorted(values, value, side = 'right')
+        counted = np.where(index > 0, cumulative[np.maximum(index - 1, 0)], 0.)
+        return counted / cumulative[-1]
+
+def allowance_percentile(per_year, periods_per_year = 8760):
+    """
+        The percentile equal to a limit that can be exceeded per_year times
+        (eg 18 times in 8760 hours is the 99.79th percentile).
+        Function IN:
+            per_year (REQUIRED, INTEGER):
+                Number of exceedances allowed per year.
+            periods_per_year (OPTIONAL, INTEGER):
+                Number of hours, days etc. in a year. Default = 8760 (hours)
+        Function OUT:
+            percentile:
+                Percentile (0-100).
+    """
+    return 100. * (1. - float(per_year) / periods_per_year)
+
+def limit_percentile(species, limit_name = 'UK_HOURLY'):
+    """
+        The percentile equal to a limit in the AQ_limits database, from the
+        number of exceedances allowed per year. These are far enough up the
+        tail that a QuantileSketch gives them exactly (see its tail).
+        Function IN:
+            species (REQUIRED, STRING):
+                The species (eg NO2).
+            limit_name (OPTIONAL, STRING):
+                The limit (eg UK_HOURLY, EU_DAILY). Default = UK_HOURLY
+        Function OUT:
+            percentile:
+                Percentile (0-100), or None if the limit has no allowance.
+    """
+    limits = AQ_limits.AQ_limits(species)
+    if limits.species_name is None or limit_name not in limits.limit_type:
+        return None
+    per_year = limits.limit_type[limit_name].per_year
+    period = limit_name.split('_', 1)[1]
+    if per_year is None or period not in PERIODS_PER_YEAR:
+        return None
+    return allowance_percentile(per_year, PERIODS_PER_YEAR[period])
+
+def yearly_sketches(timeseries, k = 200, seed = 0):
+    """
+        A sketch for each year of a timeseries. Times are hour ending, so
+        the 24:00 hour on the 31st of December is in the year it ends.
+        Function IN:
+            timeseries (REQUIRED, PANDAS SERIES):
+                The values with a datetime index.
+            k (OPTIONAL, INTEGER):
+                Sketch accuracy parameter. Default = 200
+            seed (OPTIONAL, INTEGER):
+                Seed for the sketches' random numbers.
+        Function OUT:
+            sketches:
+                Dictionary of year and QuantileSketch.
+    """
+    values = quick_tools.as_float_array(timeseries)
+    years = (pd.DatetimeIndex(timeseries.index) -
+        pd.Timedelta(1, 'h')).year.values
+    sketches = {}
+    for year in np.unique(years):
+        sketches[int(year)] = QuantileSketch(k, seed).update(
+            values[years == year])
+    return sketches
+
+def sketch_csv(filename, species, chunksize = 100000, k = 200, seed = 0,
+    verified = True):
+    """
+        Yearly sketches of a species read from a DEFRA CSV file in chunks,
+        so the whole file is never held in memory.
+        Function IN:
+            filename (REQUIRED, STRING):
+                The CSV file.
+            species (REQUIRED, STRING):
+                The species column (eg 'Nitrogen dioxide').
+            chunksize (OPTIONAL, INTEGER):
+                Number of rows to read at a time. Default = 100000
+            k, seed (OPTIONAL, INTEGER):
+                As for yearly_sketches.
+            verified (OPTIONAL, BOOLEAN):
+                Use just the verified data (True, default) or all of it.
+        Function OUT:
+            sketches:
+                Dictionary of year and QuantileSketch.
+    """
+    sketches = {}
+    for all_data in source_AQ_data.iter_csv_chunks(filename, chunksize):
+        species_data = source_AQ_data.split_one_variable(all_data, species)
+        if verified:
+            species_data = source_AQ_data.purge_unverified(species_data,
+                species)
+        for year, sketch in yearly_sketches(species_data[species], k,
+            seed).items():
+            if year in sketches:
+                sketches[year].merge(sketch)
+            else:
+                sketches[year] = sketch
+    return sketches
+
+def network_sketches(filenames, species, chunksize = 100000, k = 200,
+    seed = 0, verified = True):
+    """
+        Yearly sketches for a number of sites (files). Files without the
+        species are left out, with a message saying so.
+        Function IN:
+            filenames (REQUIRED, LIST of STRINGS):
+                The csv files. The site name is the file name without the
+                directory or extension.
+            species, chunksize, k, seed, verified (OPTIONAL):
+                As for sketch_csv.
+        Function OUT:
+            sketches:
+                Dictionary of (site, year) and QuantileSketch.
+    """
+    sketches = {}
+    for filename in filenames:
+        site = os.path.splitext(os.path.basename(filename))[0]
+        try:
+            site_sketches = sketch_csv(filename, species, chunksize, k, seed,
+                verified)
+        except KeyError as error:
+            print "Couldn't sketch %s for %s: %s not in the file" % (species,
+                site, error)
+            continue
+        for year, sketch in site_sketches.items():
+            sketches[(site, year)] = sketch
+    return sketches
+
+def sketch_table(sketches, percentiles = (50, 90, 98, 99.79)):
+    """
+        A table of percentiles from a dictionary of sketches, with a row for
+        all of them merged together.
+        Function IN:
+            sketches (REQUIRED, DICTIONARY):
+                Sketches keyed by eg year, (site, year) or site.
+            percentiles (OPTIONAL, LIST of FLOATS):
+                Percentiles (0-100) to give.
+        Function OUT:
+            table:
+                pandas DataFrame with a row per key plus 'All', columns of
+                the count and each percentile.
+    """
+    keys = sorted(sketches.keys())
+    rows = [sketches[key] for key in keys] + \
+        [QuantileSketch.merged(sketches.values())]
+    index = [str(key) if isinstance(key, tuple) else key for key in keys] + \
+        ['All']
+    table = pd.DataFrame([sketch.percentile(percentiles) for sketch in rows],
+        index = index, columns = ['P%g' % p for p in percentiles])
+    table.insert(0, 'Count', [sketch.n for sketch in rows])
+    return table
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
@@ -0,0 +1,475 @@
+#==============================================================================
+# A long running local HTTP service that answers JSON queries on DEFRA csv
+# files. Parsed files and query results are kept in memory (least recently
+# used are dropped first) so repeated queries don't re-read or re-compute.
+# Start it with:
+#       python -m Edinburgh_AQ.AQ_service serve --data-dir /path/to/csvs
+# and query it, eg:
+#       http://localhost:8765/slice?file=site.csv&species=Ozone&start=2016-01-01
+#       http://localhost:8765/average?file=site.csv&species=Ozone&hours=8
+#       http://localhost:8765/exceedances?file=site.csv&species=Nitrogen dioxide
+#       http://localhost:8765/windrose?file=site.csv
+#       http://localhost:8765/stats
+# Load test it with:
+#       python -m Edinburgh_AQ.AQ_service loadtest --self-test
+# Class/Function names:
+#   AQQueryService(data_dir)
+#   make_server(service, host, port)
+#   serve(data_dir, host, port)
+#   load_test(base_url, paths, num_requests, concurrency)
+#==============================================================================
+# Uses modules:
+# os, sys, time, json, threading, argparse, tempfile, shutil, urllib, urllib2,
+# urlparse, BaseHTTPServer, SocketServer, numpy, source_AQ_data, AQ_cache,
+# AQ_averages, AQ_limits, AQ_derived, windrose
+import os
+import sys
+import time
+import json
+import threading
+import argparse
+import tempfile
+import shutil
+import urllib
+import urllib2
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import numpy as np
+import source_AQ_data
+from AQ_cache import LRUCache
+import AQ_averages
+import AQ_limits
+import AQ_derived
+from windrose import windrose
+#==============================================================================
+
+class QueryError(Exception):
+    """
+        A query that can't be answered (eg. missing file or species). Sent
+        back to the client as a 400 error.
+    """
+    pass
+
+class AQQueryService(object):
+    """
+        Answers queries on the csv files in data_dir. Parsed files are kept in
+        a dataset cache keyed by the file name, modification time and size (so
+        a changed file is read again), and answers are kept in a result cache.
+        Each query method takes a dictionary of parameters (strings, as they
+        come from the URL) and returns something that can be sent as JSON.
+    """
+    def __init__(self, data_dir, max_datasets = 8, max_results = 1024):
+        super(AQQueryService, self).__init__()
+        self.data_dir = os.path.abspath(data_dir)
+        self.datasets = LRUCache(max_datasets)
+        self.results = LRUCache(max_results)
+        self.started = time.time()
+        self.queries = 0
+        # The server answers queries in threads, so count them under a lock
+        self.queries_lock = threading.Lock()
+        # Stop two threads reading the same file at once
+        self.load_lock = threading.Lock()
+        self.handlers = {'species': self.query_species,
+                         'slice': self.query_slice,
+                         'average': self.query_average,
+                         'exceedances': self.query_exceedances,
+                         'windrose': self.query_windrose}
+
+    def query(self, name, params):
+        """
+            Run the named query, using the result cache if it can.
+        """
+        if name == 'stats':
+            return self.stats()
+        if name not in self.handlers:
+            raise QueryError('Unknown query %s. Choose from: %s' % (name,
+                ', '.join(sorted(self.handlers.keys() + ['stats']))))
+        with self.queries_lock:
+            self.queries += 1
+
+        filename, version = self._file_version(params)
+        key = (name, version, tuple(sorted(params.items())))
+        found, result = self.results.get(key)
+        if not found:
+            result = self.handlers[name](filename, params)
+            self.results.put(key, result)
+        return result
+
+    def stats(self):
+        """
+            Cache statistics and how long the service has been running.
+        """
+        with self.queries_lock:
+            queries = self.queries
+        return {'uptime_seconds': time.time() - self.started,
+                'queries': queries,
+                'dataset_cache': self.datasets.stats(),
+                'result_cache': self.results.stats()}
+
+    def _file_version(self, params):
+        """
+            Get the full path of the requested file (which must be inside
+            data_dir) and a key that changes if the file does.
+        """
+        if 'file' not in params:
+            raise QueryError('No file given')
+        filename = os.path.abspath(os.path.join(self.data_dir, params['file']))
+        if not filename.startswith(self.data_dir + os.sep):
+            raise QueryError('File must be inside the data directory')
+        if not os.path.exists(filename):
+            raise QueryError("%s doesn't exist" % params['file'])
+        info = os.stat(filename)
+        return filename, (filename, info.st_mtime, info.st_size)
+
+    def load(self, filename):
+        """
+            Get the parsed file from the dataset cache, reading it if needed.
+        """
+        version = self._file_version({'file': filename})[1]
+        found, all_data = self.datasets.get(version)
+        if not found:
+            with self.load_lock:
+                # Another thread may have read it while we waited
+                found, all_data = self.datasets.get(version)
+                if not found:
+                    all_data = source_AQ_data.open_csv(filename)
+                    self.datasets.put(version, all_data)
+        return all_data
+
+    def species_data(self, filename, params):
+        """
+            The data for the species in the parameters, with just the verified
+            data unless verified=0.
+        """
+        all_data = self.load(filename)
+        species = params.get('species')
+        if species not in all_data.columns and \
+            species not in AQ_derived.available(all_data.columns):
+            raise QueryError('Species %r not in file. Availble: %s' % (species,
+                ', '.join(source_AQ_data.list_species(all_data.columns) +
+                AQ_derived.available(all_data.columns))))
+        species_data = source_AQ_data.split_one_variable(all_data, species)
+        if params.get('verified', '1') != '0':
+            species_data = source_AQ_data.purge_unverified(species_data,
+                species)
+        return species_data, species
+
+    def query_species(self, filename, params):
+        all_data = self.load(filename)
+        return {'species': source_AQ_data.list_species(all_data.columns),
+                'derived': AQ_derived.available(all_data.columns)}
+
+    def query_slice(self, filename, params):
+        """
+            The data between start and end (either can be left out).
+        """
+        species_data, species = self.species_data(filename, params)
+        species_data = species_data.sort_index()
+        species_data = species_data.loc[params.get('start'):params.get('end')]
+        return {'species': species,
+                'unit': _first_unit(species_data),
+                'times': _times_to_json(species_data.index),
+                'values': _values_to_json(species_data[species].values),
+                'verified': species_data['Verified'].tolist()}
+
+    def query_average(self, filename, params):
+        """
+            Running means (hours=N) or period means (period=D, W, M or A).
+            Times are hour ending, so the 24:00 hour counts in the period
+            it ends. Period means can have a bootstrap confidence interval
+            (confidence=0.95, optionally block=hours and bootstrap=N).
+        """
+        species_data, species = self.species_data(filename, params)
+        series = species_data[species]
+        if 'confidence' in params:
+            if params.get('period') not in ['D', 'M', 'A']:
+                raise QueryError('confidence needs period to be D, M or A')
+            confidence = _float_param(params, 'confidence', 0.95)
+            if not 0. < confidence < 1.:
+                raise QueryError('confidence must be between 0 and 1')
+            averaged = AQ_averages.period_mean(series, params['period'],
+                confidence = confidence,
+                block_length = _int_param(params, 'block', 24),
+                num_bootstrap = _int_param(params, 'bootstrap', 1000))
+            averaged = averaged.loc[params.get('start'):params.get('end')]
+            return {'species': species,
+                    'unit': _first_unit(species_data),
+                    'periods': averaged.index.tolist(),
+                    'values': _values_to_json(averaged['Mean'].values),
+                    'lower': _values_to_json(averaged['Lower'].values),
+                    'upper': _values_to_json(averaged['Upper'].values)}
+        if 'period' in params:
+            if params['period'] not in ['D', 'W', 'M', 'A']:
+                raise QueryError('period must be one of D, W, M or A')
+            # Back to the start of each hour before grouping by period
+            averaged = series.shift(-1, freq = 'H').resample(
+                params['period']).mean()
+        else:
+            hours = _int_param(params, 'hours', 8)
+            averaged = AQ_averages.running_custom_hour(series, hours = hours)
+        averaged = averaged.loc[params.get('start'):params.get('end')]
+        return {'species': species,
+                'unit': _first_unit(species_data),
+                'times': _times_to_json(averaged.index),
+                'values': _values_to_json(averaged.values)}
+
+    def query_exceedances(self, filename, params):
+        """
+            Exceedances per year of a limit (limit=UK_HOURLY etc.). The limit
+            species can be given as limit_species if the file's name for it
+            isn't recognised.
+        """
+        species_data, species = self.species_data(filename, params)
+        limit_name = params.get('limit', 'UK_HOURLY')
+        exceedances = AQ_limits.count_exceedances(species_data[species],
+            params.get('limit_species', species), limit_name)
+        if exceedances is None:
+            raise QueryError('No %s limit for %s' % (limit_name, species))
+        return {'species': species,
+                'limit': limit_name,
+                'years': exceedances.index.tolist(),
+                'exceedances': exceedances['Exceedances'].astype(int).tolist(),
+                'allowed': exceedances['Allowed'].astype(int).tolist(),
+                'broken': exceedances['Broken'].astype(bool).tolist()}
+
+    def query_windrose(self, filename, params):
+        """
+            Windrose bins from the modelled wind speed and direction.
+        """
+        direction_bins = _int_param(params, 'direction_bins', 8)
+        speed_bin_size = _int_param(params, 'speed_bin_size', 4)
+        if direction_bins not in [4, 8, 16]:
+            raise QueryError('direction_bins must be 4, 8 or 16')
+        if speed_bin_size < 1:
+            raise QueryError('speed_bin_size must be at least 1')
+        all_data = self.load(filename)
+        for name in ['Modelled Wind Speed', 'Modelled Wind Direction']:
+            if name not in all_data.columns:
+                raise QueryError('%s not in file' % name)
+        wind = all_data[['Date and Time', 'Modelled Wind Speed',
+            'Modelled Wind Direction']].set_index('Date and Time')
+        wind = wind.loc[params.get('start'):params.get('end')].dropna()
+        windrose_data, speed_bin_names = windrose(wind['Modelled Wind Speed'],
+            wind['Modelled Wind Direction'],
+            direction_bin_size = direction_bins,
+            speed_bin_size = speed_bin_size)
+        return {'directions': windrose_data['Direction'],
+                'speed_bins': speed_bin_names,
+                'percentages': [windrose_data[n] for n in speed_bin_names]}
+
+def _int_param(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        raise QueryError('%s must be a whole number' % name)
+
+def _float_param(params, name, default):
+    try:
+        return float(params.get(name, default))
+    except ValueError:
+        raise QueryError('%s must be a number' % name)
+
+def _first_unit(species_data):
+    units = species_data['Unit'].dropna()
+    return units.iloc[0] if len(units) else None
+
+def _times_to_json(index):
+    return [t for t in index.strftime('%Y-%m-%dT%H:%M:%S')]
+
+def _values_to_json(values):
+    # JSON has no NaN so missing values are sent as null
+    values = np.asarray(values, dtype = float)
+    return [None if np.isnan(v) else v for v in values.tolist()]
+
+class _QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Turns GET requests into service queries: the path is the query name
+        and the URL parameters are its parameters.
+    """
+    service = None
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        name = url.path.strip('/')
+        params = dict(urlparse.parse_qsl(url.query))
+        try:
+            body = json.dumps(self.service.query(name, params))
+            status = 200
+        except QueryError as error:
+            body = json.dumps({'error': str(error)})
+            status = 400
+        except Exception as error:
+            body = json.dumps({'error': 'Internal error: %s' % error})
+            status = 500
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the terminal quiet - the stats query shows what's going on
+        pass
+
+class _ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def make_server(service, host = '127.0.0.1', port = 8765):
+    """
+        Make (but don't start) a threaded HTTP server for the service. Use
+        port 0 to get any free port (server.server_address has the port).
+    """
+    # A handler class for this service
+    class QueryHandler(_QueryHandler):
+        pass
+    QueryHandler.service = service
+    return _ThreadedServer((host, port), QueryHandler)
+
+def serve(data_dir, host = '127.0.0.1', port = 8765, max_datasets = 8,
+    max_results = 1024):
+    """
+        Run the service until it is stopped (Ctrl-C).
+        Function IN:
+            data_dir (REQUIRED, STRING):
+                Directory holding the csv files. Only files in here can be
+                queried.
+            host (OPTIONAL, STRING):
+                Address to listen on. Default is only this machine.
+            port (OPTIONAL, INTEGER):
+                Port to listen on. Default = 8765
+            max_datasets, max_results (OPTIONAL, INTEGER):
+                Sizes of the dataset and result caches.
+    """
+    service = AQQueryService(data_dir, max_datasets = max_datasets,
+        max_results = max_results)
+    server = make_server(service, host, port)
+    print 'Serving %s on http://%s:%d/' % (data_dir, host,
+        server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def load_test(base_url, paths, num_requests = 500, concurrency = 8):
+    """
+        Send requests to a running service from several threads at once and
+        time them.
+        Function IN:
+            base_url (REQUIRED, STRING):
+                eg http://127.0.0.1:8765
+            paths (REQUIRED, LIST of STRINGS):
+                The query paths (with parameters) to send. They are sent in
+                turn until num_requests have been sent.
+            num_requests (OPTIONAL, INTEGER):
+                Total number of requests. Default = 500
+            concurrency (OPTIONAL, INTEGER):
+                Number of threads sending requests. Default = 8
+        Function OUT:
+            results:
+                Dictionary of requests, errors, seconds, requests per second
+                and latency percentiles in milliseconds.
+    """
+    latencies = []
+    errors = [0]
+    counter = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if counter[0] >= num_requests:
+                    return
+                path = paths[counter[0] % len(paths)]
+                counter[0] += 1
+            start = time.time()
+            try:
+                urllib2.urlopen(base_url + path).read()
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target = worker) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+
+    latencies_ms = np.array(latencies) * 1000.
+    results = {'requests': num_requests, 'errors': errors[0],
+        'seconds': seconds, 'requests_per_second': num_requests / seconds}
+    for q in [50, 90, 99]:
+        results['p%d_ms' % q] = np.percentile(latencies_ms, q) \
+            if len(latencies_ms) else np.nan
+    return results
+
+def _default_paths(filename, species = 'Nitrogen dioxide'):
+    """
+        A mix of queries on one file for load testing.
+    """
+    quoted_file = urllib.quote(filename)
+    quoted_species = urllib.quote(species)
+    common = 'file=%s&species=%s' % (quoted_file, quoted_species)
+    return ['/slice?%s&start=2015-06-01&end=2015-06-08' % common,
+            '/average?%s&hours=8&start=2015-06-01&end=2015-07-01' % common,
+            '/average?%s&period=M' % common,
+            '/exceedances?%s&limit=UK_HOURLY' % common,
+            '/windrose?file=%s' % quoted_file,
+            '/species?file=%s' % quoted_file]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Edinburgh_AQ query service')
+    commands = parser.add_subparsers(dest = 'command')
+    serve_parser = commands.add_parser('serve', help = 'Run the service')
+    serve_parser.add_argument('--data-dir', required = True)
+    serve_parser.add_argument('--host', default = '127.0.0.1')
+    serve_parser.add_argument('--port', type = int, default = 8765)
+    load_parser = commands.add_parser('loadtest', help = 'Load test a service')
+    load_parser.add_argument('--url', default = 'http://127.0.0.1:8765')
+    load_parser.add_argument('--file', help = 'csv file (in the data dir)')
+    load_parser.add_argument('--species', default = 'Nitrogen dioxide')
+    load_parser.add_argument('--requests', type = int, default = 500)
+    load_parser.add_argument('--concurrency', type = int, default = 8)
+    load_parser.add_argument('--self-test', action = 'store_true',
+        help = 'Start a service on synthetic data and load test it')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.data_dir, args.host, args.port)
+        sys.exit()
+
+    directory = None
+    if args.self_test:
+        import synthetic_AQ_data
+        directory = tempfile.mkdtemp(prefix = 'AQ_service_')
+        synthetic_AQ_data.write_defra_csv(os.path.join(directory,
+            'synthetic.csv'), years = 3)
+        server = make_server(AQQueryService(directory), port = 0)
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        args.url = 'http://127.0.0.1:%d' % server.server_address[1]
+        args.file = 'synthetic.csv'
+    elif args.file is None:
+        parser.error('--file is needed unless using --self-test')
+
+    try:
+        results = load_test(args.url, _default_paths(args.file, args.species),
+            num_requests = args.requests, concurrency = args.concurrency)
+        for name in sorted(results):
+            print '%-22s %s' % (name, results[name])
+        print json.dumps(json.loads(urllib2.urlopen(args.url +
+            '/stats').read()), indent = 1, sort_keys = True)
+    finally:
+        if directory is not None:
+            server.shutdown()
+            shutil.rmtree(directory)
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
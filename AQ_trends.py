@@ -0,0 +1,506 @@
+#==============================================================================
+# Long term trends from monthly means: the Theil-Sen slope (median of the
+# slopes between every pair of months) and the Mann-Kendall test (is there a
+# trend at all). Done naively both look at every pair, n**2 of them. Here the
+# pairs are counted level by level as in a merge sort (the number of pairs
+# that go up minus the number that go down, as in Knight's method for
+# Kendall's tau). Each of the log(n) levels uses a numpy sort rather than a
+# merge, so a count takes n log(n)**2 steps, not Knight's n log(n). The
+# median slope is found by halving a range of slopes, counting how many pair
+# slopes are below the middle each time, until the wanted slope is the only
+# one left in the range (about 20 to 30 counts, or about 45 when many pairs
+# share the slope, as with rounded data). It is then read off a pair of
+# points that swap order across the range, so it is exact.
+# Many series (and bootstrap copies of a series) are counted together in one
+# go.
+# Confidence intervals on the slope come from a moving block bootstrap of the
+# residuals, so months next to each other stay together (they're not
+# independent).
+# Function names:
+#   monthly_means(timeseries, min_capture)
+#   deseasonalise(monthly)
+#   mann_kendall(y)
+#   sen_slope(y, x)
+#   trend(monthly, num_bootstrap, block_length, confidence, seed)
+#   site_trends(filename, species, deseasonalised, ...)
+#   network_trends(filenames, species, processes, ...)
+#==============================================================================
+# Uses modules:
+# os, math, multiprocessing, numpy, pandas, quick_tools, source_AQ_data,
+# AQ_profiling
+import os
+import math
+import multiprocessing
+import numpy as np
+import pandas as pd
+import quick_tools
+import source_AQ_data
+import AQ_profiling
+#==============================================================================
+
+TREND_COLUMNS = ['Slope', 'Lower', 'Upper', 'Intercept', 'Tau', 'S', 'Z', 'P',
+    'Months']
+
+def monthly_means(timeseries, min_capture = 0.75):
+    """
+        Monthly means of an hourly series. Times are hour ending, so the
+        24:00 hour on the last day of a month counts in that month.
+        Function IN:
+            timeseries (REQUIRED, PANDAS SERIES):
+                Hourly values with a datetime index.
+            min_capture (OPTIONAL, FLOAT):
+                Fraction of the hours in a month that need data for the mean
+                to be used (NaN if not). Default = 0.75
+        Function OUT:
+            monthly:
+                pandas Series of the means, indexed by the start of the month.
+    """
+    values = quick_tools.as_float_array(timeseries)
+    starts = pd.DatetimeIndex(timeseries.index) - pd.Timedelta(1, 'h')
+    series = pd.Series(values, index = starts)
+    grouped = series.resample('MS')
+    means = grouped.mean()
+    hours = means.index.days_in_month * 24
+    means[grouped.count().values < min_capture * hours] = np.nan
+    return means
+
+def deseasonalise(monthly):
+    """
+        Take the seasonal cycle out of monthly means: each month has the
+        average of its calendar month (over all years) taken off, and the
+        overall mean put back, so the result is still a concentration.
+        Function IN:
+            monthly (REQUIRED, PANDAS SERIES):
+                Monthly means (eg from monthly_means).
+        Function OUT:
+            deseasonalised:
+                pandas Series, same index.
+    """
+    month = monthly.index.month
+    seasonal = monthly.groupby(month).transform('mean')
+    return monthly - seasonal + monthly.mean()
+
+def _pair_counts(values, series_id, position):
+    """
+        For every series, count the pairs of points (i before j) where the
+        value goes up and where it goes down. Ties count as neither.
+        The points of all series are given together: values, the series
+        each belongs to and its position in the series (0, 1, 2...).
+        Works as a merge sort: at each level the points in the right half of
+        a block are looked up in the sorted left half, which is done for all
+        blocks and series with one sort and a searchsorted.
+        Returns the up and down counts per series (arrays).
+    """
+    num_series = int(series_id.max()) + 1 if len(series_id) else 0
+    up = np.zeros(num_series, dtype = np.int64)
+    down = np.zeros(num_series, dtype = np.int64)
+    if len(values) == 0:
+        return up, down
+    # Integer ranks (ties share a rank) so keys can be packed in an int64
+    ranks = np.unique(values, return_inverse = True)[1].astype(np.int64)
+    num_ranks = int(ranks.max()) + 2
+    length = int(position.max()) + 1
+
+    width = 1
+    while width < length:
+        block = position // width
+        pair = series_id * (length // (2 * width) + 1) + block // 2
+        keys = pair * num_ranks + ranks
+        left = block % 2 == 0
+        right = ~left
+        sorted_left = np.sort(keys[left])
+
+        # Where each block's left half starts and ends in sorted_left
+        left_counts = np.bincount(pair[left], minlength = pair.max() + 1)
+        ends = np.cumsum(left_counts)
+        start = (ends - left_counts)[pair[right]]
+        end = ends[pair[right]]
+        below = np.searchsorted(sorted_left, keys[right], side = 'left')
+        not_above = np.searchsorted(sorted_left, keys[right], side = 'right')
+        # Left points below a right point are pairs going up
+        up += np.bincount(series_id[right], weights = below - start,
+            minlength = num_series).astype(np.int64)
+        down += np.bincount(series_id[right], weights = end - not_above,
+            minlength = num_series).astype(np.int64)
+        width *= 2
+
+    return up, down
+
+def _flatten(y):
+    """
+        Points of a 2D array (series x time) without the NaNs, as values,
+        series numbers, positions and times (column numbers).
+    """
+    valid = ~np.isnan(y)
+    series_id, column = np.nonzero(valid)
+    counts = valid.sum(axis = 1)
+    position = np.arange(len(series_id)) - np.repeat(np.cumsum(counts) -
+        counts, counts)
+    return y[valid], series_id, position, column, counts
+
+def mann_kendall(y):
+    """
+        The Mann-Kendall trend test of one or more series.
+        Function IN:
+            y (REQUIRED, LIST, ARRAY or PANDAS SERIES):
+                Values in time order (NaNs are left out). A 2D array is
+                taken as a series per row.
+        Function OUT:
+            results:
+                Dictionary of arrays (or numbers for one series): S (pairs
+                going up minus going down), Tau (Kendall's tau-b), Z and P (the
+                two sided p value, without allowing for autocorrelation).
+    """
+    y = np.asarray(quick_tools.as_float_array(y) if np.ndim(y) == 1 else y,
+        dtype = np.float64)
+    single = y.ndim == 1
+    y = np.atleast_2d(y)
+    values, series_id, position, column, n = _flatten(y)
+    up, down = _pair_counts(values, series_id, position)
+    up = np.pad(up, (0, len(y) - len(up)), 'constant')
+    down = np.pad(down, (0, len(y) - len(down)), 'constant')
+    s = (up - down).astype(np.float64)
+
+    # Ties in the values reduce the variance of S. Runs of equal values
+    # (in each series) after one sort are the ties.
+    order = np.lexsort((values, series_id))
+    sorted_values, sorted_id = values[order], series_id[order]
+    change = np.ones(len(values), dtype = bool)
+    change[1:] = (sorted_values[1:] != sorted_values[:-1]) | \
+        (sorted_id[1:] != sorted_id[:-1])
+    starts = np.flatnonzero(change)
+    ties = np.diff(np.append(starts, len(values))).astype(np.float64)
+    tie_id = sorted_id[starts]
+    tie_variance = np.bincount(tie_id, weights = ties * (ties - 1) *
+        (2 * ties + 5), minlength = len(y))
+    tie_pairs = np.bincount(tie_id, weights = ties * (ties - 1) / 2.,
+        minlength = len(y))
+    n = n.astype(np.float64)
+    pairs = n * (n - 1) / 2.
+    variance = (n * (n - 1) * (2 * n + 5) - tie_variance) / 18.
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        tau = s / np.sqrt(pairs * (pairs - tie_pairs))
+        z = (s - np.sign(s)) / np.sqrt(variance)
+    p = np.array([np.nan if np.isnan(value) else
+        1. - math.erf(abs(value) / math.sqrt(2.)) for value in z])
+
+    results = {'S': s, 'Tau': tau, 'Z': z, 'P': p}
+    if single:
+        results = dict((key, float(value[0])) for key, value in
+            results.items())
+    return results
+
+def _slope_in_range(values, series_id, times, lower, upper):
+    """
+        A pair slope of each series in (lower, upper], exact. Sorted by
+        y - lower * x, the pairs whose slope is in the range are the ones
+        that swap order by y - upper * x, and one of them is next to each
+        other. If no pair swaps, the slope is upper itself.
+    """
+    above_lower = values - lower[series_id] * times
+    above_upper = values - upper[series_id] * times
+    order = np.lexsort((above_upper, above_lower, series_id))
+    first, second = order[:-1], order[1:]
+    swapped = np.flatnonzero((series_id[first] == series_id[second]) &
+        (above_upper[second] < above_upper[first]))
+    slopes = upper.copy()
+    if len(swapped):
+        found, pick = np.unique(series_id[first][swapped],
+            return_index = True)
+        a, b = first[swapped[pick]], second[swapped[pick]]
+        slopes[found] = (values[b] - values[a]) / (times[b] - times[a])
+    return slopes
+
+def _order_statistic_slopes(y, x, ranks, tolerance = 1e-12,
+    max_iterations = 100, num_samples = 400, seed = 0):
+    """
+        The rank'th smallest pair slope (1 = smallest) of each series (row of
+        y, at times x), found by halving a range of slopes until it is the
+        only pair slope left in the range, then read off exactly. The number
+        of pair slopes above s is the number of pairs going up in y - s * x,
+        which is counted for all the series at once.
+    """
+    values, series_id, position, column, n = _flatten(y)
+    times = x[column]
+    num_series = len(y)
+    pairs = n * (n - 1) // 2
+
+    def at_most(slopes, active = None):
+        # Number of pair slopes <= slopes (one per series). Only the active
+        # series are counted (the rest are given as 0).
+        points = slice(None) if active is None else active[series_id]
+        shifted = values[points] - slopes[series_id[points]] * times[points]
+        up = _pair_counts(shifted, series_id[points], position[points])[0]
+        return pairs - np.pad(up, (0, num_series - len(up)), 'constant')
+
+    # Every slope is inside +/- (range of y) / (smallest time step)
+    with np.errstate(invalid = 'ignore'):
+        spread = np.nanmax(y, axis = 1) - np.nanmin(y, axis = 1)
+    smallest_step = np.min(np.diff(x)) if len(x) > 1 else 1.
+    # The size of a typical slope, to say how closely to find it
+    duration = x[-1] - x[0] if len(x) > 1 else 1.
+    scale = np.maximum(spread / duration, 1e-12)
+    # Slopes above lower and at most upper (lower is moved down a bit so
+    # none is equal to it)
+    lower = -spread / smallest_step - scale
+    upper = spread / smallest_step
+    done = (pairs < 1) | ~np.isfinite(spread)
+    lower[done] = upper[done] = 0.
+    below_lower = np.zeros(num_series, dtype = np.int64)
+    below_upper = pairs.astype(np.int64)
+
+    # Start from a much smaller range taken from a sample of the pairs, if
+    # the answer turns out to be inside it
+    if len(values) and num_samples > 0:
+        rng = np.random.RandomState(seed)
+        offsets = np.cumsum(n) - n
+        picks = (rng.random_sample((2, num_series, num_samples)) *
+            n[:, np.newaxis]).astype(np.int64) + offsets[:, np.newaxis]
+        picks = np.minimum(picks, len(values) - 1)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            sampled = (values[picks[1]] - values[picks[0]]) / \
+                (times[picks[1]] - times[picks[0]])
+        sampled[~np.isfinite(sampled)] = np.nan
+        sampled = np.sort(sampled, axis = 1)
+        num_valid = np.sum(~np.isnan(sampled), axis = 1)
+        fraction = ranks / np.maximum(pairs, 1).astype(np.float64)
+        margin = 4. * np.sqrt(fraction * (1. - fraction) /
+            np.maximum(num_valid, 1)) + 1. / np.maximum(num_valid, 1)
+        rows = np.arange(num_series)
+        low = sampled[rows, np.clip(((fraction - margin) * num_valid).astype(
+            np.int64), 0, num_samples - 1)]
+        high = sampled[rows, np.clip(((fraction + margin) * num_valid).astype(
+            np.int64), 0, num_samples - 1)]
+        usable = ~done & (num_valid > 0) & np.isfinite(low) & \
+            np.isfinite(high) & (low < high)
+        low = np.where(usable, low, lower)
+        high = np.where(usable, high, upper)
+        below_low, below_high = at_most(low), at_most(high)
+        usable &= (below_low < ranks) & (below_high >= ranks)
+        lower = np.where(usable, low, lower)
+        upper = np.where(usable, high, upper)
+        below_lower = np.where(usable, below_low, below_lower)
+        below_upper = np.where(usable, below_high, below_upper)
+
+    for iteration in range(max_iterations):
+        # Series are done when only the wanted slope is left in the range
+        # (or the range is too small to tell slopes apart)
+        active = ~done & (below_upper - below_lower > 1) & \
+            (upper - lower > tolerance * scale)
+        if not active.any():
+            break
+        middle = np.where(active, 0.5 * (lower + upper), upper)
+        below_middle = np.where(active, at_most(middle, active), below_upper)
+        enough = below_middle >= ranks
+        upper = np.where(enough, middle, upper)
+        lower = np.where(enough, lower, middle)
+        below_upper = np.where(enough, below_middle, below_upper)
+        below_lower = np.where(enough, below_lower, below_middle)
+
+    slopes = _slope_in_range(values, series_id, times, lower, upper)
+    slopes[done] = np.nan
+    return slopes
+
+def sen_slope(y, x = None, tolerance = 1e-12):
+    """
+        The Theil-Sen slope (median slope between all pairs of points) of one
+        or more series, without working out all the pair slopes.
+        Function IN:
+            y (REQUIRED, LIST, ARRAY or PANDAS SERIES):
+                Values in time order (NaNs are left out). A 2D array is taken
+                as a series per row, all at the same times.
+            x (OPTIONAL, ARRAY):
+                Increasing times of the values (eg decimal years). Default is
+                0, 1, 2...
+            tolerance (OPTIONAL, FLOAT):
+                Pair slopes closer than this (relative to the range of y
+                over the range of x) aren't told apart, so one of them may be
+                given. Default = 1e-12
+        Function OUT:
+            slope, intercept:
+                The slope (per unit of x) and the intercept (median of
+                y - slope * x). Arrays if y is 2D.
+    """
+    y = np.asarray(quick_tools.as_float_array(y) if np.ndim(y) == 1 else y,
+        dtype = np.float64)
+    single = y.ndim == 1
+    y = np.atleast_2d(y)
+    if x is None:
+        x = np.arange(y.shape[1], dtype = np.float64)
+    x = np.asarray(x, dtype = np.float64)
+
+    with AQ_profiling.stage('sen_slope', y.size):
+        # For an even number of pairs the median is the mean of the middle two
+        n = (~np.isnan(y)).sum(axis = 1)
+        pairs = n * (n - 1) // 2
+        both = np.vstack((y, y))
+        ranks = np.concatenate(((pairs + 1) // 2, pairs // 2 + 1))
+        middle = _order_statistic_slopes(both, x, ranks, tolerance)
+        slope = 0.5 * (middle[:len(y)] + middle[len(y):])
+        with np.errstate(invalid = 'ignore'):
+            intercept = np.nanmedian(y - slope[:, np.newaxis] * x, axis = 1) \
+                if y.shape[1] else np.full(len(y), np.nan)
+
+    if single:
+        return float(slope[0]), float(intercept[0])
+    return slope, intercept
+
+def _block_bootstrap(residuals, num_bootstrap, block_length, rng):
+    """
+        Moving block bootstrap copies of a 1D series of residuals (NaNs are
+        dropped first). Returns an array, copy x time.
+    """
+    residuals = residuals[~np.isnan(residuals)]
+    n = len(residuals)
+    block_length = max(1, min(block_length, n))
+    num_blocks = int(np.ceil(float(n) / block_length))
+    starts = rng.randint(0, n - block_length + 1, (num_bootstrap, num_blocks))
+    indices = (starts[:, :, np.newaxis] + np.arange(block_length)).reshape(
+        num_bootstrap, -1)[:, :n]
+    return residuals[indices]
+
+def trend(monthly, num_bootstrap = 200, block_length = 12, confidence = 0.95,
+    seed = 0):
+    """
+        The trend of a monthly series: Sen slope with a block bootstrap
+        confidence interval, and the Mann-Kendall test.
+        Function IN:
+            monthly (REQUIRED, PANDAS SERIES):
+                Monthly means (eg from monthly_means, deseasonalised).
+            num_bootstrap (OPTIONAL, INTEGER):
+                Number of bootstrap copies. 0 to skip the interval.
+                Default = 200
+            block_length (OPTIONAL, INTEGER):
+                Length (months) of the resampled blocks. Default = 12
+            confidence (OPTIONAL, FLOAT):
+                Confidence level of the interval. Default = 0.95
+            seed (OPTIONAL, INTEGER):
+                Seed for the resampling.
+        Function OUT:
+            result:
+                Dictionary with Slope (per year), Lower, Upper, Intercept,
+                Tau, S, Z, P and Months (used).
+    """
+    y = np.asarray(monthly.values, dtype = np.float64)
+    index = pd.DatetimeIndex(monthly.index)
+    # Decimal years
+    x = index.year + (index.month - 1) / 12.
+    valid = ~np.isnan(y)
+    y, x = y[valid], np.asarray(x[valid], dtype = np.float64)
+
+    result = dict((column, np.nan) for column in TREND_COLUMNS)
+    result['Months'] = len(y)
+    if len(y) < 3:
+        return result
+
+    result.update(mann_kendall(y))
+    slope, intercept = sen_slope(y, x)
+    result['Slope'] = slope
+    result['Intercept'] = intercept
+
+    if num_bootstrap > 0:
+        rng = np.random.RandomState(seed)
+        fitted = intercept + slope * x
+        copies = fitted + _block_bootstrap(y - fitted, num_bootstrap,
+            block_length, rng)
+        with AQ_profiling.stage('trend.bootstrap', copies.size):
+            slopes = sen_slope(copies, x)[0]
+        alpha = 100. * (1. - confidence) / 2.
+        result['Lower'], result['Upper'] = np.nanpercentile(slopes,
+            [alpha, 100. - alpha])
+    return result
+
+def site_trends(filename, species = None, deseasonalised = True,
+    min_capture = 0.75, verified = True, **kwargs):
+    """
+        Trends of all (or some of) the species in one file.
+        Function IN:
+            filename (REQUIRED, STRING):
+                The csv file.
+            species (OPTIONAL, LIST of STRINGS):
+                The species. Default is all of them. Species not in the file
+                are left out.
+            deseasonalised (OPTIONAL, BOOLEAN):
+                Take the seasonal cycle out first. Default = True
+            min_capture (OPTIONAL, FLOAT):
+                As for monthly_means.
+            verified (OPTIONAL, BOOLEAN):
+                Use just the verified data (True, default) or all of it.
+            Anything else is passed on to trend.
+        Function OUT:
+            table:
+                pandas DataFrame, a row per species and the columns of trend.
+    """
+    all_data = source_AQ_data.open_csv(filename)
+    file_species = source_AQ_data.list_species(all_data.columns)
+    if species is not None:
+        file_species = [s for s in species if s in file_species]
+
+    rows = []
+    for name in file_species:
+        species_data = source_AQ_data.split_one_variable(all_data, name)
+        if verified:
+            species_data = source_AQ_data.purge_unverified(species_data, name)
+        monthly = monthly_means(species_data[name], min_capture)
+        if deseasonalised:
+            monthly = deseasonalise(monthly)
+        rows.append(trend(monthly, **kwargs))
+    return pd.DataFrame(rows, index = pd.Index(file_species, name = 'Species'),
+        columns = TREND_COLUMNS)
+
+def _site_trends_task(arguments):
+    """
+        Runs site_trends for network_trends (a pool needs a function at the
+        top of the module). Errors are returned rather than stopping the
+        other sites.
+    """
+    filename, species, kwargs = arguments
+    try:
+        return filename, site_trends(filename, species, **kwargs)
+    except Exception as error:
+        return filename, error
+
+def network_trends(filenames, species = None, processes = None, **kwargs):
+    """
+        Trends of every site and species, with the sites shared out over a
+        pool of processes.
+        Function IN:
+            filenames (REQUIRED, LIST of STRINGS):
+                The csv files. The site name is the file name without the
+                directory or extension.
+            species (OPTIONAL, LIST of STRINGS):
+                The species. Default is all of them.
+            processes (OPTIONAL, INTEGER):
+                Number of processes. Default is the number of CPUs. 1 runs
+                everything here without a pool.
+            Anything else is passed on to site_trends and trend.
+        Function OUT:
+            table:
+                pandas DataFrame indexed by site and species, with the
+                columns of trend.
+    """
+    tasks = [(filename, species, kwargs) for filename in filenames]
+    if processes == 1 or len(tasks) < 2:
+        results = [_site_trends_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_site_trends_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    tables = {}
+    for filename, table in results:
+        site = os.path.splitext(os.path.basename(filename))[0]
+        if isinstance(table, Exception):
+            print "Couldn't get trends for %s: %s" % (site, table)
+            continue
+        tables[site] = table
+    if not tables:
+        return pd.DataFrame(columns = TREND_COLUMNS)
+    return pd.concat(tables, names = ['Site'], sort = False)
+
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
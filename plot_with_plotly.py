@@ -8,18 +8,28 @@
 #   hourly_box_plots()
 #==============================================================================
 # Uses modules:
-# datetime, numpy, pandas, plot.ly, source_AQ_data, windrose, quick_tools,
-# calendar
+# datetime, numpy, pandas, plot.ly (imported when plotting), source_AQ_data,
+# windrose, quick_tools, calendar, AQ_profiling, AQ_climatology
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 import source_AQ_data
-import plotly.plotly as py
-import plotly.graph_objs as go
 import quick_tools
 import calendar
+import AQ_profiling
+import AQ_climatology
 #==============================================================================
 
+def _import_plotly():
+    """
+        Import plot.ly. This is done when a plot is made rather than when the
+        module is imported as plot.ly is slow to import and not needed for
+        the data processing.
+    """
+    import plotly.plotly as py
+    import plotly.graph_objs as go
+    return py, go
+
 def timeseries_plot(species='None',filename = 'ExampleData', average = 'None',
     verified = True):
     """
@@ -37,6 +47,9 @@ def timeseries_plot(species='None',filename = 'ExampleData', average = 'None',
                 Choose whether to plot just verfied data or all data.
                 Default = True
     """
+    # Import plot.ly
+    py, go = _import_plotly()
+
     # Get the data for the species required. Also include the filename
     # if the filename is provided - use example data if not.
     # Also returns variable name (this might be changed slightly from user input)
@@ -46,21 +59,23 @@ def timeseries_plot(species='None',filename = 'ExampleData', average = 'None',
     if verified:
         species_data = source_AQ_data.purge_unverified(species_data, variablename)
 
-    # Set the data in a format the plot.ly needs to work
-    data = go.Scatter(x = species_data.index, y = species_data[variablename],
-        mode = 'markers')
-    data = [data]
+    with AQ_profiling.stage('timeseries_plot.figure', len(species_data)):
+        # Set the data in a format the plot.ly needs to work
+        data = go.Scatter(x = species_data.index, y = species_data[variablename],
+            mode = 'markers')
+        data = [data]
 
-    # Set the layout for the plot.ly graph
-    layout = go.Layout(
-        title = 'Concentration of ' + variablename + ' at Edinburgh St leonards',
-        xaxis = dict(title = 'Date and Time'),
-        yaxis = dict(title = variablename + ' ('+species_data['Unit'][0]+')'))
+        # Set the layout for the plot.ly graph
+        layout = go.Layout(
+            title = 'Concentration of ' + variablename + ' at Edinburgh St leonards',
+            xaxis = dict(title = 'Date and Time'),
+            yaxis = dict(title = variablename + ' ('+species_data['Unit'][0]+')'))
 
-    # Set the filename & combine data and layout
-    filename = '%s_timeseries' % variablename
-    fig = go.Figure(data = data, layout = layout)
-    py.plot(fig,filename = filename)
+        # Set the filename & combine data and layout
+        filename = '%s_timeseries' % variablename
+        fig = go.Figure(data = data, layout = layout)
+    with AQ_profiling.stage('timeseries_plot.plot'):
+        py.plot(fig,filename = filename)
 
     pass
 
@@ -72,6 +87,9 @@ def wind_rose_plot(filename = 'ExampleData'):
                 The filename of a csv file where this data is kept. If not
                 provided then uses the example file.
     """
+    # Import plot.ly
+    py, go = _import_plotly()
+
     # Import the windrose module
     from windrose import windrose
 
@@ -94,31 +112,33 @@ def wind_rose_plot(filename = 'ExampleData'):
         speed_bin_size = speed_bins)
 
 
-    # Make each circle of the windrose a "trace" for plot.ly
-    colours = quick_tools.get_colours_rgb(num_colours = len(speed_bin_names))
-    # Need to do it in reverse order so the larger ones don't cover the smaller
-    trace_dict = {}
-    finished_data = []
-    for x,sn in enumerate(reversed(speed_bin_names)):
-        trace_dict[sn] = go.Area(
-            r = windrose_data[sn],
-            t = windrose_data['Direction'],
-            name = sn,
-            marker = dict(color=colours[x]))
-
-        finished_data.append(trace_dict[sn])
-
-    # Set the layout options
-    layout = go.Layout(
-        title = 'Wind Speed Distribution at Edinburgh St Leonards',
-        font = dict(size = 16),
-        legend = dict(font = dict(size = 16)),
-        radialaxis = dict(ticksuffix = '%'),
-        orientation = 270)
-
-    filename = 'Wind Speed Distribution at Edinburgh St Leonards'
-    fig = go.Figure(data = finished_data, layout = layout)
-    py.plot(fig, filename = filename)
+    with AQ_profiling.stage('wind_rose_plot.figure'):
+        # Make each circle of the windrose a "trace" for plot.ly
+        colours = quick_tools.get_colours_rgb(num_colours = len(speed_bin_names))
+        # Need to do it in reverse order so the larger ones don't cover the smaller
+        trace_dict = {}
+        finished_data = []
+        for x,sn in enumerate(reversed(speed_bin_names)):
+            trace_dict[sn] = go.Area(
+                r = windrose_data[sn],
+                t = windrose_data['Direction'],
+                name = sn,
+                marker = dict(color=colours[x]))
+
+            finished_data.append(trace_dict[sn])
+
+        # Set the layout options
+        layout = go.Layout(
+            title = 'Wind Speed Distribution at Edinburgh St Leonards',
+            font = dict(size = 16),
+            legend = dict(font = dict(size = 16)),
+            radialaxis = dict(ticksuffix = '%'),
+            orientation = 270)
+
+        filename = 'Wind Speed Distribution at Edinburgh St Leonards'
+        fig = go.Figure(data = finished_data, layout = layout)
+    with AQ_profiling.stage('wind_rose_plot.plot'):
+        py.plot(fig, filename = filename)
 
     pass
 
@@ -138,6 +158,9 @@ def species_histogram(filename='ExampleData', species = 'None', verified = True,
             num_bins (OPTIONAL, INTEGER):
                 Choose the number of bins for the plot. Default = 50
     """
+    # Import plot.ly
+    py, go = _import_plotly()
+
     # Get the data for the species required. Also include the filename
     # if the filename is provided - use example data if not.
     # Also returns variable name (this might be changed slightly from user input)
@@ -147,17 +170,19 @@ def species_histogram(filename='ExampleData', species = 'None', verified = True,
     if verified:
         species_data = source_AQ_data.purge_unverified(species_data, variablename)
 
-    data = [go.Histogram(x = species_data[variablename],
-        nbinsx = num_bins)]
-    layout = go.Layout(
-        title = 'Histogram of %s concentration at Edinburgh St Leonards' % variablename,
-        yaxis = dict(title = 'Frequency'),
-        xaxis = dict(title = variablename + ' ' + species_data.Unit[0]),
-        showlegend = False)
+    with AQ_profiling.stage('species_histogram.figure', len(species_data)):
+        data = [go.Histogram(x = species_data[variablename],
+            nbinsx = num_bins)]
+        layout = go.Layout(
+            title = 'Histogram of %s concentration at Edinburgh St Leonards' % variablename,
+            yaxis = dict(title = 'Frequency'),
+            xaxis = dict(title = variablename + ' ' + species_data.Unit[0]),
+            showlegend = False)
 
-    fig = go.Figure(data = data, layout = layout)
+        fig = go.Figure(data = data, layout = layout)
     filename = 'Histogram of %s at Edinburgh St Leonards' % variablename
-    py.plot(fig, filename = filename)
+    with AQ_profiling.stage('species_histogram.plot'):
+        py.plot(fig, filename = filename)
 
     pass
 
@@ -177,6 +202,9 @@ def monthly_box_plots(filename = 'ExampleData', species='None',
                 Choose whether to use all the data (False) or just the verified
                 data (True). Default is True.
     """
+    # Import plot.ly
+    py, go = _import_plotly()
+
 
 
     # Get the data for the species required. Also include the filename
@@ -191,28 +219,30 @@ def monthly_box_plots(filename = 'ExampleData', species='None',
     # Get a list of months
     month_names = [calendar.month_name[x] for x in range(1,13)]
 
-    # Create dictionary with each month as a key containing all monthly data
-    monthly_dict = {}
-    for n,month in enumerate(month_names):
-        monthly_dict[month] = species_data.loc[species_data.index.month == (n + 1)]
-
-    # Create list to put in the plot.ly traces and combine them
-    # to send to plot.ly
-    box_data = []
-    for x, month in enumerate(month_names):
-        box_data.append( go.Box(
-            y = monthly_dict[month][variablename].values,
-            name = month))
-
-    layout = go.Layout(
-        yaxis = dict( title = variablename + ' ' + species_data.Unit[0]),
-        showlegend = False,
-        title = 'Monthly Averages for '+ variablename +' at Edinburgh St Leonards')
-
-    # Create filename and send to plot.ly
-    filename = 'Box Plot of Monthly Average %s' % variablename
-    fig = go.Figure(data = box_data, layout = layout)
-    py.plot(fig, filename = filename)
+    with AQ_profiling.stage('monthly_box_plots.group', len(species_data)):
+        # Split the data into months in one go
+        labels, monthly_groups = AQ_climatology.grouped_values(
+            species_data[variablename], 'month')
+
+    with AQ_profiling.stage('monthly_box_plots.figure'):
+        # Create list to put in the plot.ly traces and combine them
+        # to send to plot.ly
+        box_data = []
+        for x, month in enumerate(month_names):
+            box_data.append( go.Box(
+                y = monthly_groups[x],
+                name = month))
+
+        layout = go.Layout(
+            yaxis = dict( title = variablename + ' ' + species_data.Unit[0]),
+            showlegend = False,
+            title = 'Monthly Averages for '+ variablename +' at Edinburgh St Leonards')
+
+        # Create filename and send to plot.ly
+        filename = 'Box Plot of Monthly Average %s' % variablename
+        fig = go.Figure(data = box_data, layout = layout)
+    with AQ_profiling.stage('monthly_box_plots.plot'):
+        py.plot(fig, filename = filename)
 
     pass
 
@@ -232,6 +262,9 @@ def hourly_box_plots(filename = 'ExampleData', species = 'None', verified = True
                 Choose whether to use all the data (False) or just the verified
                 data (True). Default is True.
     """
+    # Import plot.ly
+    py, go = _import_plotly()
+
 
     # Get the data for the species required. Also include the filename
     # if the filename is provided - use example data if not.
@@ -245,29 +278,31 @@ def hourly_box_plots(filename = 'ExampleData', species = 'None', verified = True
     # Get a list of hours
     hour_names = [x for x in range(24)]
 
-    # Create dictionary with each month as a key containing all monthly data
-    hourly_dict = {}
-    for n,hour in enumerate(hour_names):
-        hourly_dict[hour] = species_data.loc[species_data.index.hour == (n)]
-
-    # Create list to put in the plot.ly traces and combine them
-    # to send to plot.ly
-    box_data = []
-    for x, hour in enumerate(hour_names):
-        box_data.append( go.Box(
-            y = hourly_dict[hour][variablename].values,
-            name = str(hour).zfill(2)))
-
-    layout = go.Layout(
-        yaxis = dict( title = variablename + ' ' + species_data.Unit[0]),
-        xaxis = dict( title = 'Hour of the Day'),
-        showlegend = False,
-        title = 'Hourly Averages for '+ variablename +' at Edinburgh St Leonards')
-
-    # Create filename and send to plot.ly
-    filename = 'Box Plot of Hourly Average %s' % variablename
-    fig = go.Figure(data = box_data, layout = layout)
-    py.plot(fig, filename = filename)
+    with AQ_profiling.stage('hourly_box_plots.group', len(species_data)):
+        # Split the data into hours of the day in one go
+        labels, hourly_groups = AQ_climatology.grouped_values(
+            species_data[variablename], 'hour')
+
+    with AQ_profiling.stage('hourly_box_plots.figure'):
+        # Create list to put in the plot.ly traces and combine them
+        # to send to plot.ly
+        box_data = []
+        for x, hour in enumerate(hour_names):
+            box_data.append( go.Box(
+                y = hourly_groups[x],
+                name = str(hour).zfill(2)))
+
+        layout = go.Layout(
+            yaxis = dict( title = variablename + ' ' + species_data.Unit[0]),
+            xaxis = dict( title = 'Hour of the Day'),
+            showlegend = False,
+            title = 'Hourly Averages for '+ variablename +' at Edinburgh St Leonards')
+
+        # Create filename and send to plot.ly
+        filename = 'Box Plot of Hourly Average %s' % variablename
+        fig = go.Figure(data = box_data, layout = layout)
+    with AQ_profiling.stage('hourly_box_plots.plot'):
+        py.plot(fig, filename = filename)
 
 
     pass
@@ -5,12 +5,16 @@
 #   round_nearest(num_in)
 #   round_up(num_in)
 #   get_colours_rgb(num_colours)
-#  convert_to_pandas()
+#   convert_to_pandas()
+#   as_float_array(data)
+#   as_datetime_index(date_and_time)
+#   normalise_timeseries(data, date_and_time)
+#   normal_quantile(probability)
 #==============================================================================
 # Uses modules:
-# math
+# math, numpy, pandas, brewer2mpl (imported when colours are needed)
 import math
-import brewer2mpl
+import numpy as np
 import pandas as pd
 #==============================================================================
 
@@ -59,6 +63,8 @@ def get_colours_rgb(num_colours = 8):
                 RGB string.
     """
 
+    # Only import brewer2mpl here as its only needed for plotting
+    import brewer2mpl
     bmap = brewer2mpl.get_map('Blues', 'Sequential', num_colours)
     colour_array = []
     # Loop through all the colours and make them a string
@@ -73,8 +79,11 @@ def get_colours_rgb(num_colours = 8):
 def convert_to_pandas(data,date_and_time='None'):
     """
             Converts the given data into a pandas DataFrame for ease of use later.
+            NumPy arrays and pandas Series are wrapped without copying where
+            possible, and times that are already datetime64 (or epoch integers)
+            are not re-parsed.
         Function IN:
-            data(REQUIRED, LIST or ARRAY(INT or FLOAT):
+            data(REQUIRED, LIST or ARRAY(INT or FLOAT) or PANDAS Series):
                 The data to be made into the pandas DataFrame. Usually a series
                 of concentration.
             date_and_time(OPTIONAL, DATETIME OR STRING):
@@ -86,21 +95,127 @@ def convert_to_pandas(data,date_and_time='None'):
                 A pandas dataframe of the concentration. Ideally with the index
                 being datetime.
     """
-    # Test if a datetime is given, if not then don't include it!
-    if date_and_time == 'None':
-        new_dataframe = pd.DataFrame(data)
+    # Get the values as a float array and the time axis (if there is one)
+    values, index = normalise_timeseries(data, date_and_time)
 
-    else:
-        # Create the data frame with given variables
-        new_dataframe = pd.DataFrame({'Data':data,'date_and_time':date_and_time})
-        # Make the datetime variable into a datetime format. This might not work
-        # and will depend on the way the input was - pandas will complain.
-        new_dataframe['date_and_time'] = pd.to_datetime(new_dataframe['date_and_time'])
-        # Make the datetime variable the index of the DataFrame.
-        new_dataframe.index = new_dataframe.pop('date_and_time')
+    # Wrap the array as a single column. A 2D view of the array means pandas
+    # uses the same memory rather than copying it into a new block.
+    new_dataframe = pd.DataFrame(values.reshape(-1, 1), index = index,
+        columns = ['Data'], copy = False)
 
     return new_dataframe
 
+def as_float_array(data):
+    """
+        Returns the data as a contiguous 1D float64 numpy array. If the data is
+        already a float64 array (or a pandas Series backed by one) then the
+        same memory is returned and nothing is copied.
+        Function IN:
+            data (REQUIRED, LIST, ARRAY or PANDAS Series/DataFrame):
+                The numbers to convert. A DataFrame must have a single column.
+        Fucntion OUT:
+            values:
+                Contiguous numpy float64 array.
+    """
+    # Pull the underlying array out of pandas objects
+    if isinstance(data, pd.DataFrame):
+        if data.shape[1] != 1:
+            raise ValueError('Expected a single column, got %d' % data.shape[1])
+        data = data.iloc[:, 0]
+    if isinstance(data, (pd.Series, pd.Index)):
+        data = data.values
+
+    # asarray and ascontiguousarray only copy when they have to
+    values = np.ascontiguousarray(np.asarray(data, dtype = np.float64))
+    return values.reshape(-1)
+
+def as_datetime_index(date_and_time):
+    """
+        Returns the time axis as a pandas DatetimeIndex. Times that are already
+        datetime64 are used as they are, integer times are taken to be seconds
+        since the epoch (1970-01-01). Anything else (eg strings) is parsed by
+        pandas.
+        Function IN:
+            date_and_time (REQUIRED, LIST, ARRAY, PANDAS Series or Index):
+                The times to convert.
+        Fucntion OUT:
+            index:
+                A pandas DatetimeIndex.
+    """
+    if isinstance(date_and_time, pd.DatetimeIndex):
+        return date_and_time
+    if isinstance(date_and_time, (pd.Series, pd.Index)):
+        date_and_time = date_and_time.values
+
+    times = np.asarray(date_and_time)
+    # Already datetime64 - just make sure its in nanoseconds (no copy if it is)
+    if np.issubdtype(times.dtype, np.datetime64):
+        return pd.DatetimeIndex(times.astype('datetime64[ns]', copy = False))
+    # Integers are epoch seconds. Multiply up rather than parse.
+    if np.issubdtype(times.dtype, np.integer):
+        return pd.DatetimeIndex(
+            (times.astype(np.int64) * 1000000000).view('datetime64[ns]'))
+    # Strings, datetime objects etc. need pandas to work them out
+    return pd.DatetimeIndex(pd.to_datetime(times))
+
+def normalise_timeseries(data, date_and_time = 'None'):
+    """
+        Shared input handling for the analysis functions. Takes the data and
+        (optionally) its times in any of the accepted formats and returns a
+        float array ready for the number crunching and the time axis.
+        Function IN:
+            data (REQUIRED, LIST, ARRAY or PANDAS Series/DataFrame):
+                The concentrations (or any other numbers).
+            date_and_time (OPTIONAL, LIST, ARRAY, PANDAS Series or Index):
+                The times that go with the data. If left as 'None' then the
+                index of a pandas input is used (if it has a time index).
+        Fucntion OUT:
+            values:
+                Contiguous numpy float64 array of the data.
+            index:
+                pandas DatetimeIndex of the times, or None if no times given.
+    """
+    values = as_float_array(data)
+
+    if isinstance(date_and_time, str) and date_and_time == 'None':
+        # Use the time index of a pandas object if there is one
+        if isinstance(data, (pd.Series, pd.DataFrame)) and \
+            isinstance(data.index, pd.DatetimeIndex):
+            index = data.index
+        else:
+            index = None
+    else:
+        index = as_datetime_index(date_and_time)
+        if len(index) != len(values):
+            raise ValueError('Data has length %d but times have length %d'
+                % (len(values), len(index)))
+
+    return values, index
+
+def normal_quantile(probability):
+    """
+        The value of the standard normal distribution below which the given
+        fraction of it lies (eg 0.975 -> 1.96). Used for confidence intervals
+        without needing scipy.
+        Function IN:
+            probability (REQUIRED, FLOAT):
+                Between 0 and 1.
+        Fucntion OUT:
+            z:
+                The number of standard deviations.
+    """
+    if not 0. < probability < 1.:
+        raise ValueError('Probability must be between 0 and 1')
+    # Solve 0.5 * (1 + erf(z / sqrt(2))) = probability by halving the range
+    lower, upper = -40., 40.
+    for n in range(100):
+        middle = 0.5 * (lower + upper)
+        if 0.5 * (1. + math.erf(middle / math.sqrt(2.))) < probability:
+            lower = middle
+        else:
+            upper = middle
+    return 0.5 * (lower + upper)
+
 class DEFRA_site_info(object):
     """
         Return an object which has the information about the DEFRA sites.
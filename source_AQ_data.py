@@ -3,18 +3,27 @@
 # e.g. https://uk-air.defra.gov.uk/data/
 # Function Names:
 #       open_csv(filename, skip_num_rows = 4)
+#       iter_csv_chunks(filename, chunksize, skip_num_rows = 4)
+#       clean_data(df)
 #       select_one_variable(variablename, filename = 'ExampleData')
+#       split_one_variable(all_data, variablename)
 #       purge_unverified()
+#       list_species(all_df_variables)
 #       list_availble_species(all_df_variables)
 #==============================================================================
 # Uses modules:
-# datetime, numpy, pandas, os, sys
+# datetime, numpy, pandas, os, sys, AQ_profiling, AQ_derived
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 import os, sys
-import Edinburgh_AQ
+import AQ_profiling
+import AQ_derived
 #==============================================================================
+
+# Status code given to values filled in by AQ_gapfill (never verified)
+FILLED = 'F'
+
 def open_csv(filepath, skip_num_rows = 4):
     """
         This function reads in the CSV file and puts it into a pandas DataFrame.
@@ -36,34 +45,74 @@ def open_csv(filepath, skip_num_rows = 4):
     # Read straight into pandas data frame
     # Skipping first four lines
     # Needs datatype (dtype) as string since columns mix datatypes
-    df =  pd.read_csv(filepath, skiprows = int(skip_num_rows), dtype = str)
+    with AQ_profiling.stage('open_csv.read_csv') as st:
+        df =  pd.read_csv(filepath, skiprows = int(skip_num_rows), dtype = str)
+        st.rows = len(df)
+
+    return clean_data(df)
+
+def iter_csv_chunks(filepath, chunksize = 100000, skip_num_rows = 4):
+    """
+        Reads the CSV file a chunk of rows at a time, so files too big to
+        hold in memory can be worked through (eg. into a quantile sketch).
+        Each chunk is cleaned the same way as open_csv.
+        Function IN:
+            filepath (REQUIRED, STRING):
+                    path and name of csv file
+            chunksize (OPTIONAL, INTEGER):
+                    Number of rows in each chunk. Default = 100000
+            skip_num_rows(DEFAULT = 4, INTEGER):
+                    Number of lines to skip of the file, usually 4 for DEFRA
+        Function OUT:
+            Yields a DataFrame (as from open_csv) for each chunk.
+    """
+    reader = pd.read_csv(filepath, skiprows = int(skip_num_rows), dtype = str,
+        chunksize = int(chunksize))
+    for df in reader:
+        yield clean_data(df)
+
+def clean_data(df):
+    """
+        Cleans the raw strings read from a DEFRA CSV file: 'No data' becomes
+        NaN, the measurements become floats and a 'Date and Time' column is
+        added. Used by open_csv and iter_csv_chunks.
+        Function IN:
+            df (REQUIRED, PANDAS DATAFRAME):
+                The file as read by pandas with every column as strings.
+        Function OUT:
+            df:
+                The same DataFrame, cleaned.
+    """
     # Get all the column names
     column_names = df.columns
     # Loop through each column and repace 'No data' with NaNs
     # - easier to process into numbers not strings
-    for column in column_names:
-        df[column].replace('No data', np.nan, inplace = True)
-        # In the time column replace the hour 24 with zero
-        # This is needed for pandas to convert to a datetime type
-        # This creates an error in the data as the value for 00:00:00 in then
-        # placed at the beginning of the day instead of the end. ie. It should
-        # changed to 00:00:00 and the date moved forward one day. This is
-        # recitifed later.
-        if column == 'Time':
-            df[column].replace('24:00:00', '00:00:00', inplace = True)
-        # Find if the column is a status column or date/time column, if it
-        # is then go to next iteration, if its not then turn that value
-        # from a string into a float
-        if column.split('.')[0] == 'Status':
-            continue
-        elif column in ['Date', 'Time']:
-            continue
-        else:
-            df[column] = df[column].astype(float)
+    with AQ_profiling.stage('open_csv.clean_columns', len(df)):
+        for column in column_names:
+            df[column].replace('No data', np.nan, inplace = True)
+            # In the time column replace the hour 24 with zero
+            # This is needed for pandas to convert to a datetime type
+            # This creates an error in the data as the value for 00:00:00 in then
+            # placed at the beginning of the day instead of the end. ie. It should
+            # changed to 00:00:00 and the date moved forward one day. This is
+            # recitifed later.
+            if column == 'Time':
+                df[column].replace('24:00:00', '00:00:00', inplace = True)
+            # Find if the column is a status column or date/time column, if it
+            # is then go to next iteration, if its not then turn that value
+            # from a string into a float
+            if column.split('.')[0] == 'Status':
+                continue
+            elif column in ['Date', 'Time']:
+                continue
+            else:
+                df[column] = df[column].astype(float)
 
     # Add a new column using both date and time into a datetime format
-    df['Date and Time'] = pd.to_datetime(df['Date'] + ' ' + df['Time'])
-    df['Date and Time'] = df['Date and Time'].apply(add_day)
+    with AQ_profiling.stage('open_csv.parse_times', len(df)):
+        df['Date and Time'] = pd.to_datetime(df['Date'] + ' ' + df['Time'])
+    with AQ_profiling.stage('open_csv.add_day', len(df)):
+        df['Date and Time'] = df['Date and Time'].apply(add_day)
     return df
 
 def add_day(timestamp):
@@ -88,7 +137,8 @@ def select_one_variable(variablename = 'species', filename = 'ExampleData'):
         variable that is wanted for a particular analysis. eg. just NO2.
         Function IN:
             variablename(REQUIRED, STRING):
-                The name of the species (eg. Nitrogen dioxide)
+                The name of the species (eg. Nitrogen dioxide) or of a
+                derived variable (see AQ_derived)
             filename(OPTIONAL, STRING):
                 The path and name of the file. If not chosen then automatically
                 uses the example data.
@@ -100,8 +150,8 @@ def select_one_variable(variablename = 'species', filename = 'ExampleData'):
 
     # If the filename is not set, then use the example data provided
     if filename == 'ExampleData':
-        module_path = Edinburgh_AQ.__path__
-        filename = '%s/Example_Data/edinburgh_st_leonards_2015_2017.csv' % module_path[0]
+        module_path = os.path.dirname(os.path.abspath(__file__))
+        filename = '%s/Example_Data/edinburgh_st_leonards_2015_2017.csv' % module_path
         print "No file specified. Using data from: %s \n" % filename
 
     # Check to see whether file  & path exists
@@ -115,42 +165,72 @@ def select_one_variable(variablename = 'species', filename = 'ExampleData'):
 
     # Check if species requested is available, if not then call user to
     # pick one that is
-    if variablename not in all_data.columns:
+    if variablename not in all_data.columns and \
+        variablename not in AQ_derived.available(all_data.columns):
         variablename = list_availble_species(all_data.columns)
 
+    species_data = split_one_variable(all_data, variablename)
+
+    return species_data, variablename
+
+def split_one_variable(all_data, variablename):
+    """
+        Does the work of select_one_variable on data that has already been
+        read in with open_csv (so a file can be read once and split many
+        times).
+        Function IN:
+            all_data(REQUIRED, PANDAS DATAFRAME):
+                The data from open_csv.
+            variablename(REQUIRED, STRING):
+                The name of the species (eg. Nitrogen dioxide). Must be one
+                of the columns or a derived variable (see AQ_derived) that
+                can be worked out from them.
+        Function OUT:
+            species_data:
+                A reduced pandas DataFrame that contains the date and time,
+                species concentration, the unit, and the measurement validity
+    """
     date_and_time = all_data['Date and Time']
-    species_data = all_data[variablename]
-    # Need to find the location of the variablename in the list of
-    # DataFrame columns - because the one after it is the 'status' that
-    # related the that species
-    var_location = np.where(all_data.columns == variablename)
-    variable_status_name = all_data.columns[np.squeeze(var_location) + 1]
-    variable_status = all_data[variable_status_name]
+    if variablename not in all_data.columns and \
+        AQ_derived.is_derived(variablename):
+        # Worked out from other species (and cached)
+        species_data, variable_status = AQ_derived.evaluate(all_data,
+            variablename)
+    else:
+        species_data = all_data[variablename]
+        # Need to find the location of the variablename in the list of
+        # DataFrame columns - because the one after it is the 'status' that
+        # related the that species
+        var_location = np.where(all_data.columns == variablename)
+        variable_status_name = all_data.columns[np.squeeze(var_location) + 1]
+        variable_status = all_data[variable_status_name]
     # Split the status column into 'verified' and 'units'
     # First test to see how if there is any other info in this colum
     # (like '(TEOM FDMS)' - I assume this is an instrument name)
-    if len(variable_status[0].split()) > 2:
-        verified, units, other = variable_status.str.split(' ',2).str
-    else:
-        verified, units = variable_status.str.split(' ',1).str
+    with AQ_profiling.stage('select_one_variable.split_status',
+        len(variable_status)):
+        if len(variable_status.iloc[0].split()) > 2:
+            verified, units, other = variable_status.str.split(' ',2).str
+        else:
+            verified, units = variable_status.str.split(' ',1).str
 
-    # Put all the data back into one DataFrame
-    species_data = pd.DataFrame({'Date and Time':date_and_time,
-        variablename:species_data,'Unit':units,'Verified':verified})
+        # Put all the data back into one DataFrame
+        species_data = pd.DataFrame({'Date and Time':date_and_time,
+            variablename:species_data,'Unit':units,'Verified':verified})
 
-    # Make the DataFrame index be data and time instead of just a count
-    species_data.index = species_data.pop('Date and Time')
+        # Make the DataFrame index be data and time instead of just a count
+        species_data.index = species_data.pop('Date and Time')
 
-    return species_data, variablename
+    return species_data
 
 def purge_unverified(species_data, variablename):
     """
         This function removes any measurements that have not been verfied.
         This is indicated by a V (verfied), N (not verified), P (provisional),
-        or S (suspect).
+        or S (suspect), or F (filled in by AQ_gapfill).
         This will replace values of V with NaNs unless the variable is modelled
         (eg. wind speed) as all this is not verified because its not a physical
-        measurement.
+        measurement. Filled values are removed even if modelled.
         Function IN:
             The pandas DataFrame that is to be ammended
             (has to have 'Verified' column in DataFrame)
@@ -160,24 +240,24 @@ def purge_unverified(species_data, variablename):
 
     if variablename.split()[0] == 'Modelled':
         print "Using all data as this data is modelled."
-        return species_data
+        return species_data.loc[species_data['Verified'] != FILLED]
     else:
-        verfied_data = species_data.loc[species_data['Verified'] == 'V']
+        with AQ_profiling.stage('purge_unverified.filter', len(species_data)):
+            verfied_data = species_data.loc[species_data['Verified'] == 'V']
         return verfied_data
 
 
-def list_availble_species(all_df_variables):
+def list_species(all_df_variables):
     """
-        This functions lists all the species that are avaible for analysis.
-        It requires a user input to pick a species, or write the name.
-        The user may also exit the program if they wish.
+        Returns the species (ie not the date, time or status columns) from a
+        list of column names.
         Function IN:
             all_df_variables(REQUIRED, LIST):
                 A list of all the column (variable) names from the pandas
-                dataframe which will be cleaned and printed.
+                dataframe.
         Function OUT:
-            chosen_species:
-                The species chosen by the user as string (ie 'PM2.5')
+            species_list:
+                List of the species names.
     """
     # Create empty list for species you can choose to go into
     species_list = []
@@ -190,6 +270,24 @@ def list_availble_species(all_df_variables):
         if names.split('.')[0] in not_species:
             continue
         species_list.append(names)
+    return species_list
+
+def list_availble_species(all_df_variables):
+    """
+        This functions lists all the species that are avaible for analysis.
+        It requires a user input to pick a species, or write the name.
+        The user may also exit the program if they wish.
+        Function IN:
+            all_df_variables(REQUIRED, LIST):
+                A list of all the column (variable) names from the pandas
+                dataframe which will be cleaned and printed.
+        Function OUT:
+            chosen_species:
+                The species chosen by the user as string (ie 'PM2.5')
+    """
+    # Get all the chooseable species (and the variables derived from them)
+    species_list = list_species(all_df_variables) + \
+        AQ_derived.available(all_df_variables)
     # Print out all the options with corresponding number
     print 'Availble variables to choose from file: \n'
     for x, names in enumerate(species_list):
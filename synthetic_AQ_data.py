@@ -0,0 +1,212 @@
+#==============================================================================
+# Make synthetic air quality data in the same CSV format as the DEFRA files
+# (e.g. https://uk-air.defra.gov.uk/data/). Used for testing and benchmarking
+# as the real data isn't shipped with the package.
+# The data is random but repeatable (the same seed gives the same file).
+# Function names:
+#   make_defra_data(years, species, start_year, seed)
+#   write_defra_csv(filename, years, species, start_year, seed)
+#   make_example_data()
+#==============================================================================
+# Uses modules:
+# os, numpy, pandas, AQ_averages
+import os
+import numpy as np
+import pandas as pd
+from AQ_averages import rolling_mean
+#==============================================================================
+
+# Information for each species: unit, typical level, how much it changes
+# through the day and through the year, and any instrument information that
+# DEFRA put in the status column.
+SPECIES_INFO = {
+    'Nitric oxide':
+        {'unit': 'ugm-3', 'level': 15., 'diurnal': 0.8, 'seasonal': 0.5},
+    'Nitrogen dioxide':
+        {'unit': 'ugm-3', 'level': 30., 'diurnal': 0.4, 'seasonal': 0.3},
+    'Nitrogen oxides as nitrogen dioxide':
+        {'unit': 'ugm-3', 'level': 55., 'diurnal': 0.6, 'seasonal': 0.4},
+    'Ozone':
+        {'unit': 'ugm-3', 'level': 50., 'diurnal': -0.4, 'seasonal': -0.3},
+    'Sulphur dioxide':
+        {'unit': 'ugm-3', 'level': 3., 'diurnal': 0.3, 'seasonal': 0.3},
+    'Carbon monoxide':
+        {'unit': 'mgm-3', 'level': 0.3, 'diurnal': 0.4, 'seasonal': 0.4},
+    'PM10 particulate matter (Hourly measured)':
+        {'unit': 'ugm-3', 'level': 15., 'diurnal': 0.2, 'seasonal': 0.2,
+         'instrument': '(TEOM FDMS)'},
+    'PM2.5 particulate matter (Hourly measured)':
+        {'unit': 'ugm-3', 'level': 8., 'diurnal': 0.2, 'seasonal': 0.2,
+         'instrument': '(TEOM FDMS)'},
+    'Modelled Wind Direction':
+        {'unit': 'deg', 'modelled': True},
+    'Modelled Wind Speed':
+        {'unit': 'm/s', 'level': 4., 'diurnal': 0.2, 'seasonal': 0.2,
+         'modelled': True},
+    'Modelled Temperature':
+        {'unit': 'degC', 'level': 9., 'diurnal': 0.3, 'seasonal': 0.6,
+         'modelled': True},
+    }
+
+# The species used if none are asked for
+DEFAULT_SPECIES = ['Nitric oxide', 'Nitrogen dioxide',
+    'Nitrogen oxides as nitrogen dioxide', 'Ozone',
+    'PM10 particulate matter (Hourly measured)',
+    'PM2.5 particulate matter (Hourly measured)',
+    'Modelled Wind Direction', 'Modelled Wind Speed']
+
+def make_defra_data(years = 1, species = DEFAULT_SPECIES, start_year = 2015,
+    seed = 0, missing_fraction = 0.03, unverified_fraction = 0.01,
+    provisional_months = 3):
+    """
+        Make the synthetic data as a pandas DataFrame of strings, laid out as
+        in the DEFRA CSV files: Date, Time (hour ending, so 01:00:00 to
+        24:00:00), then each species followed by its Status column.
+        Function IN:
+            years (OPTIONAL, INTEGER):
+                Number of years of hourly data. Default = 1
+            species (OPTIONAL, LIST of STRINGS):
+                The species to include. Must be in SPECIES_INFO.
+            start_year (OPTIONAL, INTEGER):
+                The first year of data. Default = 2015
+            seed (OPTIONAL, INTEGER):
+                Seed for the random numbers so the data can be repeated.
+            missing_fraction (OPTIONAL, FLOAT):
+                Roughly the fraction of 'No data' values. These come in gaps
+                of between 1 hour and a few days. Default = 0.03
+            unverified_fraction (OPTIONAL, FLOAT):
+                Fraction of measurements marked N (not verified) or S
+                (suspect). Default = 0.01
+            provisional_months (OPTIONAL, INTEGER):
+                The last few months are marked P (provisional) as in the
+                DEFRA files. Default = 3
+        Function OUT:
+            df:
+                pandas DataFrame of strings, one column per CSV column. The
+                Status columns are all called 'Status'.
+    """
+    rng = np.random.RandomState(seed)
+
+    # Hour ending times - first is 01:00 on 1st Jan, last is 24:00 on 31st Dec
+    start = np.datetime64('%d-01-01T01:00' % start_year)
+    end = np.datetime64('%d-01-01T00:00' % (start_year + years))
+    times = pd.DatetimeIndex(np.arange(start, end + np.timedelta64(1, 'h'),
+        np.timedelta64(1, 'h')))
+    ntimes = len(times)
+    # The hour 00:00 is written as 24:00 on the day before
+    midnight = times.hour == 0
+    dates = times - pd.to_timedelta(midnight.astype(int), unit = 'D')
+    date_strings = dates.strftime('%Y-%m-%d')
+    time_strings = np.where(midnight, '24:00:00',
+        np.asarray(times.strftime('%H:%M:%S')))
+
+    # Daily and yearly cycles (peak in the morning rush hour and in winter)
+    hour_cycle = np.cos(2 * np.pi * (times.hour.values - 8) / 24.)
+    year_cycle = np.cos(2 * np.pi * (times.dayofyear.values - 15) / 365.25)
+    # Status flags apart from the missing values. Last few months provisional.
+    provisional_start = end - np.timedelta64(provisional_months * 730, 'h')
+    provisional = times.values >= provisional_start
+
+    columns = [('Date', date_strings), ('Time', time_strings)]
+    for name in species:
+        info = SPECIES_INFO[name]
+        if name == 'Modelled Wind Direction':
+            # Mostly from the south west with some spread
+            values = np.mod(225. + rng.normal(0., 70., ntimes), 360.)
+            values = np.round(values, 1)
+        else:
+            # Smoothed random noise so that hours are correlated
+            # (make 5 extra hours so the first hours have a full window)
+            noise = rolling_mean(rng.normal(0., 1., ntimes + 5), 6)[5:] * \
+                np.sqrt(6)
+            values = info['level'] * np.exp(0.5 * noise) * \
+                (1. + info['diurnal'] * 0.5 * hour_cycle) * \
+                (1. + info['seasonal'] * 0.5 * year_cycle)
+        value_strings = np.char.mod('%.5f', values).astype(object)
+
+        # Gaps in the data of between 1 and 72 hours long
+        missing = np.zeros(ntimes, dtype = bool)
+        num_gaps = rng.poisson(missing_fraction * ntimes / 12.)
+        gap_starts = rng.randint(0, ntimes, num_gaps)
+        gap_lengths = np.minimum(rng.geometric(1. / 12., num_gaps), 72)
+        for gap_start, gap_length in zip(gap_starts, gap_lengths):
+            missing[gap_start:gap_start + gap_length] = True
+        value_strings[missing] = 'No data'
+
+        # Status is validity then unit (then instrument if there is one)
+        unit = info['unit']
+        if 'instrument' in info:
+            unit = '%s %s' % (unit, info['instrument'])
+        if info.get('modelled', False):
+            flags = np.array(['M'] * ntimes, dtype = object)
+        else:
+            flags = np.where(provisional, 'P', 'V').astype(object)
+            unverified = rng.random_sample(ntimes) < unverified_fraction
+            flags[unverified] = np.where(
+                rng.random_sample(unverified.sum()) < 0.5, 'N', 'S')
+        status_strings = flags + ' ' + unit
+
+        columns.append((name, value_strings))
+        columns.append(('Status', status_strings))
+
+    # Build the DataFrame from the list so duplicate Status names are kept
+    df = pd.DataFrame(dict((n, c[1]) for n, c in enumerate(columns)))
+    df = df[list(range(len(columns)))]
+    df.columns = [c[0] for c in columns]
+
+    return df
+
+def write_defra_csv(filename, years = 1, species = DEFAULT_SPECIES,
+    start_year = 2015, seed = 0, site_name = 'Synthetic Site', **kwargs):
+    """
+        Write synthetic data to a CSV file with the same preamble as the
+        DEFRA files, so it can be read with source_AQ_data.open_csv.
+        Function IN:
+            filename (REQUIRED, STRING):
+                Path and name of the CSV file to write.
+            years, species, start_year, seed (OPTIONAL):
+                See make_defra_data. Any other keywords are passed on to
+                make_defra_data too.
+            site_name (OPTIONAL, STRING):
+                The site name written in the preamble.
+        Function OUT:
+            filename:
+                The file written.
+    """
+    df = make_defra_data(years = years, species = species,
+        start_year = start_year, seed = seed, **kwargs)
+
+    # Four lines of preamble before the column headings
+    preamble = ['Hourly data from synthetic_AQ_data (not real measurements)',
+        'All Data GMT hour ending',
+        'Status: V=Verified, P=Provisionally Verified, N=Not Verified, '
+        'S=Suspect, M=Modelled',
+        'Site Name: %s' % site_name]
+    with open(filename, 'w') as f:
+        f.write('\n'.join(preamble) + '\n')
+        df.to_csv(f, index = False)
+
+    return filename
+
+def make_example_data():
+    """
+        Write the example data file that source_AQ_data.select_one_variable
+        uses when no filename is given
+        (Example_Data/edinburgh_st_leonards_2015_2017.csv in the package).
+        Function OUT:
+            filename:
+                The file written.
+    """
+    module_path = os.path.dirname(os.path.abspath(__file__))
+    directory = os.path.join(module_path, 'Example_Data')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    filename = os.path.join(directory, 'edinburgh_st_leonards_2015_2017.csv')
+    return write_defra_csv(filename, years = 3, start_year = 2015,
+        site_name = 'Edinburgh St Leonards (synthetic)')
+
+if __name__ == '__main__':
+    print 'Written %s' % make_example_data()
+## ============================================================================
+## END OF PROGAM
+## ============================================================================
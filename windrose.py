@@ -5,11 +5,11 @@
 #   windrose(windspeed, winddirection)
 #==============================================================================
 # Uses modules:
-# numpy, sys, pandas, quick_tools
+# numpy, sys, quick_tools, AQ_profiling
 import numpy as np
 import sys
-import pandas as pd
-from quick_tools import round_up
+from quick_tools import round_up, as_float_array
+import AQ_profiling
 #==============================================================================
 
 def windrose(windspeed, winddirection, direction_bin_size = 8,
@@ -17,12 +17,12 @@ def windrose(windspeed, winddirection, direction_bin_size = 8,
     """
         Description of function here
         Function IN:
-            windspeed (REQUIRED, FLOAT/INT, LIST or PANDAS Series):
+            windspeed (REQUIRED, FLOAT/INT, LIST, ARRAY or PANDAS Series):
                 An array (or list) holding the wind speed data as either a float
                 or integer.
-            winddirection (REQUIRED, FLOAT/INT, LIST or PANDAS Series):
+            winddirection (REQUIRED, FLOAT/INT, LIST, ARRAY or PANDAS Series):
                 An array (or list) holding the wind direction data as either a float
-                or integer
+                or integer. Can be a different type to the wind speed.
             direction_bin_size (OPTIONAL, INTEGER):
                 Choose how many leaves of the windrose you want. Default 8
                 (ie. 'North', 'NE', 'East', 'SE', 'South', 'SW', 'West', 'NW').
@@ -40,15 +40,20 @@ def windrose(windspeed, winddirection, direction_bin_size = 8,
     if direction_bin_size not in [4,8,16]:
         print "Cannot compute %d bins, choose 4, 8 or 16"
         sys.exit()
+    # Make both inputs contiguous float arrays. Lists, numpy arrays and pandas
+    # Series are all accepted (Series are used without copying).
+    wind_s = as_float_array(windspeed)
+    wind_d = as_float_array(winddirection)
+
     # Test to see if wind speed an direction are same length
-    if len(windspeed) != len(winddirection):
+    if len(wind_s) != len(wind_d):
         print "Wind speed and direction not same length and need to be."
-        print "Wind speed has length %d and direction has length %d" % (len(windspeed), len(winddirection))
+        print "Wind speed has length %d and direction has length %d" % (len(wind_s), len(wind_d))
         sys.exit()
 
     # Get length of data and max wind speed
-    datalen = len(windspeed)
-    wind_max = max(windspeed)
+    datalen = len(wind_s)
+    wind_max = np.nanmax(wind_s)
     # Set the names for the dirction bins for the plot
     dirc_categories = ['North', 'NNE', 'NE', 'ENE', 'East', 'ESE', 'SE',
         'SSE', 'South', 'SSW', 'SW', 'WSW', 'West', 'WNW', 'NW', 'NNW']
@@ -69,46 +74,30 @@ def windrose(windspeed, winddirection, direction_bin_size = 8,
     # Set the number of degrees. Need one more than number of categories
     degs = np.linspace (0,360, len(dirc_categories) + 1)
 
-    # Test if the inputs are lists or pandas DataFrame or numpy.ndarray
-    if isinstance(windspeed,list) and isinstance(winddirection,list):
-        islist = True
-    elif isinstance(windspeed,pd.Series) and isinstance(winddirection,pd.Series):
-        islist = False
-    elif isinstance(windspeed,np.ndarray) and isinstance(winddirection,np.ndarray):
-        islist = True
-    else:
-        print "Input format not recognised. Use list, numpy.ndarray or pandas series"
-        print "Both wind speed and direction need to be same format."
-        sys.exit()
-    # Make a dictionary  of the wind directions and
-    # put the windspeeds into the categories
+    with AQ_profiling.stage('windrose.binning', datalen):
+        # Find the direction bin of every value in one go. Directions sitting
+        # exactly on a bin edge (or outside 0-360, or NaN) aren't in any bin.
+        direction_index = np.searchsorted(degs, wind_d, side = 'left') - 1
+        in_bin = (wind_d > degs[0]) & (wind_d < degs[-1]) & \
+            (wind_d != degs[np.clip(direction_index + 1, 0, len(degs) - 1)])
+        in_bin &= ~np.isnan(wind_s)
+
+        # Count the speeds in each direction and speed bin together.
+        # Gives a (direction x speed bin) array of counts.
+        counts = np.histogram2d(direction_index[in_bin], wind_s[in_bin],
+            bins = [np.arange(len(dirc_categories) + 1) - 0.5, speed_bins])[0]
+
     direction_dict = {}
     for n, directions in enumerate(dirc_categories):
-        # But the windspeeds that fall into the bin into dictionary
-        # If the datatype is a list then do the following:
-        if islist:
-            wind_s = np.asarray(windspeed)
-            wind_d = np.asarray(winddirection)
-
-            temp_bin = wind_s[np.where(x > degs[n] and x < deg[n + 1] for x in wind_d)]
-            direction_dict[directions] = temp_bin.tolist()
-
-        # If datatype not a list(and therefore hopefully a pandas series) then:
-        else:
-            # Select the windspeeds where the winddirection is between two degree values
-            temp_bin = windspeed.loc[(winddirection > degs[n]) &
-                (winddirection < degs[n + 1])]
-            # Add to dictionary.
-            direction_dict[directions] = temp_bin.values.tolist()
+        direction_dict[directions] = counts[n]
 
     # Create a new dictionary binned as windspeed
     # Create dictionary keys of all the windspeeds with empty lists
     windrose_data = {}
     speed_bin_names = []
     for n, directions in enumerate(dirc_categories):
-        # Use numpy.histogram to create histogram of speeds in this bin.
-        # As this returns [numbers][bins] - get first from list (ie [numbers])
-        temp_hist = np.histogram(direction_dict[directions], speed_bins)[0]
+        # Get the already counted histogram of speeds in this bin.
+        temp_hist = direction_dict[directions]
         hist_perc = temp_hist / float(datalen) * 100
 
         # Need to make the percentes add up cumultively for plotting purposes